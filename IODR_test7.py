@@ -1,11 +1,25 @@
-from dash import Dash, dcc, html, Input, Output, State, callback_context, dash_table
+from dash import Dash, dcc, html, Input, Output, State, callback_context, dash_table, Patch, no_update, \
+    ClientsideFunction
 import dash_bootstrap_components as dbc
 from dash_bootstrap_components._components.Container import Container
 from plotly.subplots import make_subplots
 from whitenoise import WhiteNoise
+from flask import Flask, request
 
 from get_data_funs import *
 from predict_funs import *
+from cache_funs import *
+from api_funs import data_response, dataframe_response, what_if_response, is_admin_request
+from analysis_funs import get_analysis_bundle, bundle_cache
+from smooth_funs import smoothing_methods
+from alert_funs import alerts_response, delete_alert, enqueue_alert_check
+from align_funs import get_aligned_temperature
+from correction_funs import process_od_data
+from archive_funs import save_experiment, list_experiments, load_experiment_info, load_experiment_data, \
+    delete_experiment
+from overlay_funs import overlay_series, overlay_figure, overlay_alignments
+from session_funs import session_store, session_value, new_session_id
+from load_funs import enqueue_load, load_status, cancel_load, load_unclaimed, unfinished_statuses
 
 import numpy as np
 import pandas as pd
@@ -13,6 +27,7 @@ import urllib.request
 import requests
 import json
 import io
+import hashlib
 import plotly.graph_objects as go
 import plotly.express as px
 
@@ -52,16 +67,243 @@ for i in range(0, 25):
 
 colors = ['#f2a367', '#ed7091', '#61d0ef', '#5bc89b', '#f6cb67', '#de5f46', '#f19ef9', '#6371f2']
 
-# creates the instance of the dash app
-app = Dash(__name__, external_stylesheets=['/style.css'])
-# creates the server to use by heroku server
-server = app.server
+# creates the server to use by heroku server. Callback responses (figures and stores as json) larger than 1 kB are
+# compressed with brotli or gzip, whichever the browser takes. The data API streams are left as they are so they still
+# stream
+server = Flask(__name__)
+server.config.update(COMPRESS_ALGORITHM=['br', 'gzip'], COMPRESS_MIN_SIZE=1024, COMPRESS_STREAMS=False)
+
+# creates the instance of the dash app, assets/style.css is loaded by dash like the other assets
+app = Dash(__name__, server=server, compress=True)
+
+# the assets are served by WhiteNoise, with the .br and .gz copies made by bin/post_compile when there are. Dash adds
+# the file's modified time to asset urls, so they can be cached for a year
+server.wsgi_app = WhiteNoise(server.wsgi_app, root=app.config.assets_folder, prefix='assets/', max_age=365 * 24 * 3600)
+
+
+def make_predict_figure_template():
+    """Returns the prediction graph as a dict with empty traces, the clientside callback in assets/predict.js fills in
+    the data, the fit lines, the target line and the annotation
+
+    traces 0 and 1 are the ln OD and OD data, 2 and 3 the ln fit line and selection, 4 and 5 the OD fit line and
+    selection, 6 and 7 the lower and upper edge of the 95% band of the OD fit line, 8 the OD readings flagged as faults
+    """
+    predict_figure = make_subplots(
+        rows=2,
+        cols=1,
+        subplot_titles=("Linear OD Graph", "Natural Log OD Graph"),
+        row_heights=[0.5, 0.5],
+        vertical_spacing=0.2)
+
+    predict_figure.add_trace(
+        go.Scatter(
+            x=[],
+            y=[],
+            mode='markers',
+            name='ln_od',
+            meta='ln_od',
+            marker=dict(
+                color='blue'
+            ),
+            legendgroup="ln traces",
+            legendgrouptitle_text="ln traces",
+            hovertemplate='Time: %{x}' +
+                          '<br>ln_od: %{y}<br>' +
+                          'Trace: %{meta}<br>' +
+                          '<extra></extra>',
+            legendrank=3
+        ),
+        row=2,
+        col=1
+    )
+
+    # create scatter plot for linear data
+    predict_figure.add_trace(
+        go.Scatter(
+            x=[],
+            y=[],
+            mode='markers',
+            name='OD',
+            meta='OD',
+            marker=dict(
+                color='blue'
+            ),
+            legendgroup="linear traces",
+            legendgrouptitle_text="linear traces",
+            hovertemplate='Time: %{x}' +
+                          '<br>OD: %{y}<br>' +
+                          'Trace: %{meta}<br>' +
+                          '<extra></extra>',
+            legendrank=1
+        ),
+        row=1,
+        col=1
+    )
+    # add the fit line trace
+    predict_figure.add_trace(
+        go.Scatter(
+            x=[],
+            y=[],
+            mode='lines',
+            name='ln_od prediction',
+            meta='ln_od prediction',
+            marker=dict(
+                color='green'
+            ),
+            legendgroup="ln traces",
+            hovertemplate='Time: %{x}' +
+                          '<br>ln_od: %{y}<br>' +
+                          'Trace: %{meta}<br>' +
+                          '<extra></extra>',
+            legendrank=4
+        ),
+        row=2,
+        col=1
+    )
+    predict_figure.add_trace(
+        go.Scatter(
+            x=[],
+            y=[],
+            mode='markers',
+            name="Selection",
+            meta="Selection",
+            marker=dict(
+                color='orange'
+            ),
+            hovertemplate='Time: %{x}' +
+                          '<br>ln_od: %{y}<br>' +
+                          'Trace: %{meta}<br>' +
+                          '<extra></extra>',
+            legendgroup="ln traces"
+        ),
+        row=2,
+        col=1
+    )
+    # add the ln fit curve trace
+    predict_figure.add_trace(
+        go.Scatter(
+            x=[],
+            y=[],
+            mode='lines',
+            marker=dict(
+                color='green'
+            ),
+            name='OD prediction',
+            meta='OD prediction',
+            legendgroup="linear traces",
+            hovertemplate='Time: %{x}' +
+                          '<br>OD: %{y}<br>' +
+                          'Trace: %{meta}<br>' +
+                          '<extra></extra>',
+            legendrank=2
+        ),
+        row=1,
+        col=1
+    )
+    predict_figure.add_trace(
+        go.Scatter(
+            x=[],
+            y=[],
+            mode="markers",
+            name="Selection",
+            meta="Selection",
+            marker=dict(
+                color="orange"
+            ),
+            hovertemplate='Time: %{x}' +
+                          '<br>OD: %{y}<br>' +
+                          'Trace: %{meta}<br>' +
+                          '<extra></extra>',
+            legendgroup="linear traces"
+        ),
+        row=1,
+        col=1
+    )
+    # 95% band of the fit line, the upper edge fills down to the lower edge
+    predict_figure.add_trace(
+        go.Scatter(
+            x=[],
+            y=[],
+            mode='lines',
+            line=dict(width=0, color='green'),
+            name='95% band',
+            legendgroup="linear traces",
+            showlegend=False,
+            hoverinfo='skip'
+        ),
+        row=1,
+        col=1
+    )
+    predict_figure.add_trace(
+        go.Scatter(
+            x=[],
+            y=[],
+            mode='lines',
+            line=dict(width=0, color='green'),
+            fill='tonexty',
+            fillcolor='rgba(0, 128, 0, 0.15)',
+            name='95% band',
+            legendgroup="linear traces",
+            hoverinfo='skip'
+        ),
+        row=1,
+        col=1
+    )
+    predict_figure.add_trace(
+        go.Scatter(
+            x=[],
+            y=[],
+            mode='markers',
+            name='Sensor faults',
+            meta='Sensor faults',
+            marker=dict(
+                color='red',
+                symbol='x',
+                size=9
+            ),
+            legendgroup="linear traces",
+            hovertemplate='Time: %{x}' +
+                          '<br>OD: %{y}<br>' +
+                          'Trace: %{meta}<br>' +
+                          '<extra></extra>'
+        ),
+        row=1,
+        col=1
+    )
+    # name the axes
+    predict_figure.update_xaxes(
+        title_text="Time",
+        row=1,
+        col=1
+    )
+    predict_figure.update_xaxes(
+        title_text="Time",
+        row=2,
+        col=1
+    )
+    predict_figure.update_yaxes(
+        title_text="OD",
+        row=1,
+        col=1
+    )
+    predict_figure.update_yaxes(
+        title_text="ln OD",
+        row=2,
+        col=1
+    )
+    predict_figure.update_layout(height=800)
+    predict_figure.update_annotations(font_size=20)
+    predict_figure.update_layout(legend_tracegroupgap=320, font=dict(size=15, family="Open Sans"))
+    predict_figure.update_xaxes(matches='x')
+    # plotly keeps the user's zoom and pan in the browser for as long as uirevision stays the same, so the fit can be
+    # redrawn without resetting the zoom or sending relayout events to the server
+    predict_figure.update_layout(uirevision='predict')
+
+    return predict_figure.to_dict()
 
-# for heroku server, will find source
-server.wsgi_app = WhiteNoise(server.wsgi_app, root='static/c')
 
 # the html layout of the app
-app.layout = html.Div([
+page_layout = html.Div([
     # this is the sticky header division at the top of the page
     html.Div(children=[
         html.H1("IODR #2 Viewer", id='header-text',
@@ -91,7 +333,9 @@ app.layout = html.Div([
                 className='download-button',
                 style={'width': 130, 'height': 50, 'font-size': 20}
             ),
-            dcc.Download(id='download-dataframe-csv')
+            dcc.Download(id='download-dataframe-csv'),
+            # what the background download of a device is doing
+            html.Div(id='load-progress')
         ],
             id='button-div',
             style={'float': 'right', 'height': 100, 'width': '70%'}
@@ -133,8 +377,16 @@ app.layout = html.Div([
                     {'name': 'Tube Name', 'id': 'name', 'type': 'text', 'editable': True},
                     {'name': 'Target OD', 'id': 'target', 'type': 'numeric', 'editable': True},
                     {'name': 'OD Offset', 'id': 'offset', 'type': 'numeric', 'editable': True},
+                    {'name': 'Suggested offset', 'id': 'suggested offset', 'type': 'numeric', 'editable': False},
                     {'name': 'Est. Time/Date', 'id': 'estimate', 'type': 'text', 'editable': False},
-                    {'name': 'R value', 'id': 'r value', 'type': 'numeric', 'editable': False}
+                    {'name': 'Earliest (95%)', 'id': 'estimate low', 'type': 'text', 'editable': False},
+                    {'name': 'Latest (95%)', 'id': 'estimate high', 'type': 'text', 'editable': False},
+                    {'name': 'R value', 'id': 'r value', 'type': 'numeric', 'editable': False},
+                    {'name': 'Lag time (h)', 'id': 'lag time', 'type': 'numeric', 'editable': False},
+                    {'name': 'μmax (1/h)', 'id': 'mu max', 'type': 'numeric', 'editable': False},
+                    {'name': 'Doubling time (h)', 'id': 'doubling time', 'type': 'numeric', 'editable': False},
+                    {'name': 'Time to max (h)', 'id': 'time to max', 'type': 'numeric', 'editable': False},
+                    {'name': 'Max OD', 'id': 'max OD', 'type': 'numeric', 'editable': False}
                 ],
                 # input some data on startup
                 data=[
@@ -161,7 +413,7 @@ app.layout = html.Div([
             ),
 
         ],
-            style={'width': 800, 'flex': 1, 'float': 'left', 'marginLeft': 100}
+            style={'width': 1280, 'flex': 1, 'float': 'left', 'marginLeft': 100}
         ),
 
         html.Button(
@@ -179,6 +431,78 @@ app.layout = html.Div([
             id='update-button',
             style={'width': 100, 'height': 60, 'font-size': 20}
         ),
+        # copies the suggested offset of every tube into its offset
+        html.Button(
+            'Apply suggested offsets',
+            id='apply-offsets-button',
+            style={'width': 140, 'height': 60, 'font-size': 16}
+        ),
+        # growth model used for the estimates in the table
+        html.Div(children=[
+            html.H4("Estimate model", style={'textAlign': 'center'}),
+            dcc.Dropdown(
+                options=[
+                    {'label': 'Exponential phase (linear ln OD)', 'value': 'linear'},
+                    {'label': 'Kalman filter (ln OD and growth rate)', 'value': 'kalman'},
+                    {'label': 'Exponential', 'value': 'exponential'},
+                    {'label': 'Logistic', 'value': 'logistic'},
+                    {'label': 'Gompertz', 'value': 'gompertz'},
+                    {'label': 'Baranyi', 'value': 'baranyi'}
+                ],
+                value='linear',
+                clearable=False,
+                id='fit-model-dropdown'
+            )],
+            style={'width': 250, 'display': 'inline-block', 'verticalAlign': 'top', 'marginLeft': 20}
+        ),
+        # how the 95% bounds of the estimates are found
+        html.Div(children=[
+            html.H4("Estimate bounds", style={'textAlign': 'center'}),
+            dcc.Dropdown(
+                options=[
+                    {'label': 'Regression standard error', 'value': 'analytic'},
+                    {'label': 'Bootstrap', 'value': 'bootstrap'}
+                ],
+                value='analytic',
+                clearable=False,
+                id='interval-dropdown'
+            )],
+            style={'width': 250, 'display': 'inline-block', 'verticalAlign': 'top', 'marginLeft': 20}
+        ),
+        # smoothing of the OD readings before they are analysed
+        html.Div(children=[
+            html.H4("Smoothing", style={'textAlign': 'center'}),
+            dcc.Dropdown(
+                options=[{'label': label, 'value': method} for method, label in smoothing_methods.items()],
+                value='none',
+                clearable=False,
+                id='smoothing-dropdown'
+            )],
+            style={'width': 250, 'display': 'inline-block', 'verticalAlign': 'top', 'marginLeft': 20}
+        ),
+        # tubes with only medium in them, used to take the temperature response out of the OD readings
+        html.Div(children=[
+            html.H4("Blank tubes (temperature correction)", style={'textAlign': 'center'}),
+            dcc.Dropdown(
+                options=[{'label': f"tube {i + 1}", 'value': i} for i in range(8)],
+                value=[],
+                multi=True,
+                placeholder="No correction",
+                id='blank-tubes-dropdown'
+            )],
+            style={'width': 300, 'display': 'inline-block', 'verticalAlign': 'top', 'marginLeft': 20}
+        ),
+        # saves the current run with its table to the experiment archive and opens archived runs
+        html.Div(children=[
+            html.H4("Experiment archive", style={'textAlign': 'center'}),
+            dcc.Input(placeholder='Experiment name', type='text', id='experiment-name-input', style={'width': 200}),
+            html.Button('Save experiment', id='save-experiment-button', style={'marginLeft': 10}),
+            dcc.Dropdown(placeholder='Archived experiments', id='archive-dropdown', style={'marginTop': 10}),
+            html.Button('Open', id='open-experiment-button', style={'marginTop': 10}),
+            html.Div(id='archive-status')
+        ],
+            style={'width': 350, 'display': 'inline-block', 'verticalAlign': 'top', 'marginLeft': 20}
+        ),
         dcc.Download('download-table-csv')],
         id='update-div'
     ),
@@ -249,6 +573,41 @@ app.layout = html.Div([
         style={'flex': 1, 'marginTop': 800, 'width': '80%'}
 
     ),
+    # estimated times of the selected tube for a grid of targets and offsets
+    html.Div(children=[
+        html.H3("What-if estimates (hours from the last reading)", style={'textAlign': 'center'}),
+        html.Div(children=[
+            html.Label("Targets "),
+            dcc.Input(value='0.3, 0.5, 0.8, 1', type='text', id='whatif-targets-input', debounce=True),
+            html.Label(" Offsets ", style={'marginLeft': 20}),
+            dcc.Input(value='-0.01, -0.005, 0, 0.005, 0.01', type='text', id='whatif-offsets-input', debounce=True)
+        ],
+            style={'textAlign': 'center'}
+        ),
+        dcc.Graph(id='whatif-graph')
+    ],
+        style={'flex': 1, 'marginTop': 30, 'width': '80%', 'marginLeft': '10%'}
+    ),
+    # tubes of archived runs drawn together, lined up at the run start or the end of the lag phase
+    html.Div(children=[
+        html.H3("Compare archived runs", style={'textAlign': 'center'}),
+        dcc.Dropdown(multi=True, placeholder='Archived tubes', id='overlay-dropdown'),
+        dcc.RadioItems(
+            options=[{'label': label, 'value': alignment} for alignment, label in overlay_alignments.items()],
+            value='start',
+            inline=True,
+            id='overlay-alignment-radio'
+        ),
+        dcc.RadioItems(
+            options=[{'label': 'OD', 'value': 'od'}, {'label': 'ln OD', 'value': 'ln_od'}],
+            value='od',
+            inline=True,
+            id='overlay-y-radio'
+        ),
+        dcc.Graph(id='overlay-graph')
+    ],
+        style={'flex': 1, 'marginTop': 30, 'width': '80%', 'marginLeft': '10%'}
+    ),
     html.Br(),
     html.Div(children=[
         html.H2("Instructions for use:", style={'textAlign': 'center'}),
@@ -268,7 +627,9 @@ app.layout = html.Div([
             select which data is used to make the prediction. Your selected range of data will be highlighted in orange. 
             The predicted growth curve will be displayed in green and the estimated date and time of when the strain reaches 
             the desired OD target with be shown in a purple box on the graph. To make small adjustments to the prediction, 
-            you can adjust the offset of the clear OD value''',
+            you can adjust the offset of the clear OD value. The suggested offset column has the offset of each tube 
+            that moves its readings before growth to a clear OD of 0.01, the Apply suggested offsets button uses them 
+            for every tube at once''',
             html.H4("Rename Traces"),
             '''To rename the traces on the graph, simply input the names of the bateria 
             strains that correspond to each tube.''',
@@ -306,14 +667,23 @@ app.layout = html.Div([
         style={'marginTop': 150}
     ),
     # storage components to share dataframes between callbacks
+    # the dataframes are kept in the server side session store, these stores only hold their tokens
     dcc.Store(id='od_df_original_full_store'),  # 8000 point dataframe as a json
     dcc.Store(id='od_df_original_culled_store'),  # thinned OD dataframe before renaming and offset vals changed (json)
     dcc.Store(id='od_df_update_store'),  # final OD dataframe used for making graphs (json)
     dcc.Store(id='temp_df_store'),  # temperature dataframe (json)
+    dcc.Store(id='data_version_store'),  # data version of the culled OD dataframe, key for the analysis bundle
     dcc.Store(id='IODR_store', data=1),  # IODR number store
     dcc.Store(data=[oldNames.copy(), oldNames.copy(), oldNames.copy()], id='newNames_store'),  # names of the tubes
     dcc.Store(id='lnDataframes_store'),  # ln dataframes, could be put into one dataframe (json)
-    dcc.Store(id='zoom_vals_store'),  # values of zoom to maintain zoom levels when changing inputs for analysis
+    dcc.Store(id='graph1_state_store'),  # what the main graph in the browser shows, to send only the changes
+    dcc.Store(id='load_job_store'),  # rq job id and device of the download that is running, None if there is none
+    dcc.Interval(id='load-interval', interval=500, disabled=True),  # polls the download while it runs
+    dcc.Store(id='load_fallback_store'),  # device to download in the callback when no worker took its download
+    dcc.Store(id='archive_store'),  # id and name of the archived experiment being viewed, None for live data
+    dcc.Store(id='predict_state_store'),  # device, data version, tube and offsets of the prediction data
+    dcc.Store(id='predict_data_store'),  # times, hours and OD of the tube on the prediction graph
+    dcc.Store(id='predict_template_store', data=make_predict_figure_template()),  # prediction graph without data
     # stores the three table dataframes as jsons
     dcc.Store(
         id='table_store',
@@ -325,6 +695,8 @@ app.layout = html.Div([
                     'target': [.5] * 8,
                     'offset': [0] * 8,
                     'estimate': [0] * 8,
+                    'estimate low': ["none"] * 8,
+                    'estimate high': ["none"] * 8,
                     'r value': [0] * 8
                 }
             ).to_json(date_format='iso', orient='table'),
@@ -334,6 +706,8 @@ app.layout = html.Div([
                     'target': [.5] * 8,
                     'offset': [0] * 8,
                     'estimate': [0] * 8,
+                    'estimate low': ["none"] * 8,
+                    'estimate high': ["none"] * 8,
                     'r value': [0] * 8
                 }
             ).to_json(date_format='iso', orient='table'),
@@ -343,6 +717,8 @@ app.layout = html.Div([
                     'target': [.5] * 8,
                     'offset': [0] * 8,
                     'estimate': [0] * 8,
+                    'estimate low': ["none"] * 8,
+                    'estimate high': ["none"] * 8,
                     'r value': [0] * 8
                 }
             ).to_json(date_format='iso', orient='table'),
@@ -352,22 +728,96 @@ app.layout = html.Div([
 ])
 
 
+def serve_layout():
+    """Returns the layout of the page with a new session id, Dash calls it for every page load"""
+    return html.Div([dcc.Store(id='session_id_store', data=new_session_id()), page_layout])
+
+
+app.layout = serve_layout
+
+
 # callback for choosing which IODR to load
 @app.callback(
     Output('IODR_store', 'data'),
     Output('od_df_original_full_store', 'data'),
     Output('od_df_original_culled_store', 'data'),
     Output('temp_df_store', 'data'),
+    Output('data_version_store', 'data'),
     Output('header-text', 'children'),
+    Output('archive_store', 'data'),
+    Output('load_job_store', 'data'),
+    Output('load-interval', 'disabled'),
+    Output('load-progress', 'children'),
+    Output('load_fallback_store', 'data'),
     Input('IODR1-button', 'n_clicks'),
     Input('IODR2-button', 'n_clicks'),
-    Input('IODR3-button', 'n_clicks')
+    Input('IODR3-button', 'n_clicks'),
+    Input('smoothing-dropdown', 'value'),
+    Input('blank-tubes-dropdown', 'value'),
+    Input('open-experiment-button', 'n_clicks'),
+    Input('load-interval', 'n_intervals'),
+    Input('load_fallback_store', 'data'),
+    State('IODR_store', 'data'),
+    State('archive-dropdown', 'value'),
+    State('archive_store', 'data'),
+    State('session_id_store', 'data'),
+    State('load_job_store', 'data')
 )
-def update_which_IODR(IODR1_button, IODR2_button, IODR3_button):  # load data on switch
+def update_which_IODR(IODR1_button, IODR2_button, IODR3_button, smoothing, blank_tubes, open_button, load_interval,
+                      load_fallback, current_device, archive_id, archive, session_id, load_job):  # load data on switch
     # gets the changed properties that caused the callback
     changed_id = [p['prop_id'] for p in callback_context.triggered][0]
+    # the processing settings change the data without a new download
+    processing_changed = 'smoothing-dropdown' in changed_id or 'blank-tubes-dropdown' in changed_id
+    # the data stores are left as they are while a download runs
+    unchanged = (no_update,) * 7
+    # the data is downloaded in this callback when redis is not reachable or no worker took the download
+    download_here = 'load_fallback_store' in changed_id and load_fallback is not None
+
+    downloaded = None
+    if 'load-interval' in changed_id:
+        # the device's data is downloaded by an rq worker, check whether it is done
+        if load_job is None:
+            return unchanged + (None, True, "", no_update)
+        status, progress, downloaded = load_status(load_job['id'])
+        if status in unfinished_statuses:
+            if not load_unclaimed(load_job, status):
+                return unchanged + (no_update, no_update, progress, no_update)
+            # no worker is running, so the download is taken back and done by the next call of this callback. The
+            # interval stops first so it does not poll while the data downloads
+            cancel_load(load_job['id'])
+            return unchanged + (None, True, f"No worker took the download, downloading IODR #{load_job['device'] + 1}",
+                                {'device': load_job['device'], 'job': load_job['id']})
+        if downloaded is None:
+            return unchanged + (None, True, f"Loading IODR #{load_job['device'] + 1} failed ({status})", no_update)
+    elif 'load_fallback_store' in changed_id and not download_here:
+        return unchanged + (no_update,) * 4
+    elif processing_changed and load_job is not None:
+        # the download that is running is processed with the new settings when it is done
+        return unchanged + (no_update,) * 4
+
+    if not processing_changed:
+        # a device button goes back to live data
+        archive = None
+    if 'open-experiment-button' in changed_id:
+        info = load_experiment_info(archive_id) if archive_id is not None else None
+        if info is None:
+            return unchanged + (no_update,) * 4
+        archive = {'id': info['id'], 'name': info['name'], 'device': info['device']}
+        if load_job is not None:
+            # the archived run replaces the device that was loading
+            cancel_load(load_job['id'])
+
     # checks which button was pressed
-    if 'IODR1-button' in changed_id:
+    if downloaded is not None:
+        device_num = load_job['device']
+    elif download_here:
+        device_num = load_fallback['device']
+    elif archive is not None:
+        device_num = archive['device']
+    elif processing_changed:
+        device_num = current_device
+    elif 'IODR1-button' in changed_id:
         device_num = 0
     elif 'IODR2-button' in changed_id:
         device_num = 1
@@ -376,19 +826,64 @@ def update_which_IODR(IODR1_button, IODR2_button, IODR3_button):  # load data on
     else:
         device_num = 1  # default IODR #2
 
-    print(f"Device {device_num+1} selected, downloading OD data...")
-    # gets the full OD data frame with 8000 points
-    od_df_original_full = get_OD_dataframe(device_num, chIDs, readAPIkeys)
+    if downloaded is not None:
+        od_df_original_full, temp_df_full = downloaded
+        # keep the download so the data API can serve it without going back to Thingspeak
+        cache_device_data('od', device_num, od_df_original_full)
+        cache_device_data('temp', device_num, temp_df_full)
+        # new data, so the worker checks whether any target time alerts are due
+        enqueue_alert_check(device_num, chIDs, readAPIkeys)
+    elif archive is not None:
+        # archived runs are read from the archive, never downloaded
+        print(f"Experiment {archive['id']} '{archive['name']}' opened from the archive")
+        od_df_original_full = load_experiment_data(archive['id'], 'od')
+        temp_df_full = load_experiment_data(archive['id'], 'temp')
+    elif processing_changed:
+        # only the smoothing or correction changed, so the last download is processed again instead of downloading
+        print(f"Device {device_num+1} smoothing changed to {smoothing}, blank tubes {blank_tubes}")
+        od_df_original_full, od_version = get_device_data('od', device_num, chIDs, readAPIkeys)
+        temp_df_full, temp_version = get_device_data('temp', device_num, chIDs, readAPIkeys)
+    else:
+        # the download runs in an rq worker so it does not hold up a web worker, a download of another device is
+        # cancelled. The load interval polls it and this callback processes the data when it is done
+        new_load_job = None if download_here else enqueue_load(device_num, chIDs, readAPIkeys, previous=load_job)
+        if new_load_job is not None:
+            return (no_update,) * 5 + (f"Loading IODR #{device_num + 1}...", no_update, new_load_job, False,
+                                       "Waiting for a worker", no_update)
+
+        # redis is not reachable or no worker took the download, so the data is downloaded here
+        print(f"Device {device_num+1} selected, downloading OD data...")
+        # gets the full OD data frame with 8000 points
+        od_df_original_full = get_OD_dataframe(device_num, chIDs, readAPIkeys)
+        # keep the download so the data API can serve it without going back to Thingspeak
+        cache_device_data('od', device_num, od_df_original_full)
+        temp_df_full = get_temp_data(device_num, chIDs, readAPIkeys)
+        cache_device_data('temp', device_num, temp_df_full)
+        # new data, so the worker checks whether any target time alerts are due
+        enqueue_alert_check(device_num, chIDs, readAPIkeys)
+    # smooth and correct the readings the way the dropdowns are set, an archived run is cached apart from the live data
+    source = 'live' if archive is None else f"archive{archive['id']}"
+    od_df_smoothed, processing = process_od_data(device_num, od_df_original_full, temp_df_full, smoothing, blank_tubes,
+                                                 source=source)
     # culls the data to only take 1/10th of the data before the most recent 2 hours
-    od_df_original_culled = cull_data(od_df_original_full)
-    temp_df_full = get_temp_data(device_num, chIDs, readAPIkeys)
+    od_df_original_culled = cull_data(od_df_smoothed)
     temp_df = cull_data(temp_df_full)
 
     # sets the text of the header to the current device number
     header_text = f"IODR #{device_num + 1} Viewer"
+    data_version = get_data_version(od_df_original_culled, processing)
+    if archive is not None:
+        header_text = f"{archive['name']} (IODR #{device_num + 1} archive)"
+        if 'open-experiment-button' in changed_id:
+            # the table saved with the run is put back once the data of this version reaches the table
+            archive['table_version'] = data_version
 
-    return device_num, od_df_original_full.to_json(date_format='iso', orient='table'), od_df_original_culled.to_json(
-        date_format='iso', orient='table'), temp_df.to_json(date_format='iso', orient='table'), header_text
+    # the dataframes stay on the server, the browser only gets their tokens
+    return device_num, \
+        session_store.put(session_id, 'od_full', od_df_original_full.to_json(date_format='iso', orient='table')), \
+        session_store.put(session_id, 'od_culled', od_df_original_culled.to_json(date_format='iso', orient='table')), \
+        session_store.put(session_id, 'temp', temp_df.to_json(date_format='iso', orient='table')), \
+        data_version, header_text, archive, None, True, "", no_update
 
 
 @app.callback(
@@ -396,19 +891,28 @@ def update_which_IODR(IODR1_button, IODR2_button, IODR3_button):  # load data on
     Output('od_df_update_store', 'data'),
     Input('update-button', 'n_clicks'),
     Input('clear-button', 'n_clicks'),
+    Input('apply-offsets-button', 'n_clicks'),
     Input('IODR_store', 'data'),
+    Input('fit-model-dropdown', 'value'),
+    Input('interval-dropdown', 'value'),
     State('table_store', 'data'),
     State('od_df_original_culled_store', 'data'),
+    State('data_version_store', 'data'),
     State('test_datatable', 'data'),
+    State('archive_store', 'data'),
+    State('smoothing-dropdown', 'value'),
+    State('blank-tubes-dropdown', 'value'),
+    State('session_id_store', 'data'),
 )
-def update_table_df(update_button, clear_button, device_num, tables_list, od_df_original_culled_json, datatable_dict):
+def update_table_df(update_button, clear_button, apply_offsets_button, device_num, fit_model, interval, tables_list,
+                    od_df_original_culled_token, data_version, datatable_dict, archive, smoothing, blank_tubes,
+                    session_id):
     # dataframe to store the info from the datatable input element
     stored_table_df = pd.read_json(tables_list[device_num], orient='table')
-    # original OD data after getting culled
-    od_df_original_culled = pd.read_json(od_df_original_culled_json, orient='table')
-    od_df_updated = od_df_original_culled.copy()
-    print("beginnninggg!!!")
-    print(od_df_updated)
+    if archive is not None and archive.get('table_version') == data_version and \
+            'IODR_store' in callback_context.triggered[0]['prop_id']:
+        # an archived run was just opened, so its names, targets and offsets replace the device's table
+        stored_table_df = load_experiment_info(archive['id'])['table']
 
     # the current info from the datatable in a dataframe
     current_table_df = pd.DataFrame.from_records(datatable_dict)
@@ -417,75 +921,93 @@ def update_table_df(update_button, clear_button, device_num, tables_list, od_df_
     targets = current_table_df['target']  # targets from the table
     print(f"targets {targets}")
 
+    # the Kalman filter and growth-model fits continue from the last ones of the same series of data, so every
+    # smoothing, blank correction and archived run gets its own series
+    processing = smoothing if not blank_tubes else f"{smoothing}-blanks{sorted(blank_tubes)}"
+    fit_key = (device_num, processing, None if archive is None else archive['id'])
+
+    # original OD data after getting culled, only parsed when the analysis bundle is not cached
+    def load_culled():
+        return pd.read_json(session_value(session_id, od_df_original_culled_token), orient='table')
+
     # checks which button was pressed
     changed_id = [p['prop_id'] for p in callback_context.triggered][0]
-    if 'update-button' in changed_id:
+    if 'update-button' in changed_id or 'apply-offsets-button' in changed_id:
+        # only the tubes whose offset or target changed get a new estimate, renaming a tube never refits it
+        changes = changed_tubes(stored_table_df, current_table_df)
+        new_offsets = [clean_offset(offset) for offset in current_table_df['offset']] \
+            if 'offset' in current_table_df else [0.0] * 8
+        if 'apply-offsets-button' in changed_id:
+            # every tube with a suggestion gets it as its offset, the others keep the offset in the table
+            bundle = get_analysis_bundle(device_num, data_version, stored_table_df['offset'].map(clean_offset),
+                                         load_culled)
+            suggested = suggest_offsets(bundle, cache_key=(device_num, data_version))
+            new_offsets = [round(float(offset), 4) if offset == offset else new_offsets[i]
+                           for i, offset in enumerate(suggested)]
+            changes['offset'] = [i for i in range(8)
+                                 if new_offsets[i] != clean_offset(stored_table_df['offset'].iloc[i])]
+        print(f"changed tubes {changes}")
+
         for i in range(8):  # 8 for 8 tubes
             new_name = new_names[i]
             target = targets[i]
             if new_name is not None and new_name != "":   # if the new name in the table is not none
                 # add the tube num in front of name and put into storage dataframe
-                stored_table_df['name'].iloc[i] = f"{i + 1}_" + new_name
+                stored_table_df.loc[i, 'name'] = f"{i + 1}_" + new_name
 
-            if target is not None:
+            if target is not None and target == target:
                 target = float(target)
-                stored_table_df['target'].iloc[i] = target     # updated the value of target in the stored table df
-
-        rename_tubes(od_df_updated, stored_table_df['name'])  # rename the tubes from the stored names
+                stored_table_df.loc[i, 'target'] = target     # updated the value of target in the stored table df
 
-        # try:
-        print("Success!!!")
         # updates the stored offset values
-        stored_table_df['offset'] = pd.DataFrame.from_records(datatable_dict)['offset']
-        # except:
-        #     print("Failed!!!")
-        #     stored_table_df['offset'] = [0] * 8
-
-        # add the offset value for each column to the OD data
-        for j in range(8):
-            od_df_updated.iloc[:, j] = od_df_original_culled.iloc[:, j] + stored_table_df['offset'].iloc[j]
-            print(od_df_updated.iloc[:, j])
-
-        ln_dataframes = [] # all of the ln_dataframes
-        for i in range(8):
-            # get the ln data and make it a json for storage
-            lndf = format_ln_data(od_df_updated, i).to_json(date_format='iso', orient='table')
-            ln_dataframes.append(lndf)
-
-        # get the time estimates for when each tube hits target and the r^2 vals
-        estimates, r_vals = estimate_times(ln_dataframes, targets)
-
-        # update the stored table
-        stored_table_df['estimate'] = estimates
-        stored_table_df['r value'] = r_vals
+        stored_table_df['offset'] = new_offsets
+
+        # the bundle only refits tubes with a new offset, a new target reuses the cached fit
+        bundle = get_analysis_bundle(device_num, data_version, stored_table_df['offset'], load_culled)
+        dirty_tubes = sorted(set(changes['offset'] + changes['target']))
+        estimates, r_vals, bounds = estimate_tubes(bundle, fit_model, stored_table_df['target'].iloc[dirty_tubes],
+                                                   dirty_tubes, fit_key=fit_key, interval=interval)
+        for i, estimate, r_val, (low, high) in zip(dirty_tubes, estimates, r_vals, bounds):
+            stored_table_df.loc[i, 'estimate'] = estimate
+            stored_table_df.loc[i, 'estimate low'] = low
+            stored_table_df.loc[i, 'estimate high'] = high
+            stored_table_df.loc[i, 'r value'] = r_val
     elif 'clear-button' in changed_id:  # clear stored table to original state if clear button clicked
         stored_table_df['target'] = [.5] * 8
         stored_table_df['name'] = oldNames
         stored_table_df['estimate'] = ["none"] * 8
+        stored_table_df['estimate low'] = ["none"] * 8
+        stored_table_df['estimate high'] = ["none"] * 8
         stored_table_df['r value'] = [0] * 8
         stored_table_df['offset'] = [0] * 8
-    else:   # on opening of page
-        rename_tubes(od_df_updated, stored_table_df['name'])    # rename tubes in df to "tube 1"...
-        targets = [.5] * 8  # set targets to .5
-
-        ln_dataframes = []
-        for i in range(8):
-            offset_value = stored_table_df['offset'].iloc[i]    # get offset values
-            # get ln data into a dataframe and make a json for storage
-            lndf = format_ln_data(od_df_updated, i, offset_value=offset_value)
-            lndf_json = lndf.to_json(date_format='iso', orient='table')
-            ln_dataframes.append(lndf_json)
-
-        # get the time estimates for when each tube hits target and the r^2 vals
-        estimates, r_vals = estimate_times(ln_dataframes, targets)
+    else:   # on opening of page, loading a device or changing the estimate model or bounds
+        stored_table_df['offset'] = [clean_offset(offset) for offset in stored_table_df['offset']]
+        # fits are reused when the same data is loaded again
+        bundle = get_analysis_bundle(device_num, data_version, stored_table_df['offset'], load_culled)
+        estimates, r_vals, bounds = estimate_tubes(bundle, fit_model, stored_table_df['target'], list(range(8)),
+                                                   fit_key=fit_key, interval=interval)
 
         stored_table_df['estimate'] = estimates
+        stored_table_df['estimate low'] = [low for low, high in bounds]
+        stored_table_df['estimate high'] = [high for low, high in bounds]
         stored_table_df['r value'] = r_vals
 
+    # the OD data with the offset value added to each column comes from the analysis bundle
+    bundle = get_analysis_bundle(device_num, data_version, stored_table_df['offset'], load_culled)
+
+    # lag time, growth rate, doubling time and max OD of every tube, only computed once for each data version and offsets
+    parameters = growth_parameters(bundle, cache_key=(device_num, data_version, bundle.offsets))
+    for name in growth_parameter_names:
+        stored_table_df[name] = np.round(parameters[name], 3)
+    # offsets that move each tube's baseline to a clear OD, the same for any offsets in the table
+    stored_table_df['suggested offset'] = np.round(suggest_offsets(bundle, cache_key=(device_num, data_version)), 4)
+    od_df_updated = pd.DataFrame(bundle.od, index=bundle.times, columns=stored_table_df['name'])
+
     # encode stored table as a json and store in the list of tables. One table for each IODR device
     tables_list[device_num] = stored_table_df.to_json(date_format='iso', orient='table')
 
-    return tables_list, od_df_updated.to_json(date_format='iso', orient='table')
+    return tables_list, session_store.put(session_id, 'od_update',
+                                          od_df_updated.to_json(date_format='iso', orient='table'))
 
 
 @app.callback(
@@ -510,11 +1032,12 @@ def update_table_display(tables_list, device_num):
     Input('download-button', 'n_clicks'),
     State('od_df_original_full_store', 'data'),
     State('IODR_store', 'data'),
+    State('session_id_store', 'data'),
     prevent_initial_call=True
 )
-def download_csv(download_button, od_df_original_full_json, device):
+def download_csv(download_button, od_df_original_full_token, device, session_id):
     # get the full dataframe
-    od_df_original_full = pd.read_json(od_df_original_full_json, orient='table')
+    od_df_original_full = pd.read_json(session_value(session_id, od_df_original_full_token), orient='table')
     # change the dataframe to a csv with filename "IODR_.csv" and send to download component
     return dcc.send_data_frame(od_df_original_full.to_csv, f"IODR{device + 1}.csv")
 
@@ -551,15 +1074,54 @@ def update_tube_dropdown(tables_list, device_num, ln_tube, current_names):
 # or the rename tubes button is pressed
 @app.callback(
     Output('graph1', 'figure'),
+    Output('graph1_state_store', 'data'),
     Input('od_df_update_store', 'data'),
     Input('table_store', 'data'),
     State('temp_df_store', 'data'),
     State('IODR_store', 'data'),
+    State('od_df_original_culled_store', 'data'),
+    State('data_version_store', 'data'),
+    State('graph1_state_store', 'data'),
+    State('session_id_store', 'data'),
 )
-def update_graph(od_df_update_store, tables_list, temp_df_store, device_num):
-    od_df_update = pd.read_json(od_df_update_store, orient='table')
-    temp_df = pd.read_json(temp_df_store, orient='table')
-    # stored_table_df = pd.read_json(tables_list[device_num], orient='table')
+def update_graph(od_df_update_store, tables_list, temp_df_token, device_num, od_df_original_culled_token,
+                 data_version, graph_state, session_id):
+    stored_table_df = pd.read_json(tables_list[device_num], orient='table')
+    names = stored_table_df['name'].tolist()
+    # the token changes with the temperature data
+    temp_hash = hashlib.md5(temp_df_token.encode('utf-8')).hexdigest()
+
+    # everything drawn on the graph except the tube names
+    new_graph_state = {'data': [device_num, data_version, stored_table_df['offset'].tolist(), temp_hash],
+                       'names': names}
+    if graph_state is not None and graph_state['data'] == new_graph_state['data']:
+        if graph_state['names'] == names:
+            return no_update, no_update
+        # only the names changed, so rename the traces already in the browser instead of sending the data again
+        figure_patch = Patch()
+        for i, col in enumerate(names):
+            figure_patch['data'][i]['name'] = col
+            figure_patch['data'][i]['meta'] = col
+            figure_patch['data'][i]['legendgroup'] = col
+            figure_patch['data'][i + len(names)]['name'] = f"{col} ln"
+            figure_patch['data'][i + len(names)]['meta'] = f"{col} ln"
+            figure_patch['data'][i + len(names)]['legendgroup'] = col
+        return figure_patch, new_graph_state
+
+    # the same data, names and offsets always make the same figure
+    figure_key = ('graph1', device_num, data_version, tuple(names), tuple(stored_table_df['offset']), temp_hash)
+    cached_figure = figure_cache.get(figure_key)
+    if cached_figure is not None:
+        return cached_figure, new_graph_state
+
+    temp_df = pd.read_json(session_value(session_id, temp_df_token), orient='table')
+    # the OD and ln OD data come from the analysis bundle shared with the table and prediction graph
+    bundle = get_analysis_bundle(device_num, data_version, stored_table_df['offset'],
+                                 lambda: pd.read_json(session_value(session_id, od_df_original_culled_token),
+                                                      orient='table'))
+    # the temperature at each OD reading, for the hover display
+    aligned_temp = get_aligned_temperature(device_num, data_version, bundle.times, temp_df)
+    temp_hover = ''.join(f'<br>{col}: %{{customdata[{i}]:.1f}}' for i, col in enumerate(aligned_temp.columns))
 
     # make the subplots object
     original_data_fig = make_subplots(
@@ -579,11 +1141,11 @@ def update_graph(od_df_update_store, tables_list, temp_df_store, device_num):
 
     index = 0
     # add the traces of each tube
-    for col in od_df_update.columns:
+    for col in names:
         original_data_fig.add_trace(
             go.Scatter(
-                x=od_df_update.index,
-                y=od_df_update[col],
+                x=bundle.times,
+                y=bundle.od[:, index],
                 mode='markers',
                 marker_size=5,
                 marker=dict(
@@ -593,9 +1155,10 @@ def update_graph(od_df_update_store, tables_list, temp_df_store, device_num):
                 # for the tube name in the hover display
                 meta=col,
                 legendgroup=f"{col}",
+                customdata=aligned_temp.to_numpy(),
                 # template for hover display
                 hovertemplate='Time: %{x}' +
-                              '<br>OD: %{y}<br>' +
+                              '<br>OD: %{y}' + temp_hover + '<br>' +
                               'Trace: %{meta}<br>' +
                               '<extra></extra>'),
             row=1,  # this is the top graph
@@ -603,11 +1166,11 @@ def update_graph(od_df_update_store, tables_list, temp_df_store, device_num):
         index += 1
 
     index = 0
-    for col in od_df_update.columns:
+    for col in names:
         original_data_fig.add_trace(
             go.Scatter(
-                x=od_df_update.index,
-                y=np.log(od_df_update[col]),
+                x=bundle.times,
+                y=bundle.ln_od[:, index],
                 mode='markers',
                 marker_size=5,
                 marker=dict(
@@ -645,6 +1208,28 @@ def update_graph(od_df_update_store, tables_list, temp_df_store, device_num):
             row=3,
             col=1)
 
+    # readings flagged as sensor faults, they are left out of every fit
+    fault_rows, fault_tubes = np.nonzero(bundle.faults)
+    original_data_fig.add_trace(
+        go.Scatter(
+            x=bundle.times[fault_rows],
+            y=bundle.od[fault_rows, fault_tubes],
+            mode='markers',
+            marker=dict(
+                color='red',
+                symbol='x',
+                size=9
+            ),
+            name='Sensor faults',
+            # tube numbers rather than names, so renaming the tubes does not change this trace
+            customdata=fault_tubes + 1,
+            hovertemplate='Time: %{x}' +
+                          '<br>OD: %{y}<br>' +
+                          'Fault in tube %{customdata}<br>' +
+                          '<extra></extra>'),
+        row=1,
+        col=1)
+
     # align the x-axis
     original_data_fig.update_xaxes(matches='x')
     # de-align the y-axes
@@ -697,278 +1282,274 @@ def update_graph(od_df_update_store, tables_list, temp_df_store, device_num):
         col=1
     )
     # return the od_df_original dataframe as a json to the store component
-    return original_data_fig
+    return figure_cache.put(figure_key, original_data_fig.to_dict()), new_graph_state
 
 
-# callback for the prediction graphs
+# callback for the data of the prediction graphs, the graph itself is drawn by the clientside callback below
 @app.callback(
-    Output('linearODgraph', 'figure'),
+    Output('predict_data_store', 'data'),
+    Output('predict_state_store', 'data'),
+    Output('data-selection-slider', 'value'),
     Input('tube-dropdown', 'value'),
     Input('od_df_update_store', 'data'),
-    Input('OD_target_slider', 'value'),
-    Input('data-selection-slider', 'value'),
-    Input('blank-val-input', 'value'),
     Input('table_store', 'data'),
-    State('zoom_vals_store', 'data'),
-    State('IODR_store', 'data')
+    State('IODR_store', 'data'),
+    State('od_df_original_culled_store', 'data'),
+    State('data_version_store', 'data'),
+    State('predict_state_store', 'data'),
+    State('session_id_store', 'data')
 )
-def update_predict_graphs(fit_tube, od_df_update_json, OD_target_slider, data_selection_slider, blank_value_input,
-                          tables_list, zoom_vals, device_num):
-    # read the dataframe in from the storage component
-    od_df_update = pd.read_json(od_df_update_json, orient='table')
+def update_predict_data(fit_tube, od_df_update_token, tables_list, device_num, od_df_original_culled_token,
+                        data_version, predict_state, session_id):
     stored_table_df = pd.read_json(tables_list[device_num], orient='table')
     names = stored_table_df['name'].tolist()
+    tube_num = names.index(fit_tube) if fit_tube in names else 0
+
+    # the tube's data is only sent to the browser when it changed, renames do not change it
+    new_predict_state = [device_num, data_version, tube_num, stored_table_df['offset'].tolist()]
+    if new_predict_state == predict_state:
+        return no_update, no_update, no_update
+
+    bundle = get_analysis_bundle(device_num, data_version, stored_table_df['offset'],
+                                 lambda: pd.read_json(session_value(session_id, od_df_original_culled_token),
+                                                      orient='table'))
+    # format the data into a dataframe of just the selected tube's OD data, the blank value is added in the browser
+    ln_od_df = bundle.tube_dataframe(tube_num)
+
+    predict_data = {
+        # times are sent as local time strings, like plotly draws the times of the other graphs
+        'x': ln_od_df.index.strftime("%Y-%m-%d %H:%M:%S").tolist(),
+        # hours since the first data point, the time scale of predict_curve
+        'hours': ((ln_od_df.index - ln_od_df.index[0]) / pd.Timedelta(1, 'h')).tolist() if len(ln_od_df) else [],
+        # the browser adds hours to the first data point in milliseconds since 1970 UTC, and writes the result in the
+        # data's time zone, so times across a daylight saving change match hours_to_time_str
+        'start': int(ln_od_df.index[0].value // 10**6) if len(ln_od_df) else None,
+        'tz': str(ln_od_df.index.tz) if ln_od_df.index.tz is not None else 'UTC',
+        'od': ln_od_df['OD'].tolist(),
+        # readings flagged as sensor faults are drawn but left out of the fit
+        'fault': ln_od_df['fault'].tolist()
+    }
+    # the slider starts on the tube's exponential phase, the window the table estimate uses
+    selection = [float(bundle.fits['start'][tube_num]), float(bundle.fits['end'][tube_num])]
+    if not np.all(np.isfinite(selection)):
+        selection = no_update
+    return predict_data, new_predict_state, selection
+
+
+# fits the selected data and draws the prediction graph in the browser, so moving the sliders or changing the blank
+# value does not go to the server
+app.clientside_callback(
+    ClientsideFunction(namespace='predict', function_name='update_predict_graph'),
+    Output('linearODgraph', 'figure'),
+    Input('predict_data_store', 'data'),
+    Input('OD_target_slider', 'value'),
+    Input('data-selection-slider', 'value'),
+    Input('blank-val-input', 'value'),
+    State('predict_template_store', 'data')
+)
 
-    blank_value_input = float(blank_value_input)
-
-    if fit_tube is not None:
-        # format the data into a dataframe of just the selected tube's OD and ln_od data
-        ln_od_df = format_ln_data(od_df_update, names.index(fit_tube), offset_value=float(blank_value_input))
-    else:
-        ln_od_df = format_ln_data(od_df_update, 0, offset_value=float(blank_value_input))
-
-    print("ln_od_df")
-    print(ln_od_df)
-    # use predict_curve function to predict the curve and get the last time point as a float
-    popt, last_time_point = predict_curve(ln_od_df, data_selection_slider)
-
-    # create scatter plot for ln data
-
-    predict_figure = make_subplots(
-        rows=2,
-        cols=1,
-        subplot_titles=("Linear OD Graph", "Natural Log OD Graph"),
-        row_heights=[0.5, 0.5],
-        vertical_spacing=0.2)
-
-    predict_figure.add_trace(
-        go.Scatter(
-            x=ln_od_df.index,
-            y=ln_od_df.lnOD,  # this one?
-            mode='markers',
-            name='ln_od',
-            meta='ln_od',
-            marker=dict(
-                color='blue'
-            ),
-            legendgroup="ln traces",
-            legendgrouptitle_text="ln traces",
-            hovertemplate='Time: %{x}' +
-                          '<br>ln_od: %{y}<br>' +
-                          'Trace: %{meta}<br>' +
-                          '<extra></extra>',
-            legendrank=3
-        ),
-        row=2,
-        col=1
-    )
-
-    # create scatter plot for linear data
-    predict_figure.add_trace(
-        go.Scatter(
-            x=ln_od_df.index,
-            y=ln_od_df.OD,
-            mode='markers',
-            name='OD',
-            meta='OD',
-            marker=dict(
-                color='blue'
-            ),
-            legendgroup="linear traces",
-            legendgrouptitle_text="linear traces",
-            hovertemplate='Time: %{x}' +
-                          '<br>OD: %{y}<br>' +
-                          'Trace: %{meta}<br>' +
-                          '<extra></extra>',
-            legendrank=1
-        ),
-        row=1,
-        col=1
-    )
-    # name the axes
-    predict_figure.update_xaxes(
-        title_text="Time",
-        row=1,
-        col=1
-    )
-    predict_figure.update_xaxes(
-        title_text="Time",
-        row=2,
-        col=1
-    )
-    predict_figure.update_yaxes(
-        title_text="OD",
-        row=1,
-        col=1
-    )
-    predict_figure.update_yaxes(
-        title_text="ln OD",
-        row=2,
-        col=1
-    )
-    predict_figure.update_layout(height=800)
-
-    if len(popt) != 0:
-        last_time_time = ln_od_df.index[-1]
-
-        print("add predictions")
-        # get where the ln curve intercepts the target line
-        intercept_x = (np.log(OD_target_slider) - popt[1]) / popt[0]  # need to fix!!!!
-        print(f"t predict")
-        # create an np array for time coordinates
-        t_predict = np.linspace((last_time_point + data_selection_slider[0]), intercept_x, 50)
-        selection_df = ln_od_df.loc[
-            (ln_od_df.index > (last_time_time + data_selection_slider[0] * pd.Timedelta(1, 'h'))) & (
-                    ln_od_df.index < last_time_time + data_selection_slider[1] * pd.Timedelta(1, 'h'))]
-
-        # create array of y coordinates with linear curve calculated earlier
-        y_predict = linear_curve(t_predict, popt[0], popt[1])
-
-        # change the time predict back to datatime objects
-        t_predict = (t_predict * pd.Timedelta(1, 'h')) + od_df_update.index[0]
-
-        r = round(popt[2], 3)
-        print("R value:  ", r)
-        # add the fit line trace
-        predict_figure.add_trace(
-            go.Scatter(
-                x=t_predict,
-                y=y_predict,
-                mode='lines',
-                name='ln_od prediction',
-                meta='ln_od prediction',
-                marker=dict(
-                    color='green' if r ** 2 > 0.9 else 'red'
-                ),
-                legendgroup="ln traces",
-                hovertemplate='Time: %{x}' +
-                              '<br>ln_od: %{y}<br>' +
-                              'Trace: %{meta}<br>' +
-                              '<extra></extra>',
-                legendrank=4
-            ),
-            row=2,
-            col=1
-        )
-        predict_figure.add_trace(
-            go.Scatter(
-                x=selection_df.index,
-                y=selection_df.lnOD,  # this one?
-                mode='markers',
-                name="Selection",
-                meta="Selection",
-                marker=dict(
-                    color='orange'
-                ),
-                hovertemplate='Time: %{x}' +
-                              '<br>ln_od: %{y}<br>' +
-                              'Trace: %{meta}<br>' +
-                              '<extra></extra>',
-                legendgroup="ln traces"
-            ),
-            row=2,
-            col=1
-        )
-        # transform linear y coordinates into ln values
-        y_predict_lin = np.exp(y_predict)
-        # add the ln fit curve trace
-        predict_figure.add_trace(
-            go.Scatter(
-                x=t_predict,
-                y=y_predict_lin,
-                mode='lines',
-                marker=dict(
-                    color='green' if r ** 2 > 0.9 else 'red'
-                ),
-                name='OD prediction',
-                meta='OD prediction',
-                legendgroup="linear traces",
-                hovertemplate='Time: %{x}' +
-                              '<br>OD: %{y}<br>' +
-                              'Trace: %{meta}<br>' +
-                              '<extra></extra>',
-                legendrank=2
-            ),
-            row=1,
-            col=1
-        )
-
-        predict_figure.add_trace(
-            go.Scatter(
-                x=selection_df.index,
-                y=selection_df.OD,
-                mode="markers",
-                name="Selection",
-                meta="Selection",
-                marker=dict(
-                    color="orange"
-                ),
-                hovertemplate='Time: %{x}' +
-                              '<br>OD: %{y}<br>' +
-                              'Trace: %{meta}<br>' +
-                              '<extra></extra>',
-                legendgroup="linear traces"
-            )
-        )
-        # get the last recorded time point as a datetime object
-        first_time_time = ln_od_df.index[0]
-
-        # calculate the x coordinate when the ln curve intercepts the target line
-        time_intercept_x = (intercept_x * pd.Timedelta(1, 'h')) + first_time_time  # need to fix!!!
-
-        predict_figure.add_vline(x=time_intercept_x, line_width=2, line_dash='dash', row=1, col=1)
-
-        time_intercept_x_str = (time_intercept_x).strftime("%Y-%m-%d %H:%M:%S")
-        # first_time_str = (first_time_time - pd.Timedelta(4, 'h')).strftime("%Y-%m-%d %H:%M:%S")
-
-        predict_figure.update_annotations(font_size=20)
 
-        predict_figure.add_annotation(
-            x=time_intercept_x_str,
-            y=OD_target_slider,
-            text=f"Time when growth hits target: {time_intercept_x_str}",
-            font=dict(
-                color="#ffffff",
-                size=15
-            ),
-            showarrow=False,
-            xshift=-200,
-            yshift=-20,
-            align='center',
-            bordercolor="orange",
-            borderwidth=2,
-            bgcolor="blue",
-            opacity=.5,
-        )
-    predict_figure.update_layout(legend_tracegroupgap=320, font=dict(size=15, family="Open Sans"))
-    predict_figure.add_hline(y=OD_target_slider, line_width=2, line_dash='dash', row=1, col=1)
-    if len(zoom_vals) != 0:
-        if zoom_vals[0] is True:
-            predict_figure.update_xaxes(matches='x', autorange=True)
+# saves the current run to the experiment archive and lists the archived runs
+@app.callback(
+    Output('archive-dropdown', 'options'),
+    Output('archive-status', 'children'),
+    Input('save-experiment-button', 'n_clicks'),
+    State('experiment-name-input', 'value'),
+    State('IODR_store', 'data'),
+    State('table_store', 'data'),
+    State('od_df_original_full_store', 'data'),
+    State('od_df_original_culled_store', 'data'),
+    State('data_version_store', 'data'),
+    State('smoothing-dropdown', 'value'),
+    State('blank-tubes-dropdown', 'value'),
+    State('archive_store', 'data'),
+    State('session_id_store', 'data')
+)
+def update_archive(save_button, name, device_num, tables_list, od_df_original_full_token, od_df_original_culled_token,
+                   data_version, smoothing, blank_tubes, archive, session_id):
+    status = ""
+    changed_id = [p['prop_id'] for p in callback_context.triggered][0]
+    if 'save-experiment-button' in changed_id and od_df_original_full_token is not None:
+        stored_table_df = pd.read_json(tables_list[device_num], orient='table')
+        od_df_full = pd.read_json(session_value(session_id, od_df_original_full_token), orient='table')
+        # the full temperature data, the store only has the culled data
+        if archive is not None:
+            temp_df_full = load_experiment_data(archive['id'], 'temp')
         else:
-            predict_figure.update_xaxes(matches='x', range=zoom_vals)
-    else:
-        predict_figure.update_xaxes(matches='x')
+            temp_df_full, temp_version = get_device_data('temp', device_num, chIDs, readAPIkeys)
+        bundle = get_analysis_bundle(device_num, data_version, stored_table_df['offset'],
+                                     lambda: pd.read_json(session_value(session_id, od_df_original_culled_token),
+                                                          orient='table'))
+        processing = smoothing if not blank_tubes else f"{smoothing}-blanks{sorted(blank_tubes)}"
+        if not name:
+            name = f"IODR #{device_num + 1} {od_df_full.index[-1]:%Y-%m-%d %H:%M}"
+        experiment_id = save_experiment(name, device_num, od_df_full, temp_df_full, stored_table_df, bundle.fits,
+                                        processing)
+        status = f"Saved '{name}' as experiment {experiment_id}"
+
+    options = [{'label': f"{experiment['name']} (IODR #{experiment['device'] + 1}, {experiment['end_time'][:16]})",
+                'value': experiment['id']} for experiment in list_experiments()]
+    return options, status
+
+
+# every tube of every archived run can be picked for the overlay, values are 'experiment id:tube number'
+@app.callback(
+    Output('overlay-dropdown', 'options'),
+    Input('archive-dropdown', 'options')
+)
+def update_overlay_options(archive_options):
+    options = []
+    for experiment in list_experiments():
+        table = load_experiment_info(experiment['id'])['table']
+        for tube in range(len(experiment['tubes'])):
+            tube_name = table['name'].iloc[tube] if 'name' in table and tube < len(table) else f"tube {tube + 1}"
+            options.append({'label': f"{experiment['name']}: {tube_name}", 'value': f"{experiment['id']}:{tube}"})
+    return options
+
 
-    return predict_figure
+@app.callback(
+    Output('overlay-graph', 'figure'),
+    Input('overlay-dropdown', 'value'),
+    Input('overlay-alignment-radio', 'value'),
+    Input('overlay-y-radio', 'value'),
+    prevent_initial_call=True
+)
+def update_overlay_graph(selected, alignment, y_column):
+    selections = [tuple(int(part) for part in value.split(':')) for value in selected or []]
+    return overlay_figure(overlay_series(selections, alignment), y_column, alignment)
 
 
+# heatmap of the estimated times of the selected tube for every target and offset in the what-if inputs
 @app.callback(
-    Output('zoom_vals_store', 'data'),
-    Input('linearODgraph', 'relayoutData')
+    Output('whatif-graph', 'figure'),
+    Input('tube-dropdown', 'value'),
+    Input('table_store', 'data'),
+    Input('whatif-targets-input', 'value'),
+    Input('whatif-offsets-input', 'value'),
+    State('IODR_store', 'data'),
+    State('od_df_original_culled_store', 'data'),
+    State('data_version_store', 'data'),
+    State('session_id_store', 'data'),
+    prevent_initial_call=True
 )
-def zoom_event(relayout_data):
-    data = []
-    if relayout_data is not None:
-        if 'xaxis.range[0]' in relayout_data:   # when the graph gets zoomed, the current xaxis range values are stored
-            data.append(relayout_data['xaxis.range[0]'])
-            data.append(relayout_data['xaxis.range[1]'])
-        else:
-            data = []
-        if 'xaxis.autorange' in relayout_data:  # if user double clicks to autorange, then range values set to autorange
-            data.append(relayout_data['xaxis.autorange'])
+def update_what_if_graph(fit_tube, tables_list, targets_text, offsets_text, device_num, od_df_original_culled_token,
+                         data_version, session_id):
+    if od_df_original_culled_token is None:
+        return no_update
+    try:
+        targets = [float(target) for target in targets_text.split(',') if target.strip() != '']
+        offsets = [float(offset) for offset in offsets_text.split(',') if offset.strip() != '']
+    except (AttributeError, ValueError):
+        return no_update
+    if len(targets) == 0 or len(offsets) == 0:
+        return no_update
 
-    return data
+    stored_table_df = pd.read_json(tables_list[device_num], orient='table')
+    names = stored_table_df['name'].tolist()
+    tube_num = names.index(fit_tube) if fit_tube in names else 0
+    bundle = get_analysis_bundle(device_num, data_version, stored_table_df['offset'],
+                                 lambda: pd.read_json(session_value(session_id, od_df_original_culled_token),
+                                                      orient='table'))
+
+    # one grid for all targets and offsets of the tube
+    grid = what_if_grid(bundle, targets, offsets, [tube_num])[0]
+    etas = [[hours_to_time_str(bundle.times[0], hours) for hours in row] for row in grid]
+    what_if_fig = go.Figure(go.Heatmap(
+        z=np.round(grid - bundle.hours[-1], 2),
+        x=[str(target) for target in targets],
+        y=[str(offset) for offset in offsets],
+        text=etas,
+        texttemplate='%{z}',
+        hovertemplate='target %{x}, offset %{y}<br>%{text}<extra></extra>',
+        colorscale='Viridis',
+        colorbar={'title': 'hours'}
+    ))
+    what_if_fig.update_layout(title=names[tube_num], xaxis_title='Target OD', yaxis_title='OD offset', height=400)
+    return what_if_fig
+
+
+# hit and miss counters of the figure and analysis bundle caches, and the size of the session store
+@server.route('/api/cache/stats')
+def api_cache_stats():
+    return {'figures': figure_cache.stats(), 'analysis_bundles': bundle_cache.stats(),
+            'sessions': session_store.stats()}
+
+
+# read API for the OD and temperature data, devices are numbered 1-3 like the buttons
+@server.route('/api/devices/<int:device>/od')
+def api_od_data(device):
+    if not 1 <= device <= len(devNames):
+        return f"no device {device}\n", 404
+    return data_response('od', device - 1)
+
+
+@server.route('/api/devices/<int:device>/temperature')
+def api_temp_data(device):
+    if not 1 <= device <= len(devNames):
+        return f"no device {device}\n", 404
+    return data_response('temp', device - 1)
+
+
+# estimated times of a grid of targets and offsets, e.g. /api/devices/1/whatif?targets=0.3,0.5&offsets=0,0.01&tubes=1,2
+@server.route('/api/devices/<int:device>/whatif')
+def api_what_if(device):
+    if not 1 <= device <= len(devNames):
+        return f"no device {device}\n", 404
+    return what_if_response(device - 1)
+
+
+# archived experiments: GET lists them (?device=1-3 for one device)
+@server.route('/api/experiments')
+def api_experiments():
+    device = request.args.get('device', type=int)
+    return {'experiments': list_experiments(None if device is None else device - 1)}
+
+
+# one archived experiment with its table and fits, DELETE removes it (only with the admin token, see api_funs)
+@server.route('/api/experiments/<int:experiment_id>', methods=['GET', 'DELETE'])
+def api_experiment(experiment_id):
+    if request.method == 'DELETE':
+        if not is_admin_request():
+            return "deleting experiments needs the IODR_ADMIN_TOKEN\n", 403
+        if not delete_experiment(experiment_id):
+            return f"no experiment {experiment_id}\n", 404
+        return '', 204
+    info = load_experiment_info(experiment_id)
+    if info is None:
+        return f"no experiment {experiment_id}\n", 404
+    info['table'] = json.loads(info['table'].to_json(orient='records'))
+    if info['fits'] is not None:
+        info['fits'] = {key: [None if value != value else float(value) for value in values]
+                        for key, values in info['fits'].items()}
+    return info
+
+
+# archived OD and temperature data, with the same query parameters as the device data API
+@server.route('/api/experiments/<int:experiment_id>/<kind>')
+def api_experiment_data(experiment_id, kind):
+    kinds = {'od': 'od', 'temperature': 'temp'}
+    if kind not in kinds:
+        return f"no data {kind}\n", 404
+    dataframe = load_experiment_data(experiment_id, kinds[kind])
+    if dataframe is None:
+        return f"no experiment {experiment_id}\n", 404
+    return dataframe_response(dataframe, f"archive-{experiment_id}", kinds[kind], f"experiment-{experiment_id}")
+
+
+# target time alerts: GET lists them, POST adds one (json body, see alert_funs.save_alert), DELETE removes one. Adding
+# and removing alerts needs the admin token, see api_funs
+@server.route('/api/alerts', methods=['GET', 'POST'])
+def api_alerts():
+    return alerts_response(chIDs, readAPIkeys)
+
+
+@server.route('/api/alerts/<alert_id>', methods=['DELETE'])
+def api_delete_alert(alert_id):
+    if not is_admin_request():
+        return "deleting alerts needs the IODR_ADMIN_TOKEN\n", 403
+    if not delete_alert(alert_id):
+        return f"no alert {alert_id}\n", 404
+    return '', 204
 
 
 if __name__ == '__main__':
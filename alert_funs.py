@@ -0,0 +1,388 @@
+import json
+import os
+import smtplib
+import time
+import uuid
+from datetime import timedelta
+from email.message import EmailMessage
+from email.utils import parseaddr
+from urllib.parse import urlparse
+
+import numpy as np
+import pandas as pd
+import redis
+import requests
+from flask import request
+from rq import Queue
+
+from worker import conn
+from cache_funs import get_device_data
+from get_data_funs import cull_data
+from analysis_funs import build_analysis_bundle
+from smooth_funs import smoothing_methods
+from correction_funs import process_od_data
+from api_funs import is_admin_request
+
+# redis hash of the alert subscriptions, keyed by alert id
+alerts_key = 'iodr:alerts'
+
+# prefix of the redis keys that mark an alert as sent for one lead time
+fired_prefix = 'iodr:alerts:fired:'
+
+# seconds an alert stays marked as sent, so the next run in the same tube can alert again
+fired_ttl = 24 * 3600
+
+# minutes between the alert checks the rq worker schedules for itself
+check_minutes = int(os.getenv('ALERT_CHECK_MINUTES', 5))
+
+# lead times (minutes before the estimated time) of a new alert that does not give its own
+default_lead_minutes = [60, 15, 0]
+
+# estimated times further out than this many hours count as never, a tube that barely grows would otherwise overflow
+# the timestamps
+max_eta_hours = 24 * 365 * 100
+
+# file the log sink appends to, set on the server and never by an alert
+alert_log_path = os.getenv('ALERT_LOG_PATH', 'alerts.log')
+
+# hosts webhook alerts may post to and email addresses (or @domains) alerts may be sent to, comma separated. A sink is
+# turned off while its list is empty, so even the admin token can not send alerts anywhere the server does not allow
+webhook_hosts = [host.strip().lower() for host in os.getenv('ALERT_WEBHOOK_HOSTS', '').split(',') if host.strip()]
+email_allowlist = [address.strip().lower() for address in os.getenv('ALERT_EMAIL_ALLOWLIST', '').split(',')
+                   if address.strip()]
+
+# subscriptions and sent marks used when redis is not reachable, only seen by this process
+memory_alerts = {}
+memory_fired = {}
+
+
+def redis_call(func, fallback):
+    """Returns func() or, if redis is not reachable, fallback()"""
+    try:
+        return func()
+    except redis.exceptions.ConnectionError:
+        return fallback()
+
+
+def check_sink(sink):
+    """Returns the sink with only the settings its type uses, or raises ValueError if the type is unknown or its
+    target is not on the server's allowlist
+
+    Arguments:
+
+    sink -- dict with 'type' from alert_sinks, 'url' for a webhook and 'to' for an email
+    """
+    if not isinstance(sink, dict) or sink.get('type') not in alert_sinks:
+        raise ValueError(f"sink type must be one of {', '.join(alert_sinks)}")
+    if sink['type'] == 'webhook':
+        url = str(sink.get('url', ''))
+        parsed = urlparse(url)
+        if parsed.scheme not in ('http', 'https') or (parsed.hostname or '').lower() not in webhook_hosts:
+            raise ValueError("webhook url must be http(s) on a host in ALERT_WEBHOOK_HOSTS")
+        return {'type': 'webhook', 'url': url}
+    if sink['type'] == 'email':
+        address = parseaddr(str(sink.get('to', '')))[1].lower()
+        if address.count('@') != 1 or (address not in email_allowlist and
+                                       '@' + address.split('@')[1] not in email_allowlist):
+            raise ValueError("email address must be in ALERT_EMAIL_ALLOWLIST")
+        return {'type': 'email', 'to': address}
+    # the log sink always writes to alert_log_path
+    return {'type': 'log'}
+
+
+def redact_sink(sink):
+    """Returns the sink with its target cut down to the webhook's host or the email's domain, so listing the alerts
+    does not give away anyone's webhook url or email address"""
+    if sink['type'] == 'webhook':
+        return {'type': 'webhook', 'host': urlparse(sink['url']).hostname}
+    if sink['type'] == 'email':
+        return {'type': 'email', 'domain': sink['to'].split('@')[-1]}
+    return dict(sink)
+
+
+def save_alert(alert):
+    """Stores an alert subscription and returns it with its id
+
+    Arguments:
+
+    alert -- dict with 'device' (1-3), 'tube' (1-8), 'target' (OD), optional 'offset', 'name' and 'lead_minutes'
+    (list of minutes before the estimated time to alert at), 'smoothing' (from smoothing_methods) and 'blank_tubes'
+    (list of tube numbers 1-8), the processing the table used when the alert was made, and 'sink' (dict with 'type'
+    from alert_sinks and the settings of that sink, e.g. {'type': 'webhook', 'url': ...}, see check_sink)
+    """
+    device = int(alert['device'])
+    tube = int(alert['tube'])
+    if not 1 <= device <= 3 or not 1 <= tube <= 8:
+        raise ValueError("device must be 1-3 and tube 1-8")
+    smoothing = alert.get('smoothing') or 'none'
+    if smoothing not in smoothing_methods:
+        raise ValueError(f"smoothing must be one of {', '.join(smoothing_methods)}")
+    blank_tubes = sorted({int(blank) for blank in alert.get('blank_tubes') or []})
+    if not all(1 <= blank <= 8 for blank in blank_tubes):
+        raise ValueError("blank tubes must be 1-8")
+    sink = check_sink(alert.get('sink') or {})
+
+    alert = {
+        'id': uuid.uuid4().hex[:12],
+        'device': device,
+        'tube': tube,
+        'name': alert.get('name') or f"tube {tube}",
+        'target': float(alert['target']),
+        'offset': float(alert.get('offset') or 0),
+        'lead_minutes': sorted({int(lead) for lead in alert.get('lead_minutes', default_lead_minutes)}, reverse=True),
+        'smoothing': smoothing,
+        'blank_tubes': blank_tubes,
+        'sink': sink
+    }
+
+    def in_redis():
+        conn.hset(alerts_key, alert['id'], json.dumps(alert))
+
+    def in_memory():
+        memory_alerts[alert['id']] = alert
+
+    redis_call(in_redis, in_memory)
+    return alert
+
+
+def list_alerts(device=None):
+    """Returns a list of the stored alert subscriptions, only those of one device (1-3) if device is given"""
+    def from_redis():
+        return [json.loads(value) for value in conn.hgetall(alerts_key).values()]
+
+    alerts = redis_call(from_redis, lambda: list(memory_alerts.values()))
+    if device is not None:
+        alerts = [alert for alert in alerts if alert['device'] == device]
+    return alerts
+
+
+def delete_alert(alert_id):
+    """Removes an alert subscription, returns True if it existed"""
+    return bool(redis_call(lambda: conn.hdel(alerts_key, alert_id), lambda: memory_alerts.pop(alert_id, None)))
+
+
+def mark_fired(alert_id, lead):
+    """Returns True the first time it is called for an alert and lead time within fired_ttl seconds, so every alert is
+    only sent once however many processes check it"""
+    key = f"{fired_prefix}{alert_id}:{lead}"
+
+    def in_memory():
+        if memory_fired.get(key, 0) > time.time():
+            return False
+        memory_fired[key] = time.time() + fired_ttl
+        return True
+
+    return bool(redis_call(lambda: conn.set(key, 1, nx=True, ex=fired_ttl), in_memory))
+
+
+def send_webhook(alert, message, payload):
+    """Posts the payload as json to the alert's sink url"""
+    # redirects are not followed, they could lead off the allowed hosts
+    response = requests.post(alert['sink']['url'], json=payload, timeout=10, allow_redirects=False)
+    response.raise_for_status()
+
+
+def send_email(alert, message, payload):
+    """Emails the message to the alert's sink address through the SMTP server in the SMTP_* environment variables"""
+    email = EmailMessage()
+    email['Subject'] = message
+    email['From'] = os.getenv('SMTP_FROM', 'iodr@localhost')
+    email['To'] = alert['sink']['to']
+    email.set_content(json.dumps(payload, indent=2))
+    with smtplib.SMTP(os.getenv('SMTP_HOST', 'localhost'), int(os.getenv('SMTP_PORT', 25))) as smtp:
+        if os.getenv('SMTP_USER'):
+            smtp.starttls()
+            smtp.login(os.getenv('SMTP_USER'), os.getenv('SMTP_PASSWORD', ''))
+        smtp.send_message(email)
+
+
+def write_log(alert, message, payload):
+    """Appends the payload as a line of json to alert_log_path, a stand-in for testing"""
+    with open(alert_log_path, 'a') as log_file:
+        log_file.write(json.dumps(payload) + "\n")
+
+
+# functions that deliver an alert, keyed by the sink type. Each gets the alert, a one line message and the payload
+alert_sinks = {
+    'webhook': send_webhook,
+    'email': send_email,
+    'log': write_log
+}
+
+
+def alert_etas(dataframe, alerts):
+    """Returns a pandas DatetimeIndex of the estimated time (NaT if there is none) each alert's tube reaches the
+    alert's target, from the exponential phase fit of ln(OD + offset) with the alert's offset, the same fit as the table
+
+    The alerts with the same offset share one bundle, in which only their tubes are fitted again.
+
+    Arguments:
+
+    dataframe -- pandas dataframe of the device's OD data (no offsets added) processed like the alerts ask, like
+    od_df_original_culled
+
+    alerts -- list of alert subscriptions of the device
+    """
+    num_tubes = dataframe.shape[1]
+    base = build_analysis_bundle(dataframe, [0] * num_tubes)
+    hours = np.full(len(alerts), np.nan)
+    for offset in sorted({alert['offset'] for alert in alerts}):
+        picked = [i for i, alert in enumerate(alerts) if alert['offset'] == offset]
+        tubes = np.array([alerts[i]['tube'] - 1 for i in picked], dtype=int)
+        offsets = np.zeros(num_tubes)
+        offsets[tubes] = offset
+        bundle = build_analysis_bundle(dataframe, offsets, base=base)
+        targets = np.array([alerts[i]['target'] for i in picked], dtype=float)
+        slopes = bundle.fits['slope'][tubes]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tube_hours = (np.log(targets) - bundle.fits['intercept'][tubes]) / slopes
+            hours[picked] = np.where(np.isfinite(tube_hours) & (slopes > 0), tube_hours, np.nan)
+    hours = np.where(np.abs(hours) <= max_eta_hours, hours, np.nan)
+    return base.times[0] + pd.to_timedelta(hours, unit='h')
+
+
+def evaluate_alerts(device, chIDs, readAPIkeys, now=None):
+    """Checks every alert of a device against the latest data and sends the ones whose lead time has come, returns
+    the list of payloads sent
+
+    Arguments:
+
+    device -- int device number (0-2)
+
+    chIDs --  list of channel IDs from main file
+
+    readAPIkeys -- list of API keys from main file
+
+    now -- pandas Timestamp to check at (default None for the current time)
+    """
+    alerts = list_alerts(device + 1)
+    if len(alerts) == 0:
+        return []
+
+    dataframe, version = get_device_data('od', device, chIDs, readAPIkeys)
+    # the alerts use the same smoothing, temperature correction and exponential phase fit as the table did when they
+    # were made, alerts stored before they had a processing get the raw data
+    groups = {}
+    for i, alert in enumerate(alerts):
+        groups.setdefault((alert.get('smoothing', 'none'), tuple(alert.get('blank_tubes', []))), []).append(i)
+    temp_df = None
+    if any(blank_tubes for smoothing, blank_tubes in groups):
+        temp_df = get_device_data('temp', device, chIDs, readAPIkeys)[0]
+    etas = [pd.NaT] * len(alerts)
+    for (smoothing, blank_tubes), picked in groups.items():
+        processed = process_od_data(device, dataframe, temp_df, smoothing, [blank - 1 for blank in blank_tubes])[0]
+        for i, eta in zip(picked, alert_etas(cull_data(processed), [alerts[i] for i in picked])):
+            etas[i] = eta
+    if now is None:
+        now = pd.Timestamp.now(tz=dataframe.index.tz)
+
+    sent = []
+    for alert, eta in zip(alerts, etas):
+        if pd.isna(eta):
+            continue
+        minutes_left = (eta - now) / pd.Timedelta(1, 'min')
+        # only the shortest lead time that has come is sent, the longer ones are marked so they are not sent late
+        due = [lead for lead in alert['lead_minutes'] if minutes_left <= lead]
+        if len(due) == 0:
+            continue
+        first_time = [mark_fired(alert['id'], lead) for lead in due]
+        if not first_time[-1]:
+            continue
+
+        if minutes_left <= 0:
+            message = f"IODR #{device + 1} {alert['name']} reached OD {alert['target']} at {eta:%Y-%m-%d %H:%M}"
+        else:
+            message = f"IODR #{device + 1} {alert['name']} reaches OD {alert['target']} in {minutes_left:.0f} min " \
+                      f"({eta:%Y-%m-%d %H:%M})"
+        payload = {'alert': alert['id'], 'device': device + 1, 'tube': alert['tube'], 'name': alert['name'],
+                   'target': alert['target'], 'eta': eta.isoformat(), 'minutes_left': round(minutes_left, 1),
+                   'lead_minutes': due[-1], 'message': message}
+        try:
+            # alerts stored before the allowlists were set, or since taken off them, are checked again
+            alert['sink'] = check_sink(alert['sink'])
+            alert_sinks[alert['sink']['type']](alert, message, payload)
+            sent.append(payload)
+            print(f"alert sent: {message}")
+        except Exception as error:
+            print(f"alert {alert['id']} could not be sent ({error})")
+    return sent
+
+
+def check_alerts(device, chIDs, readAPIkeys, reschedule=True):
+    """rq job that evaluates the device's alerts and schedules the next check, so alerts go out without anyone having
+    the app open. Returns the payloads sent.
+
+    The next check is scheduled even when this one fails (Thingspeak not answering, a sink raising), so one bad check
+    does not end the chain.
+
+    Arguments:
+
+    device -- int device number (0-2)
+
+    chIDs --  list of channel IDs from main file
+
+    readAPIkeys -- list of API keys from main file
+
+    reschedule -- whether to schedule the next check in check_minutes (default True)
+    """
+    try:
+        return evaluate_alerts(device, chIDs, readAPIkeys)
+    finally:
+        if reschedule and len(list_alerts(device + 1)) != 0:
+            # only one chain of checks per device, the key runs out just before the next check so that check can renew
+            # it, and a check after a download can start a chain that stopped
+            if conn.set(f"iodr:alerts:next-check:{device}", 1, nx=True, ex=max(check_minutes * 60 - 10, 1)):
+                Queue('low', connection=conn).enqueue_in(timedelta(minutes=check_minutes), check_alerts, device,
+                                                         chIDs, readAPIkeys)
+
+
+def enqueue_alert_check(device, chIDs, readAPIkeys):
+    """Queues an alert check of the device on the 'low' rq queue after new data was downloaded, which also restarts the
+    device's chain of checks if it stopped, or checks in this process if redis is not reachable
+
+    Arguments:
+
+    device -- int device number (0-2)
+
+    chIDs --  list of channel IDs from main file
+
+    readAPIkeys -- list of API keys from main file
+    """
+    try:
+        Queue('low', connection=conn).enqueue(check_alerts, device, chIDs, readAPIkeys, job_timeout=120)
+    except redis.exceptions.ConnectionError:
+        if len(memory_alerts) != 0:
+            evaluate_alerts(device, chIDs, readAPIkeys)
+
+
+def alerts_response(chIDs, readAPIkeys):
+    """Returns the response of the alerts API: GET lists the alerts (?device=1-3 for one device) with their sink
+    targets redacted unless the request has the admin token, POST stores the alert in the json body and starts the
+    worker checking its device (only with the admin token, see api_funs)
+
+    Arguments:
+
+    chIDs --  list of channel IDs from main file
+
+    readAPIkeys -- list of API keys from main file
+    """
+    if request.method == 'POST':
+        if not is_admin_request():
+            return {'error': "adding alerts needs the IODR_ADMIN_TOKEN"}, 403
+        try:
+            alert = save_alert(request.get_json(force=True))
+        except (KeyError, TypeError, ValueError) as error:
+            return {'error': f"bad alert: {error}"}, 400
+        try:
+            # the first check schedules the next ones
+            Queue('low', connection=conn).enqueue(check_alerts, alert['device'] - 1, chIDs, readAPIkeys,
+                                                  job_timeout=120)
+        except redis.exceptions.ConnectionError:
+            print("redis is not reachable, alerts are only checked when data is downloaded")
+        return alert, 201
+
+    device = request.args.get('device', type=int)
+    alerts = list_alerts(device)
+    if not is_admin_request():
+        alerts = [dict(alert, sink=redact_sink(alert['sink'])) for alert in alerts]
+    return {'alerts': alerts}
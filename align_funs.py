@@ -0,0 +1,56 @@
+import pandas as pd
+
+from cache_funs import LRUCache, get_data_version
+
+# most readings of the temperature channel are within a couple of minutes of an OD reading, readings further away than
+# this are left out rather than matched to the wrong time
+default_tolerance = '5min'
+
+# temperature data aligned to the OD times, keyed by (device, OD data version, temperature data version, tolerance)
+aligned_cache = LRUCache(max_items=12)
+
+
+def align_to_times(times, dataframe, tolerance=default_tolerance, direction='nearest'):
+    """Returns a dataframe with the columns of dataframe at each of the times, taken from the nearest row within the
+    tolerance (nan where there is none), with one merge_asof for all columns
+
+    Arguments:
+
+    times -- sorted DatetimeIndex to align to, like the OD data index
+
+    dataframe -- pandas dataframe with a datetime index in the same timezone, like the temperature data
+
+    tolerance -- largest time between a time and the row matched to it, anything pd.Timedelta understands (default
+    default_tolerance)
+
+    direction -- 'nearest', 'backward' (last row at or before the time) or 'forward' (default 'nearest')
+    """
+    # both sides need the same time unit for merge_asof
+    left = pd.DataFrame({'time': pd.DatetimeIndex(times).as_unit('ns')})
+    right = dataframe.sort_index()
+    right = right.set_axis(pd.DatetimeIndex(right.index).as_unit('ns').rename('time'), axis=0).reset_index()
+    aligned = pd.merge_asof(left, right, on='time', tolerance=pd.Timedelta(tolerance), direction=direction)
+    return aligned.set_index('time')
+
+
+def get_aligned_temperature(device, data_version, times, temp_df, tolerance=default_tolerance):
+    """Returns the temperature data aligned to the OD times by align_to_times, only joining them once for each data
+    version of the OD and temperature data
+
+    Arguments:
+
+    device -- int device number (0-2)
+
+    data_version -- data version of the OD data the times come from
+
+    times -- DatetimeIndex of the OD data
+
+    temp_df -- pandas dataframe of the device's temperature data
+
+    tolerance -- largest time between an OD reading and the temperature matched to it (default default_tolerance)
+    """
+    key = (device, data_version, get_data_version(temp_df), str(tolerance))
+    aligned = aligned_cache.get(key)
+    if aligned is None:
+        aligned = aligned_cache.put(key, align_to_times(times, temp_df, tolerance))
+    return aligned
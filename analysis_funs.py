@@ -0,0 +1,318 @@
+import numpy as np
+import pandas as pd
+
+from cache_funs import LRUCache
+from fault_funs import fault_masks
+
+# names of the running sums kept for every tube, used to fit any window of data in constant time
+sum_names = ['n', 't', 'y', 'tt', 'ty', 'yy']
+
+# names of the values kept for the fit of every tube, see regression_from_sums and growth_phase_fit
+fit_names = ['slope', 'intercept', 'r', 'n', 'sxx', 't_mean', 'se', 'start', 'end']
+
+
+class AnalysisBundle:
+    """All of the per-device analysis data shared by the table, main graph and prediction graph callbacks
+
+    times -- DatetimeIndex of the data, hour 0 is times[0]
+
+    hours -- numpy array of the time of each row in hours since times[0]
+
+    od -- 2-D numpy array (time x tube) of OD data with the offsets added
+
+    ln_od -- 2-D numpy array of the natural log of od
+
+    valid -- 2-D boolean numpy array, True where ln_od is a finite number and the reading is not a fault
+
+    faults -- 2-D boolean numpy array, True where fault_masks flagged the reading as a sensor fault
+
+    sums -- dict of 2-D numpy arrays with the prefix sums of sum_names over valid points, one row longer than the data
+
+    fits -- dict of numpy arrays of fit_names with the fit of each tube over its exponential phase window (see
+    regression_from_sums), and 'start' and 'end' with that window in hours before the tube's last point
+
+    offsets -- tuple of the offset added to each tube
+    """
+
+    def __init__(self, times, hours, od, ln_od, valid, faults, sums, fits, offsets):
+        self.times = times
+        self.hours = hours
+        self.od = od
+        self.ln_od = ln_od
+        self.valid = valid
+        self.faults = faults
+        self.sums = sums
+        self.fits = fits
+        self.offsets = offsets
+
+    def curve_info(self, tube_num):
+        """Returns the fit of one tube as a list of slope, intercept and r value like predict_curve, or an empty
+        list if the tube did not have enough data to fit"""
+        if self.fits['n'][tube_num] <= 2:
+            return []
+        return [self.fits['slope'][tube_num], self.fits['intercept'][tube_num], self.fits['r'][tube_num]]
+
+    def tube_dataframe(self, tube_num, offset_value=0):
+        """Returns a pandas dataframe with columns OD and lnOD for one tube like format_ln_data, and fault with
+        whether the reading was flagged as a sensor fault
+
+        Arguments:
+
+        tube_num -- number (int) of which tube to get data on
+
+        offset_value -- number added to the OD data on top of the bundle's offset (default 0)
+        """
+        od = self.od[:, tube_num] + offset_value
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ln_od = np.log(od)
+        keep = np.isfinite(od)
+        return pd.DataFrame({'OD': od[keep], 'lnOD': ln_od[keep], 'fault': self.faults[keep, tube_num]},
+                            index=self.times[keep])
+
+    def window_points(self, tube_num):
+        """Returns a tuple of numpy arrays of the hours and ln OD of the valid points in the tube's fit window"""
+        valid = self.valid[:, tube_num]
+        if not valid.any():
+            return np.array([]), np.array([])
+        last_hour = self.hours[valid][-1]
+        in_window = valid & (self.hours > last_hour + self.fits['start'][tube_num]) & \
+            (self.hours < last_hour + self.fits['end'][tube_num])
+        return self.hours[in_window], self.ln_od[in_window, tube_num]
+
+
+def prefix_sums(hours, ln_od, valid):
+    """Returns a dict of the prefix sums of sum_names for every tube, with a row of zeros on top
+
+    Arguments:
+
+    hours -- numpy array of the time of each row in hours
+
+    ln_od -- 2-D numpy array (time x tube) of ln OD data
+
+    valid -- 2-D boolean numpy array of which points to include in the sums
+    """
+    t = np.where(valid, hours[:, None], 0.0)
+    y = np.where(valid, ln_od, 0.0)
+    terms = {'n': valid.astype(float), 't': t, 'y': y, 'tt': t * t, 'ty': t * y, 'yy': y * y}
+    sums = {}
+    for name in sum_names:
+        sums[name] = np.zeros((len(hours) + 1, ln_od.shape[1]))
+        np.cumsum(terms[name], axis=0, out=sums[name][1:])
+    return sums
+
+
+def regression_from_sums(n, t, y, tt, ty, yy):
+    """Returns a dict of numpy arrays 'slope', 'intercept', 'r' and 'n' of the least squares line from window sums,
+    with 'sxx' (sum of squared deviations of t), 't_mean' and 'se' (standard error of the residuals) for the
+    prediction intervals
+
+    Every argument is a numpy array of the sums over a window (like the difference of two rows of prefix_sums).
+    Windows with two points or fewer get nan for everything but n.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sxx = tt - t * t / n
+        sxy = ty - t * y / n
+        syy = yy - y * y / n
+        slope = sxy / sxx
+        intercept = (y - slope * t) / n
+        r = sxy / np.sqrt(sxx * syy)
+        se = np.sqrt(np.maximum(syy - slope * sxy, 0) / (n - 2))
+        t_mean = t / n
+    enough = n > 2
+    return {
+        'slope': np.where(enough, slope, np.nan),
+        'intercept': np.where(enough, intercept, np.nan),
+        'r': np.where(enough, r, np.nan),
+        'n': n,
+        'sxx': np.where(enough, sxx, np.nan),
+        't_mean': np.where(enough, t_mean, np.nan),
+        'se': np.where(enough, se, np.nan)
+    }
+
+
+def window_fit(bundle, data_range, tubes=None):
+    """Returns the regression of ln OD against hours for the given window of each tube, like predict_curve
+
+    The window is relative to each tube's last valid point and, like predict_curve, leaves out its end points.
+
+    Arguments:
+
+    bundle -- AnalysisBundle with the data
+
+    data_range -- list of two values for the range of data to use, in hours before the last data point
+
+    tubes -- list of tube numbers to fit (default None for all tubes)
+    """
+    if tubes is None:
+        tubes = list(range(bundle.od.shape[1]))
+    tubes = np.asarray(tubes, dtype=int)
+    # index of the last valid point of each tube
+    last_index = len(bundle.hours) - 1 - np.argmax(bundle.valid[::-1, tubes], axis=0)
+    last_hours = np.where(bundle.valid[:, tubes].any(axis=0), bundle.hours[last_index], np.nan)
+
+    start = np.searchsorted(bundle.hours, last_hours + data_range[0], side='right')
+    end = np.searchsorted(bundle.hours, last_hours + data_range[1], side='left')
+    end = np.maximum(end, start)
+    window_sums = [bundle.sums[name][end, tubes] - bundle.sums[name][start, tubes] for name in sum_names]
+    return regression_from_sums(*window_sums)
+
+
+def growth_phase_fit(bundle, tubes=None, durations=(1, 1.5, 2, 3, 4), step=0.25, lookback=24, min_points=5,
+                     min_r_squared=0.95):
+    """Returns the regression of each tube over its window of fastest exponential growth, as a dict of numpy arrays
+    like window_fit plus 'start' and 'end' with the window in hours before the tube's
+    last point (nan for tubes where no window passed the limits)
+
+    Every window starting on a grid of step hours over the last lookback hours is tried with every duration, all tubes
+    at once from the prefix sums, so the cost is the number of windows times the number of tubes. The window with the
+    highest slope among those with enough points and a high enough r^2 wins. Windows are on the grid of the
+    data-selection-slider so the prediction graph can show the same fit.
+
+    Arguments:
+
+    bundle -- AnalysisBundle with the data
+
+    tubes -- list of tube numbers to fit (default None for all tubes)
+
+    durations -- lengths of window to try in hours (default 1 to 4 hours)
+
+    step -- hours between the window starts that are tried (default 0.25, the step of the slider)
+
+    lookback -- hours before the last point to look for the window in (default 24, the range of the slider)
+
+    min_points -- int fewest valid points a window needs (default 5)
+
+    min_r_squared -- lowest r^2 a window's fit may have (default 0.95)
+    """
+    if tubes is None:
+        tubes = list(range(bundle.od.shape[1]))
+    tubes = np.asarray(tubes, dtype=int)
+    last_index = len(bundle.hours) - 1 - np.argmax(bundle.valid[::-1, tubes], axis=0)
+    last_hours = np.where(bundle.valid[:, tubes].any(axis=0), bundle.hours[last_index], np.nan)
+
+    # every (start, duration) window that ends by the last point, in hours before the last point
+    starts = -np.arange(0, lookback + step / 2, step)
+    window_start, window_duration = np.meshgrid(starts, np.asarray(durations, dtype=float), indexing='ij')
+    window_end = window_start + window_duration
+    keep = window_end <= 0
+    window_start = window_start[keep]
+    window_end = window_end[keep]
+
+    # (window x tube) indices into the prefix sums, leaving out the end points like window_fit
+    start = np.searchsorted(bundle.hours, (last_hours + window_start[:, None]).ravel(), side='right')
+    end = np.searchsorted(bundle.hours, (last_hours + window_end[:, None]).ravel(), side='left')
+    start = start.reshape(len(window_start), len(tubes))
+    end = np.maximum(end.reshape(len(window_start), len(tubes)), start)
+    window_sums = [bundle.sums[name][end, tubes] - bundle.sums[name][start, tubes] for name in sum_names]
+    fits = regression_from_sums(*window_sums)
+
+    with np.errstate(invalid='ignore'):
+        passes = (fits['n'] >= min_points) & (fits['r'] ** 2 >= min_r_squared) & np.isfinite(fits['slope'])
+    ranked_slope = np.where(passes, fits['slope'], -np.inf)
+    best = np.argmax(ranked_slope, axis=0)
+    found = passes[best, np.arange(len(tubes))]
+
+    result = {name: np.where(found, fits[name][best, np.arange(len(tubes))], np.nan) for name in fits}
+    result['n'] = np.where(found, result['n'], 0)
+    result['start'] = np.where(found, window_start[best], np.nan)
+    result['end'] = np.where(found, window_end[best], np.nan)
+    return result
+
+
+def build_analysis_bundle(dataframe, offsets, base=None):
+    """Returns an AnalysisBundle for the OD data with the offsets added
+
+    Arguments:
+
+    dataframe -- pandas dataframe of the OD data for all tubes (no offsets added), like od_df_original_culled
+
+    offsets -- list of the offset to add to each tube
+
+    base -- AnalysisBundle of the same data with other offsets, tubes with the same offset are copied from it instead
+    of being computed again (default None)
+    """
+    offsets = tuple(float(offset) for offset in offsets)
+    times = dataframe.index
+    hours = np.asarray((times - times[0]) / pd.Timedelta(1, 'h'), dtype=float)
+
+    num_tubes = dataframe.shape[1]
+    if base is None:
+        # nothing to copy, every tube gets computed
+        dirty = list(range(num_tubes))
+        od = np.empty((len(times), num_tubes))
+        ln_od = np.empty((len(times), num_tubes))
+        valid = np.zeros((len(times), num_tubes), dtype=bool)
+        # the offsets do not change which readings are faults, so they are only found when there is no base bundle
+        faults = fault_masks(dataframe.to_numpy(dtype=float), hours=hours)['any']
+        sums = {name: np.zeros((len(times) + 1, num_tubes)) for name in sum_names}
+        fits = {name: np.full(num_tubes, np.nan) for name in fit_names}
+    else:
+        # only the tubes whose offset differs from the base bundle get computed
+        dirty = [i for i in range(num_tubes) if offsets[i] != base.offsets[i]]
+        od = base.od.copy()
+        ln_od = base.ln_od.copy()
+        valid = base.valid.copy()
+        faults = base.faults
+        sums = {name: base.sums[name].copy() for name in sum_names}
+        fits = {name: base.fits[name].copy() for name in base.fits}
+
+    bundle = AnalysisBundle(times, hours, od, ln_od, valid, faults, sums, fits, offsets)
+    if len(dirty) == 0:
+        return bundle
+
+    od[:, dirty] = dataframe.iloc[:, dirty].to_numpy(dtype=float) + np.asarray(offsets)[dirty]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ln_od[:, dirty] = np.log(od[:, dirty])
+    valid[:, dirty] = np.isfinite(ln_od[:, dirty]) & ~faults[:, dirty]
+    dirty_sums = prefix_sums(hours, ln_od[:, dirty], valid[:, dirty])
+    for name in sum_names:
+        sums[name][:, dirty] = dirty_sums[name]
+
+    # fit of the exponential phase, tubes without one get the last two hours like estimate_times
+    dirty_fits = growth_phase_fit(bundle, dirty)
+    last_fits = window_fit(bundle, [-2, 0], dirty)
+    missing = np.isnan(dirty_fits['start'])
+    for name in last_fits:
+        dirty_fits[name] = np.where(missing, last_fits[name], dirty_fits[name])
+    dirty_fits['start'] = np.where(missing, -2.0, dirty_fits['start'])
+    dirty_fits['end'] = np.where(missing, 0.0, dirty_fits['end'])
+    for name in fits:
+        fits[name][dirty] = dirty_fits[name]
+    return bundle
+
+
+# analysis bundles keyed by (device, data version, offsets)
+bundle_cache = LRUCache(max_items=12)
+
+
+def get_analysis_bundle(device, data_version, offsets, load_dataframe):
+    """Returns the cached AnalysisBundle for the device's data with the given offsets, building it if needed
+
+    When a bundle of the same data with other offsets is cached, only the tubes with a different offset are computed.
+
+    Arguments:
+
+    device -- int device number (0-2)
+
+    data_version -- data version of the OD data from get_data_version
+
+    offsets -- list of the offset to add to each tube
+
+    load_dataframe -- function with no arguments that returns the OD dataframe, only called when the bundle is not
+    cached so the stores are not parsed on every callback
+    """
+    offsets = tuple(float(offset) for offset in offsets)
+    key = (device, data_version, offsets)
+    bundle = bundle_cache.get(key)
+    if bundle is not None:
+        return bundle
+
+    # look for a bundle of the same data to copy the unchanged tubes from
+    base = None
+    for (cached_device, cached_version, cached_offsets), cached_bundle in reversed(bundle_cache.items.items()):
+        if cached_device == device and cached_version == data_version:
+            base = cached_bundle
+            break
+
+    bundle = build_analysis_bundle(load_dataframe(), offsets, base=base)
+    return bundle_cache.put(key, bundle)
@@ -0,0 +1,345 @@
+import hashlib
+import hmac
+import io
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from flask import Response, request
+
+from cache_funs import get_cached_device_data, device_data_cache, get_data_version
+from get_data_funs import cull_data
+from analysis_funs import get_analysis_bundle
+from smooth_funs import smoothing_methods
+from correction_funs import process_od_data
+from predict_funs import what_if_grid, hours_to_time_str
+
+# arrow output is optional, it needs the pyarrow package
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# content types for each of the formats the data API can return
+api_formats = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+    'arrow': 'application/vnd.apache.arrow.stream'
+}
+
+# number of rows written per chunk of a streamed response
+chunk_rows = 500
+
+# token a request needs (as 'Authorization: Bearer <token>') to change or remove stored data, like deleting an
+# archived experiment. Nothing can be removed through the API while it is not set
+admin_token = os.getenv('IODR_ADMIN_TOKEN', '')
+
+# seconds a client is asked to wait before asking again for data that is not cached yet
+retry_after = 30
+
+# format of the times in csv and json lines output, local time of the data with its UTC offset
+time_format = '%Y-%m-%dT%H:%M:%S%z'
+
+
+def parse_time(value, tz):
+    """Returns a pandas Timestamp in the timezone of the data from a query string value, or None if value is empty
+
+    Arguments:
+
+    value -- time string from the query, anything pd.Timestamp understands (e.g. 2022-05-01T12:00)
+
+    tz -- timezone of the dataframe index, used when the time string does not have one
+    """
+    if value is None or value == '':
+        return None
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize(tz)
+    return timestamp.tz_convert(tz)
+
+
+def select_columns(dataframe, tubes):
+    """Returns the dataframe with only the requested columns
+
+    Arguments:
+
+    dataframe -- pandas dataframe from the device data cache
+
+    tubes -- comma separated string of tube numbers (1 to the number of columns) or column names, empty string for all
+    columns
+    """
+    if tubes is None or tubes == '':
+        return dataframe
+    columns = []
+    for tube in tubes.split(','):
+        tube = tube.strip()
+        if tube.isdigit():
+            if not 1 <= int(tube) <= len(dataframe.columns):
+                raise ValueError(f"tube {tube} must be 1-{len(dataframe.columns)}")
+            columns.append(dataframe.columns[int(tube) - 1])
+        elif tube in dataframe.columns:
+            columns.append(tube)
+        else:
+            raise ValueError(f"unknown tube {tube}")
+    return dataframe.loc[:, columns]
+
+
+def query_dataframe(dataframe, start=None, end=None, tubes=None, resolution=None):
+    """Returns the part of the dataframe between start and end for the selected tubes, optionally resampled
+
+    Arguments:
+
+    dataframe -- pandas dataframe with a datetime index
+
+    start -- time string for the first time point to include (default None for the start of the data)
+
+    end -- time string for the last time point to include (default None for the end of the data)
+
+    tubes -- comma separated string of tube numbers or column names (default None for all columns)
+
+    resolution -- pandas offset string (e.g. '10min') to resample the data to by averaging (default None)
+    """
+    start_time = parse_time(start, dataframe.index.tz)
+    end_time = parse_time(end, dataframe.index.tz)
+    df = select_columns(dataframe, tubes)
+    if start_time is not None:
+        df = df.loc[df.index >= start_time]
+    if end_time is not None:
+        df = df.loc[df.index <= end_time]
+    if resolution:
+        df = df.resample(resolution).mean().dropna(how='all')
+    return df
+
+
+def is_admin_request():
+    """Returns True if the request carries the admin token in its Authorization header"""
+    if admin_token == '':
+        return False
+    header = request.headers.get('Authorization', '')
+    return header.startswith('Bearer ') and hmac.compare_digest(header[len('Bearer '):], admin_token)
+
+
+def choose_format(format_arg, accept_header):
+    """Returns the name of the output format from the format query value or the Accept header (default csv)
+
+    Arguments:
+
+    format_arg -- value of the format query parameter, or None
+
+    accept_header -- value of the request's Accept header
+    """
+    if format_arg:
+        return format_arg if format_arg in api_formats else None
+    for name, content_type in api_formats.items():
+        if content_type in (accept_header or ''):
+            return name
+    return 'csv'
+
+
+def make_etag(kind, device, version, args):
+    """Returns an ETag that only changes when the cached data or the query changes
+
+    Arguments:
+
+    kind -- 'od' or 'temp'
+
+    device -- int device number (0-2), or anything else identifying where the data comes from
+
+    version -- data version of the cached dataframe from cache_funs
+
+    args -- dict of the query parameters
+    """
+    key = json.dumps([kind, device, version, sorted(args.items())])
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def stream_csv(dataframe):
+    """Yields the dataframe as csv text in chunks of chunk_rows rows"""
+    yield dataframe.iloc[:0].to_csv(date_format=time_format)
+    for i in range(0, len(dataframe), chunk_rows):
+        yield dataframe.iloc[i:i + chunk_rows].to_csv(header=False, date_format=time_format)
+
+
+def stream_jsonl(dataframe):
+    """Yields the dataframe as one json object per line in chunks of chunk_rows rows, with the times written like the
+    csv output"""
+    df = dataframe.reset_index()
+    for i in range(0, len(df), chunk_rows):
+        chunk = df.iloc[i:i + chunk_rows]
+        # to_json would write the times in UTC, so they are written as strings in the data's own time zone
+        chunk = chunk.assign(**{df.columns[0]: dataframe.index[i:i + chunk_rows].strftime(time_format)})
+        chunk = chunk.to_json(orient='records', lines=True)
+        yield chunk if chunk.endswith('\n') else chunk + '\n'
+
+
+def stream_arrow(dataframe):
+    """Yields the dataframe as an arrow IPC stream, one record batch per chunk_rows rows"""
+    df = dataframe.reset_index()
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    sink = io.BytesIO()
+    writer = pa.ipc.new_stream(sink, schema)
+    for i in range(0, max(len(df), 1), chunk_rows):
+        writer.write_batch(pa.RecordBatch.from_pandas(df.iloc[i:i + chunk_rows], schema=schema, preserve_index=False))
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+    writer.close()
+    yield sink.getvalue()
+
+
+def data_response(kind, device):
+    """Returns a flask Response with the cached OD or temperature data for the device, filtered by the query string
+
+    Query parameters: start, end, tubes, resolution and format (csv, jsonl or arrow). Responses carry an ETag built
+    from the data version and the query, so a request with a matching If-None-Match header gets a 304. The data is
+    never downloaded here: the last download of the app is served however old it is (its X-Data-Fetched header has
+    the time it was downloaded), and a device nothing was downloaded for yet gets a 503.
+
+    Arguments:
+
+    kind -- 'od' or 'temp'
+
+    device -- int device number (0-2)
+    """
+    dataframe, version = get_cached_device_data(kind, device)
+    if dataframe is None:
+        response = Response(f"no {kind} data of IODR #{device + 1} is cached yet, open the device in the app\n",
+                            status=503, mimetype='text/plain')
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+    response = dataframe_response(dataframe, version, kind, device)
+    fetched = pd.Timestamp(device_data_cache[(kind, device)]['fetched'], unit='s', tz='UTC')
+    response.headers['X-Data-Fetched'] = fetched.tz_convert(dataframe.index.tz).strftime(time_format)
+    return response
+
+
+def dataframe_response(dataframe, version, kind, source):
+    """Returns a flask Response with the dataframe filtered by the query string, see data_response
+
+    Arguments:
+
+    dataframe -- pandas dataframe with a datetime index
+
+    version -- string that changes whenever the dataframe changes, for the ETag
+
+    kind -- 'od' or 'temp'
+
+    source -- anything identifying where the dataframe comes from (e.g. the device number), for the ETag
+    """
+    args = request.args.to_dict()
+    output_format = choose_format(args.pop('format', None), request.headers.get('Accept'))
+    if output_format is None:
+        return Response(f"format must be one of {', '.join(api_formats)}\n", status=400, mimetype='text/plain')
+    if output_format == 'arrow' and pa is None:
+        return Response("arrow output needs the pyarrow package\n", status=406, mimetype='text/plain')
+
+    etag = make_etag(kind, source, version, dict(args, format=output_format))
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    try:
+        df = query_dataframe(dataframe, args.get('start'), args.get('end'), args.get('tubes'), args.get('resolution'))
+    except (ValueError, IndexError) as error:
+        return Response(f"{error}\n", status=400, mimetype='text/plain')
+    df = df.replace([np.inf, -np.inf], np.nan)
+
+    if output_format == 'csv':
+        body = stream_csv(df)
+    elif output_format == 'jsonl':
+        body = stream_jsonl(df)
+    else:
+        body = stream_arrow(df)
+
+    response = Response(body, mimetype=api_formats[output_format])
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Data-Version'] = version
+    return response
+
+
+def parse_numbers(value, name, number_type=float):
+    """Returns a list of numbers from a comma separated query string value
+
+    Arguments:
+
+    value -- comma separated string of numbers, e.g. '0.3,0.5,1'
+
+    name -- name of the query parameter, for the error message
+
+    number_type -- float, or int to only accept whole numbers (default float)
+    """
+    try:
+        numbers = [number_type(number) for number in value.split(',') if number.strip() != '']
+    except ValueError:
+        kind = "whole numbers" if number_type is int else "numbers"
+        raise ValueError(f"{name} must be a comma separated list of {kind}")
+    if len(numbers) == 0:
+        raise ValueError(f"{name} needs at least one number")
+    return numbers
+
+
+def what_if_response(device, max_cells=10000):
+    """Returns the response of the what-if API: the estimated time each tube reaches each target with each offset,
+    from one what_if_grid over the device's cached data processed like the app's table
+
+    Query parameters: targets and offsets (comma separated numbers, offsets default 0), tubes (comma separated tube
+    numbers 1-8, default all), smoothing (one of smoothing_methods, default none), blanks (comma separated blank tube
+    numbers 1-8 for the temperature correction, default none) and table_offsets (the 8 offsets of the table, which
+    pick each tube's exponential phase window, default 0). With the same settings as the app the grid matches the
+    app's what-if heatmap. Each tube gets 'hours' (offset x target hours from now, null where the tube is not growing)
+    and 'eta' (the same as time strings). Like the data API this only uses the cached data, a device nothing was
+    downloaded for yet gets a 503.
+
+    Arguments:
+
+    device -- int device number (0-2)
+
+    max_cells -- largest number of tube, offset and target combinations of one request (default 10000)
+    """
+    try:
+        targets = parse_numbers(request.args.get('targets', ''), 'targets')
+        offsets = parse_numbers(request.args.get('offsets', '0'), 'offsets')
+        tubes = [tube - 1 for tube in parse_numbers(request.args.get('tubes', '1,2,3,4,5,6,7,8'), 'tubes', int)]
+        blank_tubes = [tube - 1 for tube in parse_numbers(request.args['blanks'], 'blanks', int)] \
+            if request.args.get('blanks') else []
+        table_offsets = parse_numbers(request.args['table_offsets'], 'table_offsets') \
+            if request.args.get('table_offsets') else [0.0] * 8
+    except ValueError as error:
+        return {'error': str(error)}, 400
+    if not all(0 <= tube < 8 for tube in tubes + blank_tubes):
+        return {'error': "tubes and blanks must be 1-8"}, 400
+    if len(table_offsets) != 8:
+        return {'error': "table_offsets needs the offset of each of the 8 tubes"}, 400
+    smoothing = request.args.get('smoothing') or 'none'
+    if smoothing not in smoothing_methods:
+        return {'error': f"smoothing must be one of {', '.join(smoothing_methods)}"}, 400
+    if len(tubes) * len(offsets) * len(targets) > max_cells:
+        return {'error': f"at most {max_cells} combinations of tubes, offsets and targets"}, 400
+
+    dataframe = get_cached_device_data('od', device)[0]
+    temp_df = get_cached_device_data('temp', device)[0] if blank_tubes else None
+    if dataframe is None or (blank_tubes and temp_df is None):
+        return {'error': f"no data of IODR #{device + 1} is cached yet, open the device in the app"}, 503, \
+            {'Retry-After': str(retry_after)}
+
+    # the same smoothing, temperature correction, culling and fits as the table, and the same data version, so the
+    # bundle is shared with the app
+    processed, processing = process_od_data(device, dataframe, temp_df, smoothing, blank_tubes)
+    culled = cull_data(processed)
+    version = get_data_version(culled, processing)
+    bundle = get_analysis_bundle(device, version, table_offsets, lambda: culled)
+    grid = what_if_grid(bundle, targets, offsets, tubes)
+    hours_left = grid - bundle.hours[-1]
+
+    results = []
+    for i, tube in enumerate(tubes):
+        results.append({
+            'tube': tube + 1,
+            'name': dataframe.columns[tube],
+            'hours': [[None if np.isnan(hours) else round(float(hours), 3) for hours in row] for row in hours_left[i]],
+            'eta': [[hours_to_time_str(bundle.times[0], hours) for hours in row] for row in grid[i]]
+        })
+    return {'device': device + 1, 'version': version, 'targets': targets, 'offsets': offsets, 'tubes': results}
@@ -0,0 +1,231 @@
+import json
+import os
+import sqlite3
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from cache_funs import LRUCache
+
+# sqlite file of the experiment archive
+archive_path = os.getenv('IODR_ARCHIVE_PATH', 'iodr_archive.sqlite')
+
+# archived data read back from the archive, keyed by (path, experiment id, kind, tubes). Archived runs never change,
+# so nothing here goes out of date
+archive_data_cache = LRUCache(max_items=16)
+
+archive_schema = """
+CREATE TABLE IF NOT EXISTS experiments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    device INTEGER NOT NULL,
+    saved_at TEXT NOT NULL,
+    start_time TEXT,
+    end_time TEXT,
+    num_rows INTEGER,
+    timezone TEXT,
+    processing TEXT,
+    tubes TEXT,
+    table_json TEXT,
+    fits_json TEXT
+);
+CREATE INDEX IF NOT EXISTS experiments_device ON experiments (device, saved_at);
+CREATE TABLE IF NOT EXISTS columns (
+    experiment_id INTEGER NOT NULL REFERENCES experiments (id) ON DELETE CASCADE,
+    kind TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT,
+    dtype TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (experiment_id, kind, position)
+);
+"""
+
+# position of the time column of each kind of data, the tubes are 0-7
+time_position = -1
+
+# columns of the experiment listing
+listing_names = ['id', 'name', 'device', 'saved_at', 'start_time', 'end_time', 'num_rows', 'processing', 'tubes']
+
+
+def connect_archive(path=None):
+    """Returns a sqlite3 connection to the archive, creating the tables the first time
+
+    Arguments:
+
+    path -- path of the sqlite file (default None for archive_path)
+    """
+    connection = sqlite3.connect(path or archive_path)
+    connection.execute("PRAGMA foreign_keys = ON")
+    connection.executescript(archive_schema)
+    return connection
+
+
+def pack_column(values):
+    """Returns a tuple of the dtype name and the zlib compressed bytes of a numpy array"""
+    values = np.ascontiguousarray(values)
+    return values.dtype.str, zlib.compress(values.tobytes(), 6)
+
+
+def unpack_column(dtype, data):
+    """Returns the numpy array packed by pack_column"""
+    return np.frombuffer(zlib.decompress(data), dtype=np.dtype(dtype))
+
+
+def column_rows(experiment_id, kind, dataframe):
+    """Returns a list of the rows of the columns table for a dataframe, one for the times and one for each column
+
+    Arguments:
+
+    experiment_id -- int id of the experiment
+
+    kind -- 'od' or 'temp'
+
+    dataframe -- pandas dataframe with a datetime index
+    """
+    times = pd.DatetimeIndex(dataframe.index).as_unit('ns').asi8
+    rows = [(experiment_id, kind, time_position, 'time') + pack_column(times)]
+    for position, name in enumerate(dataframe.columns):
+        rows.append((experiment_id, kind, position, str(name)) + pack_column(dataframe[name].to_numpy(dtype=float)))
+    return rows
+
+
+def json_numbers(values):
+    """Returns a list of the numbers in a numpy array with nan as None, for json"""
+    return [None if value != value else float(value) for value in np.asarray(values, dtype=float)]
+
+
+def save_experiment(name, device, od_df, temp_df, table_df, fits=None, processing='none', path=None):
+    """Stores a snapshot of a run in the archive and returns its id
+
+    Arguments:
+
+    name -- name of the experiment
+
+    device -- int device number (0-2)
+
+    od_df -- pandas dataframe of the full OD data of the run, like the one from get_OD_dataframe
+
+    temp_df -- pandas dataframe of the temperature data of the run
+
+    table_df -- pandas dataframe of the stored table with the tube names, targets, offsets and estimates
+
+    fits -- dict of numpy arrays of the exponential phase fit of every tube, like AnalysisBundle.fits (default None)
+
+    processing -- name of the smoothing and correction the table was made with (default 'none')
+
+    path -- path of the sqlite file (default None for archive_path)
+    """
+    fits_json = None if fits is None else json.dumps({key: json_numbers(value) for key, value in fits.items()})
+    with connect_archive(path) as connection:
+        cursor = connection.execute(
+            "INSERT INTO experiments (name, device, saved_at, start_time, end_time, num_rows, timezone, processing, "
+            "tubes, table_json, fits_json) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (name, int(device), pd.Timestamp.now(tz='UTC').isoformat(), od_df.index[0].isoformat(),
+             od_df.index[-1].isoformat(), len(od_df), str(od_df.index.tz), processing,
+             json.dumps([str(column) for column in od_df.columns]), table_df.to_json(date_format='iso', orient='table'),
+             fits_json))
+        experiment_id = cursor.lastrowid
+        connection.executemany("INSERT INTO columns VALUES (?, ?, ?, ?, ?, ?)",
+                               column_rows(experiment_id, 'od', od_df) + column_rows(experiment_id, 'temp', temp_df))
+    connection.close()
+    print(f"saved experiment {experiment_id} '{name}' ({len(od_df)} rows)")
+    return experiment_id
+
+
+def list_experiments(device=None, path=None):
+    """Returns a list of dicts with the listing of every archived experiment (not the data), newest first
+
+    Arguments:
+
+    device -- int device number (0-2) to only list that device's experiments (default None for all)
+
+    path -- path of the sqlite file (default None for archive_path)
+    """
+    query = f"SELECT {', '.join(listing_names)} FROM experiments"
+    args = ()
+    if device is not None:
+        query += " WHERE device = ?"
+        args = (int(device),)
+    connection = connect_archive(path)
+    rows = connection.execute(query + " ORDER BY saved_at DESC", args).fetchall()
+    connection.close()
+    experiments = [dict(zip(listing_names, row)) for row in rows]
+    for experiment in experiments:
+        experiment['tubes'] = json.loads(experiment['tubes'])
+    return experiments
+
+
+def load_experiment_info(experiment_id, path=None):
+    """Returns a dict with the listing of an experiment, its 'table' (pandas dataframe) and 'fits' (dict of numpy
+    arrays, or None), or None if there is no such experiment
+
+    Arguments:
+
+    experiment_id -- int id of the experiment
+
+    path -- path of the sqlite file (default None for archive_path)
+    """
+    connection = connect_archive(path)
+    row = connection.execute(f"SELECT {', '.join(listing_names)}, timezone, table_json, fits_json FROM experiments "
+                             f"WHERE id = ?", (int(experiment_id),)).fetchone()
+    connection.close()
+    if row is None:
+        return None
+    info = dict(zip(listing_names + ['timezone', 'table_json', 'fits_json'], row))
+    info['tubes'] = json.loads(info['tubes'])
+    info['table'] = pd.read_json(info.pop('table_json'), orient='table')
+    fits_json = info.pop('fits_json')
+    info['fits'] = None if fits_json is None else {key: np.array(value, dtype=float)
+                                                   for key, value in json.loads(fits_json).items()}
+    return info
+
+
+def load_experiment_data(experiment_id, kind='od', tubes=None, path=None):
+    """Returns a pandas dataframe of an experiment's archived data, only reading the columns of the selected tubes, or
+    None if there is no such experiment
+
+    Arguments:
+
+    experiment_id -- int id of the experiment
+
+    kind -- 'od' or 'temp' (default 'od')
+
+    tubes -- list of column positions (0-7 for the tubes) to read (default None for all)
+
+    path -- path of the sqlite file (default None for archive_path)
+    """
+    key = (path or archive_path, int(experiment_id), kind, None if tubes is None else tuple(tubes))
+    dataframe = archive_data_cache.get(key)
+    if dataframe is not None:
+        return dataframe
+
+    query = "SELECT position, name, dtype, data FROM columns WHERE experiment_id = ? AND kind = ?"
+    args = [int(experiment_id), kind]
+    if tubes is not None:
+        positions = [time_position] + [int(tube) for tube in tubes]
+        query += f" AND position IN ({', '.join('?' * len(positions))})"
+        args += positions
+    connection = connect_archive(path)
+    rows = connection.execute(query + " ORDER BY position", args).fetchall()
+    timezone = connection.execute("SELECT timezone FROM experiments WHERE id = ?", (int(experiment_id),)).fetchone()
+    connection.close()
+    if timezone is None or len(rows) == 0:
+        return None
+
+    times = pd.to_datetime(unpack_column(rows[0][2], rows[0][3]), utc=True)
+    if timezone[0] not in (None, 'None'):
+        times = times.tz_convert(timezone[0])
+    times = times.rename('time')
+    dataframe = pd.DataFrame({name: unpack_column(dtype, data) for position, name, dtype, data in rows[1:]},
+                             index=times)
+    return archive_data_cache.put(key, dataframe)
+
+
+def delete_experiment(experiment_id, path=None):
+    """Removes an experiment and its data from the archive, returns True if it existed"""
+    with connect_archive(path) as connection:
+        deleted = connection.execute("DELETE FROM experiments WHERE id = ?", (int(experiment_id),)).rowcount
+    connection.close()
+    return deleted != 0
@@ -0,0 +1,243 @@
+// clientside callbacks for the prediction graph, registered in IODR_test7.py
+// the least squares fit of the selected data runs here so the sliders and blank value never go to the server
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    predict: {
+        update_predict_graph: function (predictData, target, selection, blankValue, template) {
+            var figure = JSON.parse(JSON.stringify(template));
+            if (!predictData || predictData.od.length === 0) {
+                return figure;
+            }
+            var blank = parseFloat(blankValue) || 0;
+            var sums = window.dash_clientside.predict.prefix_sums(predictData, blank);
+            var hours = predictData.hours;
+            var n = hours.length;
+
+            // OD and ln OD data with the blank value added, like format_ln_data
+            figure.data[0].x = predictData.x;
+            figure.data[0].y = sums.ln;
+            figure.data[1].x = predictData.x;
+            figure.data[1].y = sums.od;
+            // readings flagged as sensor faults
+            var fault = predictData.fault || [];
+            for (var k = 0; k < fault.length; k++) {
+                if (fault[k]) {
+                    figure.data[8].x.push(predictData.x[k]);
+                    figure.data[8].y.push(sums.od[k]);
+                }
+            }
+
+            // the selected window counts back from the last reading that is not a fault, like window_fit and
+            // growth_phase_fit, and leaves out its end points like predict_curve
+            var lastTimePoint = sums.lastValid >= 0 ? hours[sums.lastValid] : hours[n - 1];
+            var start = upperBound(hours, lastTimePoint + selection[0]);
+            var end = Math.max(lowerBound(hours, lastTimePoint + selection[1]), start);
+            var fit = regression(sums, start, end);
+
+            var shapes = [];
+            if (fit !== null) {
+                // get where the ln curve intercepts the target line, a fit that is not growing never reaches it and
+                // its line is only drawn over the selected data
+                var interceptX = (Math.log(target) - fit.intercept) / fit.slope;
+                var interceptTime = fit.slope > 0 ? hoursToTime(predictData, interceptX) : null;
+                var lineEnd = interceptTime !== null ? interceptX : lastTimePoint + selection[1];
+                // 95% band of the fit line and of the crossing time, like eta_intervals in predict_funs.py
+                var quantile = tQuantile975(fit.n - 2);
+                var se = Math.sqrt(Math.max(fit.syy - fit.slope * fit.slope * fit.sxx, 0) / (fit.n - 2));
+                var bandWidth = function (t) {
+                    return quantile * se * Math.sqrt(1 / fit.n + (t - fit.tMean) * (t - fit.tMean) / fit.sxx);
+                };
+                var interceptWidth = bandWidth(interceptX) / Math.abs(fit.slope);
+                var tPredict = [];
+                var yPredict = [];
+                var yPredictLin = [];
+                var yLower = [];
+                var yUpper = [];
+                for (var i = 0; i < 50; i++) {
+                    var t = (lastTimePoint + selection[0]) + i * (lineEnd - (lastTimePoint + selection[0])) / 49;
+                    tPredict.push(hoursToTime(predictData, t));
+                    yPredict.push(fit.slope * t + fit.intercept);
+                    yPredictLin.push(Math.exp(fit.slope * t + fit.intercept));
+                    yLower.push(Math.exp(fit.slope * t + fit.intercept - bandWidth(t)));
+                    yUpper.push(Math.exp(fit.slope * t + fit.intercept + bandWidth(t)));
+                }
+                var selectionX = [];
+                var selectionLn = [];
+                var selectionOD = [];
+                for (var j = start; j < end; j++) {
+                    if (sums.valid[j]) {
+                        selectionX.push(predictData.x[j]);
+                        selectionLn.push(sums.ln[j]);
+                        selectionOD.push(sums.od[j]);
+                    }
+                }
+                var r = Math.round(fit.r * 1000) / 1000;
+                var color = r * r > 0.9 ? 'green' : 'red';
+                var earliestTime = null;
+                var latestTime = null;
+                if (interceptTime !== null) {
+                    earliestTime = hoursToTime(predictData, interceptX - interceptWidth);
+                    latestTime = hoursToTime(predictData, interceptX + interceptWidth);
+                }
+
+                figure.data[2].x = tPredict;
+                figure.data[2].y = yPredict;
+                figure.data[2].marker.color = color;
+                figure.data[3].x = selectionX;
+                figure.data[3].y = selectionLn;
+                figure.data[4].x = tPredict;
+                figure.data[4].y = yPredictLin;
+                figure.data[4].marker.color = color;
+                figure.data[5].x = selectionX;
+                figure.data[5].y = selectionOD;
+                figure.data[6].x = tPredict;
+                figure.data[6].y = yLower;
+                figure.data[7].x = tPredict;
+                figure.data[7].y = yUpper;
+
+                if (interceptTime !== null) {
+                    shapes.push({
+                        type: 'line', x0: interceptTime, x1: interceptTime, xref: 'x', y0: 0, y1: 1, yref: 'y domain',
+                        line: {width: 2, dash: 'dash'}
+                    });
+                }
+                if (earliestTime !== null && latestTime !== null) {
+                    shapes.push({
+                        type: 'rect', x0: earliestTime, x1: latestTime, xref: 'x', y0: 0, y1: 1, yref: 'y domain',
+                        fillcolor: 'orange', opacity: 0.2, line: {width: 0}
+                    });
+                }
+                figure.layout.annotations.push({
+                    x: interceptTime !== null ? interceptTime : tPredict[tPredict.length - 1], y: target, xref: 'x',
+                    yref: 'y',
+                    // "none" like the table when the target is never reached
+                    text: 'Time when growth hits target: ' + (interceptTime !== null ? interceptTime : 'none') +
+                        (earliestTime !== null && latestTime !== null ?
+                            '<br>95%: ' + earliestTime + ' to ' + latestTime : ''),
+                    font: {color: '#ffffff', size: 15}, showarrow: false, xshift: -200, yshift: -20, align: 'center',
+                    bordercolor: 'orange', borderwidth: 2, bgcolor: 'blue', opacity: 0.5
+                });
+            }
+            // target line on the linear graph
+            shapes.push({
+                type: 'line', x0: 0, x1: 1, xref: 'x domain', y0: target, y1: target, yref: 'y',
+                line: {width: 2, dash: 'dash'}
+            });
+            figure.layout.shapes = shapes;
+            return figure;
+        },
+
+        // running sums of the valid points for the least squares fit, kept for the last data and blank value so
+        // moving the slider only costs two lookups
+        prefix_sums: function (predictData, blank) {
+            var cached = window.dash_clientside.predict.cached_sums;
+            if (cached && cached.data === predictData && cached.blank === blank) {
+                return cached;
+            }
+            var n = predictData.od.length;
+            var sums = {
+                data: predictData, blank: blank, od: new Array(n), ln: new Array(n), valid: new Array(n),
+                n: new Float64Array(n + 1), t: new Float64Array(n + 1), y: new Float64Array(n + 1),
+                tt: new Float64Array(n + 1), ty: new Float64Array(n + 1), yy: new Float64Array(n + 1), lastValid: -1
+            };
+            for (var i = 0; i < n; i++) {
+                var od = predictData.od[i] + blank;
+                var ln = Math.log(od);
+                var t = predictData.hours[i];
+                var valid = isFinite(ln) && !(predictData.fault && predictData.fault[i]);
+                sums.od[i] = od;
+                sums.ln[i] = isFinite(ln) ? ln : null;
+                sums.valid[i] = valid;
+                if (valid) {
+                    sums.lastValid = i;
+                }
+                sums.n[i + 1] = sums.n[i] + (valid ? 1 : 0);
+                sums.t[i + 1] = sums.t[i] + (valid ? t : 0);
+                sums.y[i + 1] = sums.y[i] + (valid ? ln : 0);
+                sums.tt[i + 1] = sums.tt[i] + (valid ? t * t : 0);
+                sums.ty[i + 1] = sums.ty[i] + (valid ? t * ln : 0);
+                sums.yy[i + 1] = sums.yy[i] + (valid ? ln * ln : 0);
+            }
+            window.dash_clientside.predict.cached_sums = sums;
+            return sums;
+        }
+    }
+});
+
+// least squares line of the points with index start to end - 1, null if there are 2 points or fewer
+function regression(sums, start, end) {
+    var n = sums.n[end] - sums.n[start];
+    if (n <= 2) {
+        return null;
+    }
+    var t = sums.t[end] - sums.t[start];
+    var y = sums.y[end] - sums.y[start];
+    var sxx = (sums.tt[end] - sums.tt[start]) - t * t / n;
+    var sxy = (sums.ty[end] - sums.ty[start]) - t * y / n;
+    var syy = (sums.yy[end] - sums.yy[start]) - y * y / n;
+    var slope = sxy / sxx;
+    return {slope: slope, intercept: (y - slope * t) / n, r: sxy / Math.sqrt(sxx * syy), n: n, sxx: sxx, syy: syy,
+        tMean: t / n};
+}
+
+// 97.5% quantile of the t distribution with df degrees of freedom, from the normal quantile with the Cornish-Fisher
+// expansion (within 1% from 3 degrees of freedom up, 1 and 2 are exact)
+function tQuantile975(df) {
+    var z = 1.959964;
+    if (df < 1) {
+        return NaN;
+    } else if (df < 3) {
+        return [12.706205, 4.302653][df - 1];
+    }
+    var z3 = z * z * z;
+    var z5 = z3 * z * z;
+    var z7 = z5 * z * z;
+    return z + (z3 + z) / (4 * df) + (5 * z5 + 16 * z3 + 3 * z) / (96 * df * df) +
+        (3 * z7 + 19 * z5 + 17 * z3 - 15 * z) / (384 * df * df * df);
+}
+
+// index of the first value greater than x in a sorted array
+function upperBound(values, x) {
+    var lo = 0, hi = values.length;
+    while (lo < hi) {
+        var mid = (lo + hi) >> 1;
+        if (values[mid] <= x) { lo = mid + 1; } else { hi = mid; }
+    }
+    return lo;
+}
+
+// index of the first value greater than or equal to x in a sorted array
+function lowerBound(values, x) {
+    var lo = 0, hi = values.length;
+    while (lo < hi) {
+        var mid = (lo + hi) >> 1;
+        if (values[mid] < x) { lo = mid + 1; } else { hi = mid; }
+    }
+    return lo;
+}
+
+// time string of a number of hours after the first data point, written in the data's time zone like
+// hours_to_time_str in predict_funs.py, or null if hours is not a usable number
+function hoursToTime(predictData, hours) {
+    if (!isFinite(hours) || Math.abs(hours) > 24 * 365 * 100) {
+        return null;
+    }
+    var parts = {};
+    timeFormat(predictData.tz).formatToParts(new Date(predictData.start + hours * 3600000)).forEach(function (part) {
+        parts[part.type] = part.value;
+    });
+    return parts.year + '-' + parts.month + '-' + parts.day + ' ' + (parts.hour === '24' ? '00' : parts.hour) + ':' +
+        parts.minute + ':' + parts.second;
+}
+
+// formatter of the date and time parts in a time zone, kept for each zone since making one is slow
+var timeFormats = {};
+function timeFormat(tz) {
+    if (!timeFormats[tz]) {
+        timeFormats[tz] = new Intl.DateTimeFormat('en-US', {
+            timeZone: tz, hourCycle: 'h23', year: 'numeric', month: '2-digit', day: '2-digit', hour: '2-digit',
+            minute: '2-digit', second: '2-digit'
+        });
+    }
+    return timeFormats[tz];
+}
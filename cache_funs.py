@@ -0,0 +1,139 @@
+import hashlib
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+from get_data_funs import get_OD_dataframe, get_temp_data
+
+
+class LRUCache:
+    """Least recently used cache that holds at most max_items values and counts hits and misses
+
+    Arguments:
+
+    max_items -- int number of values to keep before the least recently used one is evicted (default 32)
+    """
+
+    def __init__(self, max_items=32):
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Returns the value stored under key (and marks it as recently used), or default if it is not cached"""
+        if key in self.items:
+            self.items.move_to_end(key)
+            self.hits += 1
+            return self.items[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        """Stores value under key, evicting the least recently used values if the cache is full"""
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+        return value
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def clear(self):
+        self.items.clear()
+
+    def stats(self):
+        """Returns a dict with the number of cached items, the hits and the misses"""
+        return {'size': len(self.items), 'max_items': self.max_items, 'hits': self.hits, 'misses': self.misses}
+
+
+# serialized figures keyed by the graph id and everything that is drawn on it (device, data version, names, ...)
+figure_cache = LRUCache(max_items=16)
+
+# most recent full dataframes downloaded from Thingspeak, keyed by ('od' or 'temp', device number)
+device_data_cache = {}
+
+
+def get_data_version(dataframe, processing='none'):
+    """Returns a short string that changes whenever the rows of a Thingspeak dataframe change
+
+    Thingspeak only ever appends rows, so the number of rows and the first and last time stamps identify the data.
+
+    Arguments:
+
+    dataframe -- pandas dataframe with a datetime index
+
+    processing -- name of anything done to the readings after the download (e.g. the smoothing method), so the
+    processed data gets its own version (default 'none')
+    """
+    if len(dataframe) == 0:
+        return 'empty'
+    key = f"{len(dataframe)}-{dataframe.index[0].value}-{dataframe.index[-1].value}-{'-'.join(map(str, dataframe.columns))}"
+    if processing != 'none':
+        key += f"-{processing}"
+    return hashlib.md5(key.encode('utf-8')).hexdigest()[:12]
+
+
+def cache_device_data(kind, device, dataframe):
+    """Stores a freshly downloaded dataframe in the device data cache and returns its data version
+
+    Arguments:
+
+    kind -- 'od' or 'temp'
+
+    device -- int device number (0-2)
+
+    dataframe -- full dataframe returned by get_OD_dataframe or get_temp_data
+    """
+    version = get_data_version(dataframe)
+    device_data_cache[(kind, device)] = {'data': dataframe, 'version': version, 'fetched': time.time()}
+    return version
+
+
+def get_device_data(kind, device, chIDs, readAPIkeys, max_age=300):
+    """Returns a tuple of the full dataframe for the device and its data version, only downloading from Thingspeak
+    when the cached copy is missing or older than max_age seconds
+
+    Arguments:
+
+    kind -- 'od' or 'temp'
+
+    device -- int device number (0-2)
+
+    chIDs --  list of channel IDs from main file
+
+    readAPIkeys -- list of API keys from main file
+
+    max_age -- number of seconds a cached dataframe is served before it is downloaded again (default 300)
+    """
+    entry = device_data_cache.get((kind, device))
+    if entry is None or time.time() - entry['fetched'] > max_age:
+        if kind == 'od':
+            dataframe = get_OD_dataframe(device, chIDs, readAPIkeys)
+        else:
+            dataframe = get_temp_data(device, chIDs, readAPIkeys)
+        cache_device_data(kind, device, dataframe)
+        entry = device_data_cache[(kind, device)]
+
+    return entry['data'], entry['version']
+
+
+def get_cached_device_data(kind, device):
+    """Returns a tuple of the last downloaded dataframe for the device and its data version however old it is, or
+    (None, None) if nothing was downloaded yet. Never downloads, the app and the worker keep the cache fresh
+
+    Arguments:
+
+    kind -- 'od' or 'temp'
+
+    device -- int device number (0-2)
+    """
+    entry = device_data_cache.get((kind, device))
+    if entry is None:
+        return None, None
+    return entry['data'], entry['version']
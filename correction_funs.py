@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+
+from cache_funs import LRUCache, get_data_version
+from align_funs import align_to_times, get_aligned_temperature
+from smooth_funs import get_smoothed_data
+
+# temperature column the OD response is fitted against
+correction_column = 'Temp Int'
+
+# sums of the calibration data of each device and set of blank tubes, keyed by (device, blank tubes, processing)
+calibration_cache = LRUCache(max_items=12)
+
+# names of the running sums kept for each blank tube
+calibration_sum_names = ['n', 't', 'y', 'tt', 'ty']
+
+
+def calibration_sums(od, temperature):
+    """Returns a dict of numpy arrays (one value per blank tube) of the sums over the readings where both the OD and
+    temperature are known
+
+    Arguments:
+
+    od -- 2-D numpy array (time x blank tube) of blank tube OD readings
+
+    temperature -- numpy array of the temperature at each reading
+    """
+    t = np.broadcast_to(temperature[:, None], od.shape)
+    known = np.isfinite(od) & np.isfinite(t)
+    t = np.where(known, t, 0.0)
+    y = np.where(known, od, 0.0)
+    return {'n': known.sum(axis=0).astype(float), 't': t.sum(axis=0), 'y': y.sum(axis=0), 'tt': (t * t).sum(axis=0),
+            'ty': (t * y).sum(axis=0)}
+
+
+def fit_temperature_response(sums):
+    """Returns a tuple of the OD change per degree and the mean temperature of the calibration data, from the sums of
+    calibration_sums. Every blank tube has its own level, the slope is shared (a pooled within-tube regression), so
+    blanks with different ODs can be used together. The slope is 0 if there is not enough data.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sxx = sums['tt'] - sums['t'] ** 2 / sums['n']
+        sxy = sums['ty'] - sums['t'] * sums['y'] / sums['n']
+    usable = sums['n'] > 2
+    total_sxx = np.sum(np.where(usable, sxx, 0))
+    if total_sxx <= 0:
+        return 0.0, np.nan
+    slope = np.sum(np.where(usable, sxy, 0)) / total_sxx
+    reference = np.sum(np.where(usable, sums['t'], 0)) / np.sum(np.where(usable, sums['n'], 0))
+    return float(slope), float(reference)
+
+
+def get_temperature_response(device, blank_tubes, dataframe, temp_df, processing='none'):
+    """Returns a tuple of the OD change per degree and the reference temperature of the device, fitted from the blank
+    tubes. The sums of the readings already fitted are cached, so only readings newer than the last one that had a
+    temperature are added.
+
+    Arguments:
+
+    device -- int device number (0-2)
+
+    blank_tubes -- list of the tube numbers (0-7) that only hold medium
+
+    dataframe -- pandas dataframe of the OD data of all tubes, like the one from get_OD_dataframe
+
+    temp_df -- pandas dataframe of the device's temperature data
+
+    processing -- name of anything done to the OD readings before (e.g. the smoothing method), the sums of differently
+    processed readings are kept apart (default 'none')
+    """
+    key = (device, tuple(sorted(blank_tubes)), processing)
+    cached = calibration_cache.get(key)
+    last_time = None if cached is None else cached['last_time']
+    if last_time is not None and last_time >= dataframe.index[-1]:
+        return cached['slope'], cached['reference']
+
+    # only the readings the cached sums do not have yet
+    new_rows = dataframe if last_time is None else dataframe.loc[dataframe.index > last_time]
+    column = correction_column if correction_column in temp_df.columns else temp_df.columns[0]
+    temperature = align_to_times(new_rows.index, temp_df[[column]])[column].to_numpy(dtype=float)
+    # the temperature channel can lag the OD channel, so the newest readings without a temperature yet, or after the
+    # last temperature reading (a nearer one may still come), are left for the next fit instead of being counted
+    known = np.flatnonzero(np.isfinite(temperature) & (new_rows.index <= temp_df.index.max()))
+    used = known[-1] + 1 if len(known) != 0 else 0
+    sums = calibration_sums(new_rows.iloc[:used, list(key[1])].to_numpy(dtype=float), temperature[:used])
+    if cached is not None:
+        sums = {name: sums[name] + cached['sums'][name] for name in calibration_sum_names}
+    if used != 0:
+        last_time = new_rows.index[used - 1]
+
+    slope, reference = fit_temperature_response(sums)
+    print(f"device {device + 1} OD response to temperature {slope:.5f} OD/degree around {reference:.1f} from "
+          f"{int(sums['n'].sum())} blank readings")
+    calibration_cache.put(key, {'sums': sums, 'slope': slope, 'reference': reference, 'last_time': last_time})
+    return slope, reference
+
+
+def correct_temperature(dataframe, aligned_temp, slope, reference):
+    """Returns a copy of the OD dataframe with the temperature response taken out of every tube at once, readings
+    without a temperature within the alignment tolerance are left as they are
+
+    Arguments:
+
+    dataframe -- pandas dataframe of the OD data of all tubes
+
+    aligned_temp -- pandas dataframe of the temperature at each OD reading, from get_aligned_temperature
+
+    slope -- OD change per degree from get_temperature_response
+
+    reference -- temperature the readings are corrected to
+    """
+    if slope == 0 or not np.isfinite(reference):
+        return dataframe
+    column = correction_column if correction_column in aligned_temp.columns else aligned_temp.columns[0]
+    temperature = aligned_temp[column].to_numpy(dtype=float)
+    shift = np.nan_to_num(slope * (temperature - reference))
+    return pd.DataFrame(dataframe.to_numpy(dtype=float) - shift[:, None], index=dataframe.index,
+                        columns=dataframe.columns)
+
+
+def process_od_data(device, od_df, temp_df, smoothing='none', blank_tubes=None, source='live'):
+    """Returns a tuple of the OD dataframe smoothed and corrected for the chamber temperature, and the name of that
+    processing for get_data_version. The table, the target time alerts and the what-if API all process the data here,
+    so their estimates agree.
+
+    Arguments:
+
+    device -- int device number (0-2)
+
+    od_df -- pandas dataframe of the full OD download, like the one from get_OD_dataframe
+
+    temp_df -- pandas dataframe of the device's temperature data, only used with blank tubes
+
+    smoothing -- 'none', 'savgol' or 'median' (default 'none')
+
+    blank_tubes -- list of the tube numbers (0-7) that only hold medium, None or empty for no correction (default None)
+
+    source -- 'live' for Thingspeak data or e.g. 'archive3' for an archived run, whose smoothing and calibration are
+    cached apart from the live data (default 'live')
+    """
+    # smooth the readings before culling, so the filter sees evenly spaced readings. Only new rows get smoothed when
+    # the last download of the device was smoothed the same way
+    od_df = get_smoothed_data(device, od_df, smoothing, source=source)
+    if not blank_tubes:
+        return od_df, smoothing
+
+    # take the chamber temperature response fitted from the blank tubes out of every tube
+    calibration_processing = smoothing if source == 'live' else f"{smoothing}-{source}"
+    slope, reference = get_temperature_response(device, blank_tubes, od_df, temp_df, calibration_processing)
+    aligned_temp = get_aligned_temperature(device, get_data_version(od_df, smoothing), od_df.index, temp_df)
+    return correct_temperature(od_df, aligned_temp, slope, reference), f"{smoothing}-blanks{sorted(blank_tubes)}"
@@ -0,0 +1,105 @@
+import warnings
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# number of earlier rows each test looks at, also the number of rows of context needed to check new rows on their own
+fault_window = 15
+
+# names of the fault tests, each gives a mask in the dict returned by fault_masks
+fault_names = ['spike', 'stuck', 'jump']
+
+
+def trailing_windows(values, window):
+    """Returns a (time x tube x window) view of the window of values ending at (and including) each row, with the first
+    rows padded with nan
+
+    Arguments:
+
+    values -- 2-D numpy array (time x tube)
+
+    window -- int number of rows in each window
+    """
+    padded = np.concatenate([np.full((window - 1, values.shape[1]), np.nan), values])
+    return sliding_window_view(padded, window, axis=0)
+
+
+def fault_masks(od, context=None, window=fault_window, spike_mads=6, mad_floor=0.002, stuck_rows=10,
+                jump_size=0.05, hours=None, context_hours=None, max_growth_rate=np.log(2)):
+    """Returns a dict of 2-D boolean numpy arrays (time x tube), True where a reading looks like a sensor fault, with
+    one mask for each of fault_names and 'any' for all of them
+
+    Every test only looks at earlier readings, so new rows can be checked on their own given the last window rows
+    before them as context, and give the same answer as checking all of the data at once.
+
+    'spike' -- the reading is more than spike_mads scaled median absolute deviations from the median of its window
+    'stuck' -- the reading is the same as the stuck_rows - 1 readings before it
+    'jump' -- the reading moved more than jump_size OD, plus the most growth at max_growth_rate could explain in the
+    time since, from the last reading that was not a spike without being a spike itself, like a tube being moved or the
+    sensor shifting. The growth allowance keeps culled data (every 10th reading) and high ODs from counting as jumps
+
+    Arguments:
+
+    od -- 2-D numpy array (time x tube) of OD readings, nan where there was no reading
+
+    context -- 2-D numpy array of the readings just before od, used by the tests but not flagged (default None)
+
+    window -- int number of readings in the rolling median and MAD (default fault_window)
+
+    spike_mads -- number of MADs away from the median a spike has to be (default 6)
+
+    mad_floor -- smallest MAD used, so a flat signal does not flag every bit of noise (default 0.002 OD)
+
+    stuck_rows -- int number of equal readings in a row that count as a stuck sensor (default 10)
+
+    jump_size -- OD change from the recent median that counts as a jump (default 0.05)
+
+    hours -- numpy array of the time of each reading in hours, for the growth allowance of the jump test (default None
+    for no allowance)
+
+    context_hours -- numpy array of the time of each context reading in hours, needed when context and hours are given
+
+    max_growth_rate -- fastest growth of ln OD per hour the jump test allows for (default ln 2, doubling every hour)
+    """
+    od = np.asarray(od, dtype=float)
+    num_context = 0
+    if context is not None and len(context) != 0:
+        context = np.asarray(context, dtype=float)[-max(window, stuck_rows):]
+        num_context = len(context)
+        od = np.concatenate([context, od])
+        if hours is not None:
+            hours = np.concatenate([np.asarray(context_hours, dtype=float)[-num_context:], hours])
+
+    windows = trailing_windows(od, window)
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        # windows of only nan readings warn about an empty median
+        warnings.simplefilter('ignore', RuntimeWarning)
+        median = np.nanmedian(windows, axis=2)
+        mad = np.nanmedian(np.abs(windows - median[:, :, None]), axis=2)
+    spike = np.abs(od - median) > spike_mads * np.maximum(1.4826 * mad, mad_floor)
+
+    # the last reading before each reading that was not a spike, so coming back down from a spike is not a jump
+    rows = np.arange(len(od))[:, None]
+    good = np.isfinite(od) & ~spike
+    last_good = np.maximum.accumulate(np.where(good, rows, -1), axis=0)
+    last_good = np.concatenate([np.full((1, od.shape[1]), -1), last_good[:-1]])
+    previous = np.where(last_good >= 0, np.take_along_axis(od, np.maximum(last_good, 0), axis=0), np.nan)
+    jump_limit = jump_size
+    if hours is not None:
+        hours = np.asarray(hours, dtype=float)
+        previous_hours = np.where(last_good >= 0, hours[np.maximum(last_good, 0)], np.nan)
+        # growth explains a larger step the higher the OD and the longer since the last reading
+        with np.errstate(invalid='ignore'):
+            jump_limit = jump_size + np.abs(previous) * np.expm1(max_growth_rate * (hours[:, None] - previous_hours))
+    with np.errstate(invalid='ignore'):
+        jump = (np.abs(od - previous) > jump_limit) & ~spike
+
+    # length of the run of equal readings ending at each reading
+    same = np.concatenate([np.zeros((1, od.shape[1]), dtype=bool), od[1:] == od[:-1]])
+    run_start = np.maximum.accumulate(np.where(same, 0, rows), axis=0)
+    stuck = (rows - run_start + 1) >= stuck_rows
+
+    masks = {'spike': spike, 'stuck': stuck, 'jump': jump}
+    masks = {name: mask[num_context:] for name, mask in masks.items()}
+    masks['any'] = masks['spike'] | masks['stuck'] | masks['jump']
+    return masks
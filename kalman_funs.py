@@ -0,0 +1,156 @@
+import numpy as np
+
+from cache_funs import LRUCache
+
+# filter states keyed by (fit key, offsets), so each new download only runs the filter over its new readings
+kalman_states = LRUCache(max_items=24)
+
+
+class KalmanState:
+    """State of a Kalman filter of (ln OD, growth rate) for a number of tubes, every array has one row per tube
+
+    x -- 2-D numpy array (tube x 2) of the estimated ln OD and growth rate (1/h)
+
+    P -- 3-D numpy array (tube x 2 x 2) of the covariance of x
+
+    started -- boolean numpy array, True for tubes that have had a reading
+
+    last_time -- time stamp of the last reading the filter saw (None before the first)
+
+    stats -- dict of numpy arrays with the number of readings, the sums of ln OD and ln OD squared and the sum of squared
+    prediction errors, for the r^2 of the filter's predictions
+    """
+
+    def __init__(self, num_tubes, initial_variance=1.0):
+        self.x = np.zeros((num_tubes, 2))
+        self.P = np.tile(np.eye(2) * initial_variance, (num_tubes, 1, 1))
+        self.started = np.zeros(num_tubes, dtype=bool)
+        self.last_time = None
+        self.stats = {name: np.zeros(num_tubes) for name in ['n', 'y', 'yy', 'error']}
+
+    def r_squared(self):
+        """Returns a numpy array of the r^2 of the filter's one step ahead predictions of ln OD for each tube"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            total = self.stats['yy'] - self.stats['y'] ** 2 / self.stats['n']
+            return np.where(total > 0, 1 - self.stats['error'] / total, 0)
+
+
+def kalman_step(state, dt, ln_od, od, rate_noise=0.05, od_noise=0.003):
+    """Moves the filter forward dt hours and takes in one reading of every tube, in place
+
+    The state is ln OD and growth rate. The growth rate changes as a random walk with rate_noise^2 variance per hour,
+    and ln OD grows at that rate. The measurement noise of ln OD is the OD noise divided by the OD (the first order
+    error of the log), so readings at low OD count for less.
+
+    Arguments:
+
+    state -- KalmanState of the tubes
+
+    dt -- hours since the last reading
+
+    ln_od -- numpy array of the ln OD reading of every tube, nan for tubes without a usable reading
+
+    od -- numpy array of the OD reading of every tube
+
+    rate_noise -- standard deviation of the change of growth rate in one hour (default 0.05 1/h)
+
+    od_noise -- standard deviation of an OD reading (default 0.003)
+    """
+    has_reading = np.isfinite(ln_od)
+
+    # tubes get their first state from their first reading
+    first = has_reading & ~state.started
+    state.x[first, 0] = ln_od[first]
+    state.x[first, 1] = 0.0
+    state.started |= first
+    update = has_reading & ~first
+
+    # predict
+    state.x[:, 0] += dt * state.x[:, 1]
+    F = np.array([[1.0, dt], [0.0, 1.0]])
+    Q = rate_noise ** 2 * np.array([[dt ** 3 / 3, dt ** 2 / 2], [dt ** 2 / 2, dt]])
+    state.P = F @ state.P @ F.T + Q
+
+    # update the tubes with a reading, H = [1, 0]
+    if update.any():
+        innovation = ln_od[update] - state.x[update, 0]
+        R = (od_noise / np.maximum(od[update], od_noise)) ** 2
+        S = state.P[update, 0, 0] + R
+        K = state.P[update, :, 0] / S[:, None]
+        state.x[update] += K * innovation[:, None]
+        state.P[update] -= K[:, :, None] * state.P[update, 0, :][:, None, :]
+
+        y = ln_od[update]
+        state.stats['n'][update] += 1
+        state.stats['y'][update] += y
+        state.stats['yy'][update] += y * y
+        state.stats['error'][update] += innovation ** 2
+    return state
+
+
+def run_kalman(bundle, tubes=None, fit_key=None, **noise):
+    """Returns the KalmanState of the tubes after all of the bundle's readings, only running the filter over the
+    readings newer than the last run with the same fit key and offsets
+
+    Arguments:
+
+    bundle -- AnalysisBundle from analysis_funs with the data of all tubes
+
+    tubes -- list of tube numbers (default None for all tubes)
+
+    fit_key -- anything identifying the series of data (e.g. device number), None to always start over (default None)
+
+    noise -- rate_noise and od_noise passed on to kalman_step
+    """
+    if tubes is None:
+        tubes = list(range(bundle.od.shape[1]))
+    tubes = list(tubes)
+    key = (fit_key, tuple(bundle.offsets[i] for i in tubes), tuple(tubes))
+    state = kalman_states.get(key) if fit_key is not None else None
+    if state is None or state.last_time is None or state.last_time > bundle.times[-1]:
+        state = KalmanState(len(tubes))
+        new_rows = np.arange(len(bundle.times))
+    else:
+        new_rows = np.nonzero(bundle.times > state.last_time)[0]
+
+    ln_od = np.where(bundle.valid[:, tubes], bundle.ln_od[:, tubes], np.nan)
+    od = bundle.od[:, tubes]
+    last_hour = None if state.last_time is None else (state.last_time - bundle.times[0]).total_seconds() / 3600
+    for row in new_rows:
+        dt = 0.0 if last_hour is None else bundle.hours[row] - last_hour
+        kalman_step(state, dt, ln_od[row], od[row], **noise)
+        last_hour = bundle.hours[row]
+    if len(new_rows) != 0:
+        state.last_time = bundle.times[new_rows[-1]]
+
+    if fit_key is not None:
+        kalman_states.put(key, state)
+    return state
+
+
+def kalman_forecast(state, target_vals, confidence_z=1.96):
+    """Returns a tuple of numpy arrays of the hours from the filter's last reading until each tube reaches its target,
+    and the lower and upper bounds of those hours
+
+    The time is (ln(target) - ln OD) / growth rate, its variance comes from the state covariance with the delta method.
+    Tubes that are not growing or are already past their target get nan.
+
+    Arguments:
+
+    state -- KalmanState from run_kalman
+
+    target_vals -- list of target OD values, one for each tube of the state
+
+    confidence_z -- number of standard deviations in the bounds (default 1.96 for 95%)
+    """
+    ln_target = np.log(np.asarray(target_vals, dtype=float))
+    ln_od = state.x[:, 0]
+    rate = state.x[:, 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hours = (ln_target - ln_od) / rate
+        gradient = np.stack([-1 / rate, -(ln_target - ln_od) / rate ** 2], axis=1)
+        variance = np.einsum('ti,tij,tj->t', gradient, state.P, gradient)
+    growing = (rate > 0) & state.started & (ln_od < ln_target)
+    hours = np.where(growing, hours, np.nan)
+    spread = confidence_z * np.sqrt(np.maximum(variance, 0))
+    return hours, np.where(growing, hours - spread, np.nan), np.where(growing, hours + spread, np.nan)
@@ -0,0 +1,123 @@
+import os
+import time
+
+import redis
+from rq import Queue, get_current_job
+from rq.command import send_stop_job_command
+from rq.exceptions import NoSuchJobError, InvalidJobOperation
+from rq.job import Job, JobStatus
+
+from worker import conn
+from get_data_funs import get_OD_dataframe, get_temp_data
+
+# seconds a device download may take in the worker
+load_timeout = 120
+
+# seconds a download may wait in the queue before the app takes it back and downloads the data itself, so the app
+# still loads when no worker process is running
+worker_wait = int(os.getenv('LOAD_WORKER_WAIT', 15))
+
+# job statuses of a download that is still going
+unfinished_statuses = [JobStatus.CREATED, JobStatus.QUEUED, JobStatus.STARTED, JobStatus.DEFERRED,
+                       JobStatus.SCHEDULED]
+
+
+def set_progress(message):
+    """Stores the progress message of the running rq job in its meta, where the app polls it"""
+    job = get_current_job()
+    if job is not None:
+        job.meta['progress'] = message
+        job.save_meta()
+    print(message)
+
+
+def load_device_data(device, chIDs, readAPIkeys):
+    """rq job that downloads the OD and temperature data of a device from Thingspeak, returns a tuple of the OD and
+    temperature dataframes
+
+    Arguments:
+
+    device -- int device number (0-2)
+
+    chIDs --  list of channel IDs from main file
+
+    readAPIkeys -- list of API keys from main file
+    """
+    set_progress(f"Fetching and parsing the OD data of IODR #{device + 1}")
+    od_df = get_OD_dataframe(device, chIDs, readAPIkeys)
+    set_progress(f"Fetching and parsing the temperature data of IODR #{device + 1}")
+    temp_df = get_temp_data(device, chIDs, readAPIkeys)
+    set_progress(f"Sending the data of IODR #{device + 1}")
+    return od_df, temp_df
+
+
+def cancel_load(job_id):
+    """Cancels a device download, stopping it in the worker if it already started"""
+    try:
+        job = Job.fetch(job_id, connection=conn)
+        if job.get_status() == JobStatus.STARTED:
+            send_stop_job_command(conn, job_id)
+        elif job.get_status() in unfinished_statuses:
+            job.cancel()
+        print(f"cancelled download {job_id}")
+    except (NoSuchJobError, InvalidJobOperation, redis.exceptions.ConnectionError) as error:
+        print(f"download {job_id} could not be cancelled ({error})")
+
+
+def enqueue_load(device, chIDs, readAPIkeys, previous=None):
+    """Queues a download of the device's data on the 'high' rq queue and returns a dict with the job 'id', 'device'
+    and 'queued_at' (time.time()), or None if redis is not reachable (the data is then downloaded in the callback)
+
+    A download of another device that is still going is cancelled. A download of the same device that is still
+    going is kept, and returned, instead of starting another one.
+
+    Arguments:
+
+    device -- int device number (0-2)
+
+    chIDs --  list of channel IDs from main file
+
+    readAPIkeys -- list of API keys from main file
+
+    previous -- dict of the last download from enqueue_load, or None
+    """
+    try:
+        if previous is not None:
+            status = load_status(previous['id'])[0]
+            if status in unfinished_statuses:
+                if previous['device'] == device:
+                    return previous
+                cancel_load(previous['id'])
+        job = Queue('high', connection=conn).enqueue(load_device_data, device, chIDs, readAPIkeys,
+                                                    job_timeout=load_timeout, result_ttl=300, failure_ttl=300)
+    except redis.exceptions.ConnectionError:
+        return None
+    return {'id': job.id, 'device': device, 'queued_at': time.time()}
+
+
+def load_status(job_id):
+    """Returns a tuple of the status of a download, its progress message and its result (None until it finished)
+
+    Arguments:
+
+    job_id -- id of the rq job from enqueue_load
+    """
+    try:
+        job = Job.fetch(job_id, connection=conn)
+        status = job.get_status()
+        result = job.return_value() if status == JobStatus.FINISHED else None
+    except (NoSuchJobError, redis.exceptions.ConnectionError):
+        return JobStatus.FAILED, "The download is gone", None
+    return status, job.meta.get('progress', "Waiting for a worker"), result
+
+
+def load_unclaimed(load_job, status):
+    """Returns True if no worker has started the download within worker_wait seconds of it being queued
+
+    Arguments:
+
+    load_job -- dict of the download from enqueue_load
+
+    status -- status of the download from load_status
+    """
+    return status != JobStatus.STARTED and time.time() - load_job.get('queued_at', 0) > worker_wait
@@ -0,0 +1,160 @@
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+from cache_funs import LRUCache
+from get_data_funs import format_ln_data
+from predict_funs import predict_curve
+from archive_funs import load_experiment_info, load_experiment_data
+
+# most points drawn on the overlay graph, shared by all of its traces
+overlay_budget = 4000
+
+# fewest points of one trace however many traces there are
+min_trace_points = 200
+
+# ways to line the runs up, the hours of every run count from this point
+overlay_alignments = {
+    'start': 'Run start',
+    'lag': 'End of lag phase'
+}
+
+# downsampled series of archived tubes keyed by (experiment id, tube, alignment, number of points). Archived runs
+# never change, so nothing here goes out of date
+overlay_cache = LRUCache(max_items=64)
+
+
+def minmax_downsample(values, num_points):
+    """Returns a sorted numpy array of the indexes of the values to draw, the lowest and highest value of each of
+    num_points / 2 buckets of consecutive values, so spikes and dips still show after downsampling
+
+    Arguments:
+
+    values -- numpy array of the values in drawing order
+
+    num_points -- int number of points to keep (at most)
+    """
+    num_values = len(values)
+    if num_values <= num_points:
+        return np.arange(num_values)
+    num_buckets = max(num_points // 2, 1)
+    # every bucket gets the same number of values, the last ones are padded with nan
+    bucket_size = -(-num_values // num_buckets)
+    padded = np.full(num_buckets * bucket_size, np.nan)
+    padded[:num_values] = values
+    buckets = padded.reshape(num_buckets, bucket_size)
+    filled = ~np.isnan(buckets).all(axis=1)
+    low = np.argmin(np.where(np.isnan(buckets), np.inf, buckets), axis=1)
+    high = np.argmax(np.where(np.isnan(buckets), -np.inf, buckets), axis=1)
+    starts = np.arange(num_buckets) * bucket_size
+    indexes = np.concatenate([(starts + low)[filled], (starts + high)[filled]])
+    return np.unique(indexes[indexes < num_values])
+
+
+def lag_end(ln_od_df, fits, column, start_hours=1):
+    """Returns the hour (since the first reading) the tube's exponential phase line crosses its starting ln OD, or
+    None if the tube has no exponential phase
+
+    The line is fitted by predict_curve over the window of the archived fit.
+
+    Arguments:
+
+    ln_od_df -- pandas dataframe with columns OD and lnOD from format_ln_data
+
+    fits -- dict of numpy arrays with the archived exponential phase fit of every tube, or None
+
+    column -- int position of the tube in the archived data
+
+    start_hours -- hours at the start of the data used for the starting ln OD (default 1)
+    """
+    if fits is None or len(ln_od_df) == 0 or not np.isfinite([fits['start'][column], fits['end'][column]]).all():
+        return None
+    finite = ln_od_df.loc[np.isfinite(ln_od_df['lnOD'])]
+    if len(finite) == 0:
+        return None
+    curve_info, last_time_point = predict_curve(finite, [fits['start'][column], fits['end'][column]])
+    if len(curve_info) == 0 or curve_info[0] <= 0:
+        return None
+    hours = (finite.index - finite.index[0]) / pd.Timedelta(1, 'h')
+    start_ln_od = finite['lnOD'].loc[hours <= start_hours].median()
+    return max(float((start_ln_od - curve_info[1]) / curve_info[0]), 0.0)
+
+
+def overlay_series(selections, alignment='start', budget=overlay_budget):
+    """Returns a list of dicts, one per selected tube, with the 'name', 'hours' (since the alignment point), 'od' and
+    'ln_od' of the tube downsampled for drawing, and 'shift' with the hours the alignment point is after the run start
+
+    Only the columns of the selected tubes are read from the archive, one read per experiment.
+
+    Arguments:
+
+    selections -- list of (experiment id, tube number 0-7) pairs
+
+    alignment -- 'start' to count the hours from each run's first reading or 'lag' to count them from the end of each
+    tube's lag phase (tubes without an exponential phase stay at the run start) (default 'start')
+
+    budget -- int most points of all series together (default overlay_budget)
+    """
+    if len(selections) == 0:
+        return []
+    num_points = max(budget // len(selections), min_trace_points)
+
+    # the tubes of each experiment, so each experiment is read once
+    experiment_tubes = {}
+    for experiment_id, tube in selections:
+        experiment_tubes.setdefault(int(experiment_id), []).append(int(tube))
+
+    series = []
+    for experiment_id, tube in selections:
+        key = (int(experiment_id), int(tube), alignment, num_points)
+        cached = overlay_cache.get(key)
+        if cached is not None:
+            series.append(cached)
+            continue
+
+        info = load_experiment_info(experiment_id)
+        tubes = sorted(set(experiment_tubes[int(experiment_id)]))
+        dataframe = load_experiment_data(experiment_id, 'od', tubes)
+        if info is None or dataframe is None:
+            continue
+        offset = float(info['table']['offset'].iloc[tube]) if 'offset' in info['table'] else 0.0
+        ln_od_df = format_ln_data(dataframe, tubes.index(int(tube)), offset if offset == offset else 0.0)
+        if len(ln_od_df) == 0:
+            continue
+
+        hours = ((ln_od_df.index - ln_od_df.index[0]) / pd.Timedelta(1, 'h')).to_numpy()
+        shift = lag_end(ln_od_df, info['fits'], int(tube)) if alignment == 'lag' else None
+        shift = 0.0 if shift is None else shift
+
+        keep = minmax_downsample(ln_od_df['OD'].to_numpy(), num_points)
+        tube_name = info['table']['name'].iloc[tube] if 'name' in info['table'] else f"tube {tube + 1}"
+        series.append(overlay_cache.put(key, {
+            'name': f"{info['name']}: {tube_name}",
+            'hours': hours[keep] - shift,
+            'od': ln_od_df['OD'].to_numpy()[keep],
+            'ln_od': ln_od_df['lnOD'].to_numpy()[keep],
+            'shift': shift
+        }))
+    return series
+
+
+def overlay_figure(series, y_column='od', alignment='start'):
+    """Returns a plotly figure with one WebGL trace for each series from overlay_series
+
+    Arguments:
+
+    series -- list of dicts from overlay_series
+
+    y_column -- 'od' or 'ln_od' (default 'od')
+
+    alignment -- name of the alignment of the series, for the axis title (default 'start')
+    """
+    figure = go.Figure()
+    for item in series:
+        figure.add_trace(go.Scattergl(x=item['hours'], y=item['ln_od' if y_column == 'ln_od' else 'od'],
+                                      mode='markers', marker={'size': 4}, name=item['name'],
+                                      hovertemplate=f"{item['name']}<br>%{{x:.2f}} h, %{{y:.3f}}<extra></extra>"))
+    figure.update_layout(xaxis_title=f"Hours since {overlay_alignments.get(alignment, 'Run start').lower()}",
+                         yaxis_title='ln OD' if y_column == 'ln_od' else 'OD', height=600,
+                         legend={'orientation': 'h', 'y': -0.15}, uirevision='overlay')
+    return figure
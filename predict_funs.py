@@ -4,15 +4,22 @@ import urllib.request
 import requests
 import json
 import io
+import hashlib
 import plotly.graph_objects as go
 import plotly.express as px
 
 from rq import Queue
 from worker import conn
 
+from scheduler_funs import run_fits
+from cache_funs import LRUCache
+from analysis_funs import growth_phase_fit
+from kalman_funs import run_kalman, kalman_forecast
+
 import logging
+import warnings
 from scipy.signal import find_peaks
-from scipy.optimize import curve_fit
+from scipy.optimize import curve_fit, brentq
 from scipy.stats import linregress
 from scipy import stats
 
@@ -58,6 +65,136 @@ def predict_curve(dataframe, data_range):
     return curve_info, last_time_point
 
 
+# growth parameters of all tubes keyed by (device, data version, offsets)
+growth_parameter_cache = LRUCache(max_items=12)
+
+# names of the growth parameters, in the order of the table columns
+growth_parameter_names = ['lag time', 'mu max', 'doubling time', 'time to max', 'max OD']
+
+
+def growth_parameters(bundle, cache_key=None, start_hours=1, min_points=10, min_r_squared=0.95):
+    """Returns a dict of numpy arrays (one value per tube) of the growth parameters of every tube, nan where the tube
+    has no exponential phase
+
+    'mu max' is the slope (1/h) of ln OD over the steepest window of all of the data (growth_phase_fit), 'doubling time'
+    is ln(2) / mu max in hours and 'lag time' is the hour where the line of that window crosses the starting ln OD (the
+    median of the first start_hours hours). 'max OD' is the highest OD and 'time to max' the hour it was reached. Hours
+    count from the first data point.
+
+    Arguments:
+
+    bundle -- AnalysisBundle from analysis_funs with the data of all tubes
+
+    cache_key -- anything identifying the data and offsets of the bundle (e.g. (device, data version, offsets)), the
+    parameters are only computed once for each key (default None to not cache)
+
+    start_hours -- hours at the start of the data used for the starting ln OD (default 1)
+
+    min_points -- int fewest valid points of the steepest window, more than for the estimates since the noisy low OD
+    at the start of a run can line up by chance over a few points (default 10)
+
+    min_r_squared -- lowest r^2 of the steepest window (default 0.95)
+    """
+    if cache_key is not None and cache_key in growth_parameter_cache:
+        return growth_parameter_cache.get(cache_key)
+
+    fits = growth_phase_fit(bundle, lookback=bundle.hours[-1], min_points=min_points, min_r_squared=min_r_squared)
+    start_ln_od = np.where(bundle.valid & (bundle.hours[:, None] <= start_hours), bundle.ln_od, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+        # tubes without data in the first hours warn about an all nan median
+        warnings.simplefilter('ignore', RuntimeWarning)
+        start_ln_od = np.nanmedian(start_ln_od, axis=0)
+        lag_time = (start_ln_od - fits['intercept']) / fits['slope']
+        doubling_time = np.log(2) / fits['slope']
+
+    has_od = np.isfinite(bundle.od).any(axis=0)
+    max_index = np.argmax(np.where(np.isfinite(bundle.od), bundle.od, -np.inf), axis=0)
+    parameters = {
+        'lag time': np.maximum(lag_time, 0),
+        'mu max': fits['slope'],
+        'doubling time': np.where(fits['slope'] > 0, doubling_time, np.nan),
+        'time to max': np.where(has_od, bundle.hours[max_index], np.nan),
+        'max OD': np.where(has_od, bundle.od[max_index, np.arange(bundle.od.shape[1])], np.nan)
+    }
+    if cache_key is not None:
+        growth_parameter_cache.put(cache_key, parameters)
+    return parameters
+
+
+# suggested offsets of all tubes keyed by (device, data version), they do not depend on the offsets in the table
+suggested_offset_cache = LRUCache(max_items=12)
+
+
+def suggest_offsets(bundle, cache_key=None, start_od=0.01, search_hours=4, window_hours=1, percentile=10,
+                    min_points=5):
+    """Returns a numpy array of the suggested offset of every tube, the offset that moves the tube's baseline to
+    start_od (nan for tubes without early readings)
+
+    The baseline is a low percentile of the readings in the steadiest window (lowest standard deviation) of
+    window_hours that starts in the first search_hours of the data, before the tube starts growing. A low percentile
+    rather than the mean keeps the occasional bubble or bump from raising it. Sensor faults are left out.
+
+    Arguments:
+
+    bundle -- AnalysisBundle from analysis_funs with the data of all tubes
+
+    cache_key -- anything identifying the data of the bundle (e.g. (device, data version)), the offsets are only
+    suggested once for each key (default None to not cache)
+
+    start_od -- OD the baseline is moved to, a little above 0 so the ln OD of the baseline is finite (default 0.01)
+
+    search_hours -- hours at the start of the data the window is looked for in (default 4)
+
+    window_hours -- length of the window in hours (default 1)
+
+    percentile -- percentile of the readings in the window taken as the baseline (default 10)
+
+    min_points -- int fewest readings in the window (default 5)
+    """
+    if cache_key is not None and cache_key in suggested_offset_cache:
+        return suggested_offset_cache.get(cache_key)
+
+    # the readings without the bundle's offsets
+    od = np.where(bundle.faults, np.nan, bundle.od - np.asarray(bundle.offsets))
+    num_rows, num_tubes = od.shape
+    if num_rows == 0:
+        return np.full(num_tubes, np.nan)
+
+    # every window has the number of rows in the first window_hours, so all windows of all tubes are one array
+    window = int(min(max(np.searchsorted(bundle.hours, bundle.hours[0] + window_hours), min_points), num_rows))
+    num_starts = max(int(np.searchsorted(bundle.hours, bundle.hours[0] + search_hours - window_hours,
+                                         side='right')), 1)
+    num_starts = min(num_starts, num_rows - window + 1)
+
+    # standard deviation of every window from prefix sums
+    known = np.isfinite(od)
+    values = np.where(known, od, 0.0)
+    n = np.vstack([np.zeros(num_tubes), np.cumsum(known, axis=0)])
+    s = np.vstack([np.zeros(num_tubes), np.cumsum(values, axis=0)])
+    ss = np.vstack([np.zeros(num_tubes), np.cumsum(values * values, axis=0)])
+    starts = np.arange(num_starts)
+    window_n = n[starts + window] - n[starts]
+    window_s = s[starts + window] - s[starts]
+    window_ss = ss[starts + window] - ss[starts]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        spread = (window_ss - window_s ** 2 / window_n) / window_n
+    spread = np.where(window_n >= min_points, spread, np.inf)
+
+    # the readings of the steadiest window of each tube
+    best_start = np.argmin(spread, axis=0)
+    rows = best_start[None, :] + np.arange(window)[:, None]
+    window_od = np.take_along_axis(od, rows, axis=0)
+    with warnings.catch_warnings():
+        # tubes without readings in the window warn about an all nan percentile
+        warnings.simplefilter('ignore', RuntimeWarning)
+        baseline = np.nanpercentile(window_od, percentile, axis=0)
+    offsets = np.where(np.isfinite(spread[best_start, np.arange(num_tubes)]), start_od - baseline, np.nan)
+
+    if cache_key is not None:
+        suggested_offset_cache.put(cache_key, offsets)
+    return offsets
+
+
 def linear_curve(t, a, b):
     """
     fit data to linear model
@@ -65,6 +202,482 @@ def linear_curve(t, a, b):
     return a * t + b
 
 
+# growth models of ln OD against time in hours. y0 is the starting ln OD, A the increase in ln OD to stationary phase,
+# mu the maximum specific growth rate (1/h) and lam the lag time (h), using the Zwietering et al. (1990) forms
+def exponential_curve(t, y0, mu):
+    """
+    exponential growth, a straight line in ln OD
+    """
+    return y0 + mu * t
+
+
+def logistic_curve(t, y0, A, mu, lam):
+    """
+    logistic growth model
+    """
+    return y0 + A / (1 + np.exp(4 * mu / A * (lam - t) + 2))
+
+
+def gompertz_curve(t, y0, A, mu, lam):
+    """
+    Gompertz growth model
+    """
+    return y0 + A * np.exp(-np.exp(mu * np.e / A * (lam - t) + 1))
+
+
+def baranyi_curve(t, y0, A, mu, lam):
+    """
+    Baranyi and Roberts growth model
+    """
+    h0 = mu * lam
+    adjusted_t = t + np.log(np.exp(-mu * t) + np.exp(-h0) - np.exp(-mu * t - h0)) / mu
+    return y0 + mu * adjusted_t - np.log(1 + (np.exp(mu * adjusted_t) - 1) / np.exp(A))
+
+
+def exponential_time(y, y0, mu):
+    return (y - y0) / mu
+
+
+def logistic_time(y, y0, A, mu, lam):
+    if not 0 < y - y0 < A:
+        return np.nan
+    return lam - (np.log(A / (y - y0) - 1) - 2) * A / (4 * mu)
+
+
+def gompertz_time(y, y0, A, mu, lam):
+    if not 0 < y - y0 < A:
+        return np.nan
+    return lam - (np.log(-np.log((y - y0) / A)) - 1) * A / (mu * np.e)
+
+
+def baranyi_time(y, y0, A, mu, lam):
+    if not 0 < y - y0 < A:
+        return np.nan
+    # the curve only increases, so step forward until it passes the target and then solve in that bracket
+    t_low = 0.0
+    t_high = lam + A / mu
+    while baranyi_curve(t_high, y0, A, mu, lam) < y:
+        t_high *= 2
+    return brentq(lambda t: baranyi_curve(t, y0, A, mu, lam) - y, t_low, t_high)
+
+
+# for each model: the curve, the time the curve reaches a ln OD and the parameter names
+growth_models = {
+    'exponential': (exponential_curve, exponential_time, ['y0', 'mu']),
+    'logistic': (logistic_curve, logistic_time, ['y0', 'A', 'mu', 'lam']),
+    'gompertz': (gompertz_curve, gompertz_time, ['y0', 'A', 'mu', 'lam']),
+    'baranyi': (baranyi_curve, baranyi_time, ['y0', 'A', 'mu', 'lam'])
+}
+
+
+def initial_guess(hours, ln_od, model):
+    """Returns a list of starting parameters for fitting the model to one tube's data
+
+    Arguments:
+
+    hours -- numpy array of time points in hours
+
+    ln_od -- numpy array of ln OD values at the time points
+
+    model -- name of the model in growth_models
+    """
+    tenth = max(len(ln_od) // 10, 1)
+    y0 = np.median(ln_od[:tenth])
+    y_max = np.median(ln_od[-tenth:]) if model != 'exponential' else ln_od[-1]
+    A = max(y_max - y0, 0.1)
+    span = max(hours[-1] - hours[0], 1e-3)
+    if model == 'exponential':
+        return [y0 - (ln_od[-1] - y0) / span * hours[0], (ln_od[-1] - y0) / span]
+    # the steepest rise over a tenth of the data is a starting point for the growth rate
+    rises = (ln_od[tenth:] - ln_od[:-tenth]) / np.maximum(hours[tenth:] - hours[:-tenth], 1e-3)
+    mu = max(np.max(rises), 1e-3) if len(rises) else A / span
+    steepest = np.argmax(rises) if len(rises) else 0
+    lam = max(hours[steepest] - (ln_od[steepest] - y0) / mu, 0.0)
+    return [y0, A, mu, lam]
+
+
+def fit_growth_model(hours, ln_od, model, p0=None):
+    """Returns a tuple of the fitted parameters (numpy array) and the r^2 of the fit of a growth model to one tube,
+    parameters are None if the fit failed
+
+    Arguments:
+
+    hours -- numpy array of time points in hours
+
+    ln_od -- numpy array of ln OD values at the time points (no nan)
+
+    model -- name of the model in growth_models
+
+    p0 -- starting parameters, e.g. the last fit of the same tube (default None to guess them from the data)
+    """
+    curve, time_of, param_names = growth_models[model]
+    if len(ln_od) <= len(param_names):
+        return None, 0
+    warm_start = p0 is not None
+    if p0 is None:
+        p0 = initial_guess(hours, ln_od, model)
+    if model == 'exponential':
+        bounds = (-np.inf, np.inf)
+    else:
+        # positive increase and growth rate, lag time from the start of the data
+        bounds = ([-np.inf, 1e-6, 1e-6, 0], [np.inf, np.inf, np.inf, np.inf])
+        p0 = np.clip(p0, [-np.inf, 1e-6, 1e-6, 0], np.inf)
+    try:
+        with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+            popt, pcov = curve_fit(curve, hours, ln_od, p0=p0, bounds=bounds, maxfev=5000)
+            residuals = ln_od - curve(hours, *popt)
+    except (RuntimeError, ValueError):
+        if warm_start:
+            # the last fit was not a good start, try again from a guess
+            return fit_growth_model(hours, ln_od, model)
+        return None, 0
+    total = np.sum((ln_od - np.mean(ln_od)) ** 2)
+    r_squared = 1 - np.sum(residuals ** 2) / total if total > 0 else 0
+    return popt, r_squared
+
+
+# last growth model fit of each tube keyed by (fit key, tube number, model), used to warm start the next fit and to
+# skip fitting when no new data came in
+growth_fits = {}
+
+
+def fit_growth_models(bundle, model, target_vals, tubes=None, fit_key=None):
+    """Returns a tuple of a list of time estimates (strings), a list of r^2 values (strings) and a list of dicts of the
+    fitted parameters, in the same order as the tubes, like estimate_times
+
+    Every tube is fit over all of its data. A tube whose data did not change since its last fit reuses it, otherwise
+    the last parameters of the same tube are the starting point of the new fit.
+
+    Arguments:
+
+    bundle -- AnalysisBundle from analysis_funs with the data of all tubes
+
+    model -- name of the model in growth_models
+
+    target_vals -- list of target OD values to make estimates for, one for each tube in tubes
+
+    tubes -- list of tube numbers to fit (default None for all tubes)
+
+    fit_key -- anything identifying the series of data (e.g. device number) for warm starts (default None for no
+    warm starts)
+    """
+    curve, time_of, param_names = growth_models[model]
+    if tubes is None:
+        tubes = list(range(bundle.od.shape[1]))
+
+    # find the tubes that need a new fit and start them all at once
+    fits = {}
+    jobs = {}
+    job_tubes = {}
+    for tube_num in tubes:
+        valid = bundle.valid[:, tube_num]
+        hours = bundle.hours[valid]
+        ln_od = bundle.ln_od[valid, tube_num]
+        # the data of a tube is the same when it has the same points, offset and first and last time
+        signature = (len(hours), bundle.offsets[tube_num], bundle.times[0],
+                     hours[-1] if len(hours) else None)
+
+        previous = growth_fits.get((fit_key, tube_num, model)) if fit_key is not None else None
+        if previous is not None and previous['signature'] == signature:
+            fits[tube_num] = (previous['params'], previous['r_squared'])
+            continue
+
+        p0 = None
+        if previous is not None and previous['params'] is not None and previous['signature'][1] == signature[1]:
+            # the last parameters of the same tube are a good start, moved to the new time zero
+            p0 = np.array(previous['params'], dtype=float)
+            shift = (bundle.times[0] - previous['signature'][2]) / pd.Timedelta(1, 'h')
+            if model == 'exponential':
+                p0[0] += p0[1] * shift
+            else:
+                p0[3] -= shift
+        # the job key identifies the data and starting point, so the scheduler can reuse results
+        data_hash = hashlib.md5(hours.tobytes() + ln_od.tobytes()).hexdigest()
+        job_key = (model, data_hash, None if p0 is None else tuple(p0))
+        jobs[job_key] = (hours, ln_od, model, p0)
+        job_tubes[job_key] = (tube_num, signature)
+
+    results = run_fits(fit_growth_model, jobs)
+    for job_key, (tube_num, signature) in job_tubes.items():
+        # fits that timed out count as failed and are tried again next time
+        popt, r_squared = results.get(job_key, (None, 0))
+        fits[tube_num] = (popt, r_squared)
+        if fit_key is not None and job_key in results:
+            growth_fits[(fit_key, tube_num, model)] = {'signature': signature, 'params': popt,
+                                                       'r_squared': r_squared}
+
+    estimates = []
+    r_vals = []
+    parameters = []
+    for tube_num, target in zip(tubes, target_vals):
+        popt, r_squared = fits[tube_num]
+        if popt is None:
+            estimates.append("none")
+            r_vals.append("0")
+            parameters.append({})
+            continue
+
+        intercept_x = time_of(np.log(float(target)), *popt)
+        if np.isfinite(intercept_x):
+            time_intercept_x = (intercept_x * pd.Timedelta(1, 'h')) + bundle.times[0]
+            estimates.append(time_intercept_x.strftime("%Y-%m-%d %H:%M:%S"))
+        else:
+            # the target is above the model's stationary phase
+            estimates.append("none")
+        r_vals.append(f"{r_squared}"[0:5])
+        parameters.append(dict(zip(param_names, popt)))
+    return estimates, r_vals, parameters
+
+
+def estimate_time(curve_info, first_time_time, target_val):
+    """Returns a tuple of the time estimate (string) for when the fit line reaches the target and the r^2 value (string)
+
+    Arguments:
+
+    curve_info -- list of slope, intercept and r value returned by predict_curve (empty list if there was no fit)
+
+    first_time_time -- datetime of the first data point, hour 0 of the fit
+
+    target_val -- target OD value to make the estimate for
+    """
+    if len(curve_info) == 0:
+        return "none", "0"
+
+    # get where the ln curve intercepts the target line
+    intercept_x = (np.log(float(target_val)) - curve_info[1]) / curve_info[0]  # solve for x = (y - b)/slope
+    # transform from float value intercept to datetime object
+    time_intercept_x = (intercept_x * pd.Timedelta(1, 'h')) + first_time_time
+    time_intercept_x_str = (time_intercept_x).strftime("%Y-%m-%d %H:%M:%S")     # from datetime object to string
+
+    r = curve_info[2]
+    return time_intercept_x_str, f"{r**2}"[0:5]
+
+
+def hours_to_time_str(first_time_time, hours):
+    """Returns the time (string) some hours after the first data point, or "none" if hours is not a usable number"""
+    if not np.isfinite(hours) or abs(hours) > 24 * 365 * 100:
+        return "none"
+    return ((hours * pd.Timedelta(1, 'h')) + first_time_time).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def eta_intervals(bundle, target_vals, tubes, confidence=0.95):
+    """Returns a tuple of numpy arrays of the lower and upper bound (hours since the first data point) of when each
+    tube's fit line reaches its target, for all tubes at once
+
+    The bound is the inverse prediction (delta method) of the regression: the crossing time x0 = (ln(target) - b) / m
+    has a standard error of se / |m| * sqrt(1 / n + (x0 - t_mean)^2 / sxx), scaled by the t quantile with n - 2 degrees
+    of freedom. Tubes without a fit get nan.
+
+    Arguments:
+
+    bundle -- AnalysisBundle from analysis_funs with the data of all tubes
+
+    target_vals -- list of target OD values, one for each tube in tubes
+
+    tubes -- list of tube numbers
+
+    confidence -- confidence level of the bounds (default 0.95)
+    """
+    tubes = np.asarray(tubes, dtype=int)
+    fits = {name: bundle.fits[name][tubes] for name in ['slope', 'intercept', 'n', 'sxx', 't_mean', 'se']}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossing = (np.log(np.asarray(target_vals, dtype=float)) - fits['intercept']) / fits['slope']
+        quantile = stats.t.ppf(0.5 + confidence / 2, fits['n'] - 2)
+        half_width = quantile * fits['se'] / np.abs(fits['slope']) * \
+            np.sqrt(1 / fits['n'] + (crossing - fits['t_mean']) ** 2 / fits['sxx'])
+    return crossing - half_width, crossing + half_width
+
+
+def bootstrap_eta_intervals(bundle, target_vals, tubes, confidence=0.95, num_samples=500, seed=0):
+    """Returns a tuple of numpy arrays of the lower and upper bound (hours since the first data point) of when each
+    tube's fit line reaches its target, from a bootstrap of the points in the tube's fit window
+
+    All of the resampled fits of a tube are done at once with numpy, tubes without a fit get nan.
+
+    Arguments:
+
+    bundle -- AnalysisBundle from analysis_funs with the data of all tubes
+
+    target_vals -- list of target OD values, one for each tube in tubes
+
+    tubes -- list of tube numbers
+
+    confidence -- confidence level of the bounds (default 0.95)
+
+    num_samples -- int number of bootstrap resamples (default 500)
+
+    seed -- seed of the random resampling, fixed so the table does not change between updates (default 0)
+    """
+    rng = np.random.default_rng(seed)
+    lows = np.full(len(tubes), np.nan)
+    highs = np.full(len(tubes), np.nan)
+    for i, (tube_num, target) in enumerate(zip(tubes, target_vals)):
+        hours, ln_od = bundle.window_points(tube_num)
+        if len(hours) <= 2:
+            continue
+        # (sample x point) resampled windows
+        picks = rng.integers(0, len(hours), size=(num_samples, len(hours)))
+        t = hours[picks]
+        y = ln_od[picks]
+        t_dev = t - t.mean(axis=1, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = (t_dev * (y - y.mean(axis=1, keepdims=True))).sum(axis=1) / (t_dev ** 2).sum(axis=1)
+            intercept = y.mean(axis=1) - slope * t.mean(axis=1)
+            crossing = (np.log(float(target)) - intercept) / slope
+        crossing = crossing[np.isfinite(crossing)]
+        if len(crossing) == 0:
+            continue
+        lows[i], highs[i] = np.quantile(crossing, [0.5 - confidence / 2, 0.5 + confidence / 2])
+    return lows, highs
+
+
+def what_if_grid(bundle, target_vals, offset_vals, tubes=None):
+    """Returns a 3-D numpy array (tube x offset x target) of the hours from the first data point until each tube
+    reaches each target with each offset, nan where the tube is not growing
+
+    Every tube keeps the exponential phase window of the bundle's fit, so the counts and time sums of the window are
+    the same for all offsets and only the ln OD sums are computed again, for all tubes and offsets at once.
+
+    Arguments:
+
+    bundle -- AnalysisBundle from analysis_funs with the data of all tubes
+
+    target_vals -- list of target OD values
+
+    offset_vals -- list of offsets, each one replaces the tube's offset in the bundle
+
+    tubes -- list of tube numbers (default None for all tubes)
+    """
+    if tubes is None:
+        tubes = list(range(bundle.od.shape[1]))
+    tubes = list(tubes)
+    targets = np.asarray(target_vals, dtype=float)
+    offsets = np.asarray(offset_vals, dtype=float)
+
+    # the readings of the fit window of every tube, without the bundle's offsets
+    # the window ends where the fit's window does, at the last valid point with the bundle's offsets
+    valid = bundle.valid[:, tubes]
+    last_hour = np.array([bundle.hours[valid[:, i]][-1] if valid[:, i].any() else np.nan for i in range(len(tubes))])
+    usable = ~bundle.faults[:, tubes] & np.isfinite(bundle.od[:, tubes])
+    with np.errstate(invalid='ignore'):
+        in_window = usable & (bundle.hours[:, None] > last_hour + bundle.fits['start'][tubes]) & \
+            (bundle.hours[:, None] < last_hour + bundle.fits['end'][tubes])
+    rows = np.nonzero(in_window.any(axis=1))[0]
+    raw = bundle.od[rows][:, tubes] - np.asarray(bundle.offsets)[tubes]
+    in_window = in_window[rows]
+    t = bundle.hours[rows][:, None]
+
+    # offset x row x tube
+    shifted = raw[None, :, :] + offsets[:, None, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ln_od = np.log(shifted)
+    keep = in_window[None, :, :] & np.isfinite(ln_od)
+    y = np.where(keep, ln_od, 0.0)
+    t = np.where(keep, t[None, :, :], 0.0)
+    n = keep.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sxx = (t * t).sum(axis=1) - t.sum(axis=1) ** 2 / n
+        sxy = (t * y).sum(axis=1) - t.sum(axis=1) * y.sum(axis=1) / n
+        slope = sxy / sxx
+        intercept = (y.sum(axis=1) - slope * t.sum(axis=1)) / n
+        # offset x tube x target
+        hours = (np.log(targets)[None, None, :] - intercept[:, :, None]) / slope[:, :, None]
+    growing = (n > 2) & (slope > 0)
+    hours = np.where(growing[:, :, None] & np.isfinite(hours), hours, np.nan)
+    return hours.transpose(1, 0, 2)
+
+
+def changed_tubes(stored_table_df, current_table_df):
+    """Returns a dict with lists of the tube numbers whose name, target or offset differ between the stored table and
+    the rows coming from the datatable
+
+    Empty names and targets in the datatable keep the stored value, so they do not count as changes.
+
+    Arguments:
+
+    stored_table_df -- pandas dataframe of the stored table with columns 'name', 'target' and 'offset'
+
+    current_table_df -- pandas dataframe of the datatable rows
+    """
+    changes = {'name': [], 'target': [], 'offset': []}
+    for i in range(len(stored_table_df)):
+        row = current_table_df.iloc[i] if i < len(current_table_df) else pd.Series(dtype=object)
+
+        new_name = row.get('name')
+        if new_name is not None and new_name == new_name and new_name != "" and \
+                f"{i + 1}_" + new_name != stored_table_df['name'].iloc[i]:
+            changes['name'].append(i)
+
+        target = row.get('target')
+        if target is not None and target == target and float(target) != float(stored_table_df['target'].iloc[i]):
+            changes['target'].append(i)
+
+        if clean_offset(row.get('offset')) != clean_offset(stored_table_df['offset'].iloc[i]):
+            changes['offset'].append(i)
+    return changes
+
+
+def clean_offset(offset_value):
+    """Returns the offset as a float, empty table cells (None or NaN) count as an offset of 0"""
+    if offset_value is None or offset_value != offset_value or offset_value == "":
+        return 0.0
+    return float(offset_value)
+
+
+def estimate_tubes(bundle, model, target_vals, tubes, fit_key=None, interval='analytic'):
+    """Returns a tuple of a list of time estimates (strings), a list of r^2 values (strings) and a list of the (lower,
+    upper) bounds of the estimates (strings) for the tubes, from the bundle's fit of the exponential phase for the
+    'linear' model, from the Kalman filter of kalman_funs for 'kalman' or from fit_growth_models for the other models.
+    The growth models get "none" for the bounds.
+
+    Arguments:
+
+    bundle -- AnalysisBundle from analysis_funs with the data of all tubes
+
+    model -- 'linear', 'kalman' or the name of a model in growth_models
+
+    target_vals -- list of target OD values to make estimates for, one for each tube in tubes
+
+    tubes -- list of tube numbers
+
+    fit_key -- anything identifying the series of data (e.g. device number) for warm starts and to only run the Kalman
+    filter over new readings (default None)
+
+    interval -- for the 'linear' model, 'analytic' for eta_intervals or 'bootstrap' for bootstrap_eta_intervals (default 'analytic')
+    """
+    tubes = list(tubes)
+    target_vals = list(target_vals)
+    if model is None or model == 'linear':
+        estimates = []
+        r_vals = []
+        for tube_num, target in zip(tubes, target_vals):
+            estimate, r_val = estimate_time(bundle.curve_info(tube_num), bundle.times[0], target)
+            estimates.append(estimate)
+            r_vals.append(r_val)
+
+        if interval == 'bootstrap':
+            lows, highs = bootstrap_eta_intervals(bundle, target_vals, tubes)
+        else:
+            lows, highs = eta_intervals(bundle, target_vals, tubes)
+        bounds = [(hours_to_time_str(bundle.times[0], low), hours_to_time_str(bundle.times[0], high))
+                  for low, high in zip(lows, highs)]
+        return estimates, r_vals, bounds
+
+    if model == 'kalman':
+        state = run_kalman(bundle, tubes, fit_key=fit_key)
+        hours, lows, highs = kalman_forecast(state, target_vals)
+        # hours count from the filter's last reading
+        last_hour = 0 if state.last_time is None else (state.last_time - bundle.times[0]) / pd.Timedelta(1, 'h')
+        estimates = [hours_to_time_str(bundle.times[0], last_hour + hour) for hour in hours]
+        bounds = [(hours_to_time_str(bundle.times[0], last_hour + low),
+                   hours_to_time_str(bundle.times[0], last_hour + high)) for low, high in zip(lows, highs)]
+        r_vals = [f"{r_squared}"[0:5] for r_squared in state.r_squared()]
+        return estimates, r_vals, bounds
+
+    estimates, r_vals, parameters = fit_growth_models(bundle, model, target_vals, tubes=tubes, fit_key=fit_key)
+    return estimates, r_vals, [("none", "none")] * len(tubes)
+
+
 # move to functions file
 def estimate_times(lnDataframes, target_vals):
     """Returns a tuple of a list of time estimates (strings) and a list of r_values from the prediction curves (ints)
@@ -81,27 +694,9 @@ def estimate_times(lnDataframes, target_vals):
     for i in range(len(lnDataframes)):
         # get the data from json file
         lnODdf = pd.read_json(lnDataframes[i], orient='table')
-        print("lnODdf",  lnODdf)
         curve_info, last_time_point = predict_curve(lnODdf, [-2, 0])    # get the prediction info
 
-        if len(curve_info) != 0:
-
-            first_time_time = lnODdf.index[0]
-            # last_time_time = lnODdf.index[-1]
-            print(target_vals[i])
-            # get where the ln curve intercepts the target line
-            intercept_x = (np.log(float(target_vals[i])) - curve_info[1]) / curve_info[0]  # solve for x = (y - b)/slope
-            print(intercept_x)
-            # transform from float value intercept to datetime object
-            time_intercept_x = (intercept_x * pd.Timedelta(1, 'h')) + first_time_time
-            time_intercept_x_str = (time_intercept_x).strftime("%Y-%m-%d %H:%M:%S")     # from datetime object to string
-
-            estimates.append(time_intercept_x_str)
-            r = curve_info[2]
-            r_vals.append(f"{r**2}"[0:5])     # append r^2 values
-
-        else:
-            estimates.append("none")
-            r_vals.append("0")
+        estimate, r_val = estimate_time(curve_info, lnODdf.index[0] if len(lnODdf) else None, target_vals[i])
+        estimates.append(estimate)
+        r_vals.append(r_val)     # append r^2 values
     return estimates, r_vals
-
@@ -0,0 +1,209 @@
+import math
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from rq import Queue
+from worker import conn
+
+from cache_funs import LRUCache
+
+# where the fits run: 'process' for a pool of processes in this dyno, 'rq' for the rq workers started by worker.py or
+# 'serial' to run them one after another in the callback
+fit_backend = os.getenv('FIT_BACKEND', 'process')
+
+# seconds one fit may take before it is given up on
+fit_timeout = float(os.getenv('FIT_TIMEOUT', 20))
+
+# seconds a whole batch of fits may take. The fits run inside a Dash callback, so the batch has to end before gunicorn
+# ends the web worker (30 s unless the Procfile sets --timeout), the fits still running then are given up on
+batch_deadline = float(os.getenv('FIT_BATCH_DEADLINE', 25))
+
+# number of processes in the pool
+fit_workers = min(4, os.cpu_count() or 1)
+
+# results of finished fits keyed by the job key, so the same fit is never run twice
+fit_results = LRUCache(max_items=512)
+
+# process pool, created the first time it is needed
+fit_executor = None
+
+
+class FitTimeout(Exception):
+    """Raised in a fit that ran longer than its timeout"""
+
+
+def raise_fit_timeout(signum, frame):
+    """SIGALRM handler of timed_call"""
+    raise FitTimeout()
+
+
+def can_time_fits():
+    """Returns True if fits can be timed with SIGALRM here, which only the main thread of a Unix process can do"""
+    return hasattr(signal, 'setitimer') and threading.current_thread() is threading.main_thread()
+
+
+def timed_call(func, timeout, *args):
+    """Returns func(*args), raising FitTimeout if it runs for longer than timeout seconds
+
+    The timer is SIGALRM, so this has to run in the main thread of its process, like the tasks of a process pool.
+    """
+    previous = signal.signal(signal.SIGALRM, raise_fit_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return func(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def get_fit_executor():
+    """Returns the process pool used to run fits, creating it on first use"""
+    global fit_executor
+    if fit_executor is None:
+        fit_executor = ProcessPoolExecutor(max_workers=fit_workers)
+    return fit_executor
+
+
+def replace_fit_executor():
+    """Shuts the process pool down and ends its processes, so fits that are still running do not hold its slots, the
+    next batch gets a new pool"""
+    global fit_executor
+    if fit_executor is not None:
+        # the pool can not stop a task that is running, so its processes are ended
+        processes = list((fit_executor._processes or {}).values())
+        fit_executor.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+    fit_executor = None
+
+
+def run_fits_serial(func, jobs, timeout):
+    """Returns a dict of job key to result for the jobs that finished within timeout seconds each and batch_deadline
+    seconds in all, running them one after another in this process. Where SIGALRM can not be used (not the main
+    thread) they run in the process pool."""
+    if not can_time_fits():
+        return run_fits_process(func, jobs, timeout)
+    deadline = time.time() + batch_deadline
+    results = {}
+    for i, (key, args) in enumerate(jobs.items()):
+        time_left = min(timeout, deadline - time.time())
+        if time_left <= 0:
+            print(f"{len(jobs) - i} fits not run, the batch took more than {batch_deadline} s")
+            break
+        try:
+            results[key] = timed_call(func, time_left, *args)
+        except FitTimeout:
+            print(f"fit {key[0]} took more than {time_left:.1f} s, given up on")
+    return results
+
+
+def run_fits_process(func, jobs, timeout, retry=True):
+    """Returns a dict of job key to result for the jobs that finished within timeout seconds each, running them in the
+    process pool
+
+    Every fit times itself out in its process (timed_call), so its slot is free for the next one. If the batch still
+    has fits running once every fit could have run for timeout seconds, or after batch_deadline seconds, the pool is
+    replaced and the fits that finished are returned.
+    """
+    try:
+        futures = {get_fit_executor().submit(timed_call, func, timeout, *args): key for key, args in jobs.items()}
+    except BrokenProcessPool:
+        # a worker process died, so the batch is tried once more on a new pool
+        replace_fit_executor()
+        return run_fits_process(func, jobs, timeout, retry=False) if retry else {}
+
+    # the fits queue for the processes of the pool, so the batch gets a timeout for each round of them, but never more
+    # than batch_deadline
+    rounds = math.ceil(len(jobs) / fit_workers)
+    batch_timeout = min(timeout * rounds + 1, batch_deadline)
+    done, not_done = wait(futures, timeout=batch_timeout)
+    if len(not_done) != 0:
+        print(f"{len(not_done)} fits did not finish in {batch_timeout} s, replacing the process pool")
+        replace_fit_executor()
+
+    results = {}
+    for future in done:
+        try:
+            results[futures[future]] = future.result()
+        except FitTimeout:
+            print(f"fit {futures[future][0]} took more than {timeout} s, given up on")
+        except BrokenProcessPool:
+            replace_fit_executor()
+    return results
+
+
+def run_fits_rq(func, jobs, timeout, queue='high'):
+    """Returns a dict of job key to result for the jobs the rq workers finished within timeout seconds (at most
+    batch_deadline), unfinished jobs are cancelled"""
+    fit_queue = Queue(queue, connection=conn)
+    rq_jobs = {key: fit_queue.enqueue(func, *args, job_timeout=int(timeout) + 1, result_ttl=600)
+               for key, args in jobs.items()}
+
+    deadline = time.time() + min(timeout, batch_deadline)
+    results = {}
+    while len(rq_jobs) != 0 and time.time() < deadline:
+        for key, job in list(rq_jobs.items()):
+            status = job.get_status(refresh=True)
+            if status == 'finished':
+                results[key] = job.return_value()
+                del rq_jobs[key]
+            elif status in ('failed', 'stopped', 'canceled'):
+                del rq_jobs[key]
+        time.sleep(0.1)
+
+    for job in rq_jobs.values():
+        job.cancel()
+    return results
+
+
+def run_fits(func, jobs, backend=None, timeout=None):
+    """Returns a dict of job key to the result of func(*args) for every job that finished in time, with cached results
+    for jobs that already ran
+
+    Arguments:
+
+    func -- module level function to run (it has to be importable by the worker processes), e.g.
+    predict_funs.fit_growth_model
+
+    jobs -- dict of job key to the tuple of arguments for func. The key has to identify the arguments, it is the key
+    of the result cache
+
+    backend -- 'process', 'rq' or 'serial' (default None for fit_backend)
+
+    timeout -- seconds each fit may take (default None for fit_timeout)
+    """
+    backend = backend or fit_backend
+    timeout = timeout or fit_timeout
+
+    results = {}
+    pending = {}
+    for key, args in jobs.items():
+        cached = fit_results.get(key)
+        if cached is not None:
+            results[key] = cached
+        else:
+            pending[key] = args
+
+    if len(pending) == 0:
+        return results
+
+    if backend == 'serial' or len(pending) == 1:
+        new_results = run_fits_serial(func, pending, timeout)
+    elif backend == 'rq':
+        try:
+            new_results = run_fits_rq(func, pending, timeout)
+        except Exception as error:
+            # redis is not reachable, run the fits in this process instead
+            print(f"rq fits failed ({error}), fitting in the web process")
+            new_results = run_fits_process(func, pending, timeout)
+    else:
+        new_results = run_fits_process(func, pending, timeout)
+
+    for key, result in new_results.items():
+        fit_results.put(key, result)
+        results[key] = result
+    return results
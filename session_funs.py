@@ -0,0 +1,267 @@
+import hashlib
+import os
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+
+import redis
+from dash.exceptions import PreventUpdate
+
+from worker import conn
+
+# seconds a session is kept after it was last used
+session_ttl = int(os.getenv('SESSION_TTL', 6 * 3600))
+
+# most bytes (compressed) one session can hold, the least recently used values go first when it is full
+session_max_bytes = int(os.getenv('SESSION_MAX_BYTES', 16 * 1024 * 1024))
+
+# most sessions kept in memory by one process, the least recently used session goes first
+max_memory_sessions = int(os.getenv('SESSION_MAX_COUNT', 200))
+
+# prefix of the redis keys of the sessions
+session_prefix = 'iodr:session:'
+
+
+def default_backend():
+    """Returns the SESSION_BACKEND environment variable if it is set, else 'redis' if redis is reachable (so every
+    gunicorn worker sees the values) or 'browser' to send the values to the browser like before the session store"""
+    backend = os.getenv('SESSION_BACKEND')
+    if backend:
+        return backend
+    try:
+        conn.ping()
+        return 'redis'
+    except redis.exceptions.ConnectionError:
+        print("redis is not reachable, session values are sent to the browser")
+        return 'browser'
+
+
+def new_session_id():
+    """Returns a new random session id"""
+    return uuid.uuid4().hex
+
+
+def make_token(name, data):
+    """Returns the token a store holds for a value, the name and a hash of the value so a new value gets a new token
+
+    Arguments:
+
+    name -- name of the value in the session, e.g. 'od_culled'
+
+    data -- compressed bytes of the value
+    """
+    return f"{name}:{hashlib.md5(data).hexdigest()[:12]}"
+
+
+class MemorySession:
+    """Values of one session kept in this process, in order of use
+
+    values -- OrderedDict of name to (token, compressed bytes), least recently used first
+
+    size -- int number of bytes of all values
+
+    last_used -- time.time() of the last get or put
+    """
+
+    def __init__(self):
+        self.values = OrderedDict()
+        self.size = 0
+        self.last_used = time.time()
+
+
+class SessionStore:
+    """Server side values of each browser session (like the downloaded dataframes), so the dcc.Store components only
+    hold a short token and the data does not go back and forth with every callback
+
+    Values are compressed and kept in redis when backend is 'redis', so every gunicorn worker sees them. With 'browser'
+    (or when redis stops answering) put returns the values themselves and the stores carry them like before. 'memory'
+    keeps them in this process and is only for a server with one process, like the debug server, since another
+    worker would not find them. Every session holds at most max_bytes, sessions not used for ttl seconds are dropped,
+    and the memory backend keeps at most max_sessions sessions.
+
+    Arguments:
+
+    backend -- 'redis', 'browser' or 'memory' (default None for default_backend)
+
+    ttl -- seconds a session is kept after it was last used (default session_ttl)
+
+    max_bytes -- most compressed bytes of one session (default session_max_bytes)
+
+    max_sessions -- most sessions of the memory backend (default max_memory_sessions)
+    """
+
+    def __init__(self, backend=None, ttl=session_ttl, max_bytes=session_max_bytes, max_sessions=max_memory_sessions):
+        self.backend = backend or default_backend()
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.evictions = 0
+
+    def put(self, session_id, name, value):
+        """Stores a string value under a name in the session and returns its token, or returns the value itself if it
+        is larger than a whole session may hold (so it still works, the old way)
+
+        Arguments:
+
+        session_id -- id of the session from new_session_id
+
+        name -- name of the value, a new value of the same name replaces the old one
+
+        value -- string (e.g. a dataframe as json)
+        """
+        if self.backend == 'browser':
+            return value
+        data = zlib.compress(value.encode('utf-8'), 1)
+        if len(data) > self.max_bytes:
+            print(f"session value {name} is {len(data)} bytes, more than a session holds, sent to the browser")
+            return value
+        token = make_token(name, data)
+        if self.backend == 'redis':
+            try:
+                self.redis_put(session_id, name, token, data)
+                return token
+            except redis.exceptions.ConnectionError:
+                # other workers could not see values kept in memory, so they go to the browser
+                print("redis is not reachable, session values are sent to the browser")
+                self.backend = 'browser'
+                return value
+        self.memory_put(session_id, name, token, data)
+        return token
+
+    def get(self, session_id, token):
+        """Returns the string value of a token from put, or None if the session no longer has it. Values that were too
+        large for the session are their own token and come back as they are.
+
+        Arguments:
+
+        session_id -- id of the session from new_session_id
+
+        token -- token returned by put
+        """
+        if token is None or token.startswith('{'):
+            return token
+        name = token.split(':', 1)[0]
+        data = None
+        if self.backend == 'redis':
+            try:
+                data = self.redis_get(session_id, name, token)
+            except redis.exceptions.ConnectionError:
+                self.backend = 'browser'
+        elif self.backend == 'memory':
+            data = self.memory_get(session_id, name, token)
+        if data is None:
+            print(f"session value {name} is gone (evicted or expired)")
+            return None
+        return zlib.decompress(data).decode('utf-8')
+
+    def memory_put(self, session_id, name, token, data):
+        """Stores the compressed value in memory, evicting the session's least recently used values and the least
+        recently used sessions when over the limits"""
+        self.drop_expired()
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = self.sessions[session_id] = MemorySession()
+        self.sessions.move_to_end(session_id)
+        session.last_used = time.time()
+
+        if name in session.values:
+            session.size -= len(session.values.pop(name)[1])
+        session.values[name] = (token, data)
+        session.size += len(data)
+        while session.size > self.max_bytes and len(session.values) > 1:
+            evicted_name, (evicted_token, evicted_data) = session.values.popitem(last=False)
+            session.size -= len(evicted_data)
+            self.evictions += 1
+            print(f"session {session_id[:8]} over {self.max_bytes} bytes, evicted {evicted_name}")
+
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+            self.evictions += 1
+
+    def memory_get(self, session_id, name, token):
+        """Returns the compressed value of the token from memory, or None"""
+        self.drop_expired()
+        session = self.sessions.get(session_id)
+        if session is None or name not in session.values or session.values[name][0] != token:
+            return None
+        self.sessions.move_to_end(session_id)
+        session.values.move_to_end(name)
+        session.last_used = time.time()
+        return session.values[name][1]
+
+    def drop_expired(self):
+        """Drops the sessions not used for ttl seconds, the least recently used sessions are first"""
+        cutoff = time.time() - self.ttl
+        while len(self.sessions) != 0:
+            session_id, session = next(iter(self.sessions.items()))
+            if session.last_used >= cutoff:
+                break
+            del self.sessions[session_id]
+            self.evictions += 1
+
+    def redis_put(self, session_id, name, token, data):
+        """Stores the compressed value in the session's redis hash, evicting its least recently used values when over
+        max_bytes. Redis drops the whole session ttl seconds after its last use."""
+        key = f"{session_prefix}{session_id}"
+        used_key = f"{key}:used"
+        pipeline = conn.pipeline()
+        pipeline.hset(key, mapping={name: data, f"{name}:token": token})
+        pipeline.zadd(used_key, {name: time.time()})
+        pipeline.expire(key, self.ttl)
+        pipeline.expire(used_key, self.ttl)
+        pipeline.execute()
+
+        names = [used.decode('utf-8') for used in conn.zrange(used_key, 0, -1)]
+        sizes = conn.pipeline()
+        for used_name in names:
+            sizes.hstrlen(key, used_name)
+        sizes = sizes.execute()
+        total = sum(sizes)
+        for used_name, size in zip(names, sizes):
+            if total <= self.max_bytes or used_name == name:
+                break
+            conn.hdel(key, used_name, f"{used_name}:token")
+            conn.zrem(used_key, used_name)
+            total -= size
+            self.evictions += 1
+            print(f"session {session_id[:8]} over {self.max_bytes} bytes, evicted {used_name}")
+
+    def redis_get(self, session_id, name, token):
+        """Returns the compressed value of the token from redis, or None"""
+        key = f"{session_prefix}{session_id}"
+        stored_token, data = conn.hmget(key, f"{name}:token", name)
+        if stored_token is None or stored_token.decode('utf-8') != token:
+            return None
+        pipeline = conn.pipeline()
+        pipeline.zadd(f"{key}:used", {name: time.time()})
+        pipeline.expire(key, self.ttl)
+        pipeline.expire(f"{key}:used", self.ttl)
+        pipeline.execute()
+        return data
+
+    def stats(self):
+        """Returns a dict with the backend, the number of sessions and bytes in memory and the number of evictions"""
+        return {'backend': self.backend, 'sessions': len(self.sessions),
+                'bytes': sum(session.size for session in self.sessions.values()), 'evictions': self.evictions}
+
+
+# the session store of the app
+session_store = SessionStore()
+
+
+def session_value(session_id, token):
+    """Returns the value of a store's token from the session store, or stops the callback (PreventUpdate) if the
+    session no longer has it
+
+    Arguments:
+
+    session_id -- id of the session from the session id store
+
+    token -- token the store holds
+    """
+    value = session_store.get(session_id, token)
+    if value is None:
+        raise PreventUpdate
+    return value
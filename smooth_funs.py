@@ -0,0 +1,166 @@
+import numpy as np
+import pandas as pd
+from scipy.signal import savgol_filter
+
+from cache_funs import LRUCache
+
+# smoothing methods offered in the app, 'none' leaves the data as it is
+smoothing_methods = {
+    'none': 'None',
+    'savgol': 'Savitzky-Golay',
+    'median': 'Rolling median'
+}
+
+# number of readings in the smoothing window (odd, so the window is centred on the reading)
+smoothing_window = 11
+
+# last smoothed dataframe of each device, source and method, keyed by (device, source, method)
+smoothed_cache = LRUCache(max_items=12)
+
+
+def smooth_values(values, method, window=smoothing_window, polyorder=2):
+    """Returns a 2-D numpy array of the smoothed values, every column is smoothed at once
+
+    Missing readings (nan) are filled in for the filter and are nan again in the result.
+
+    Arguments:
+
+    values -- 2-D numpy array (time x tube) of readings
+
+    method -- 'none', 'savgol' for a Savitzky-Golay filter or 'median' for a rolling median
+
+    window -- int odd number of readings in the window (default smoothing_window)
+
+    polyorder -- order of the Savitzky-Golay polynomial (default 2)
+    """
+    values = np.asarray(values, dtype=float)
+    if method == 'none' or len(values) == 0:
+        return values.copy()
+
+    missing = np.isnan(values)
+    if method == 'median':
+        # a centred rolling median ignores missing readings on its own
+        smoothed = pd.DataFrame(values).rolling(window, center=True, min_periods=1).median().to_numpy()
+    elif method == 'savgol':
+        if len(values) < window:
+            return values.copy()
+        # the filter can not skip missing readings, so they get the value of the line between their neighbours
+        filled = pd.DataFrame(values).interpolate(limit_direction='both').to_numpy()
+        filled = np.where(np.isnan(filled), 0.0, filled)
+        smoothed = savgol_filter(filled, window, polyorder, axis=0, mode='interp')
+    else:
+        raise ValueError(f"unknown smoothing method {method}")
+    smoothed[missing] = np.nan
+    return smoothed
+
+
+def smooth_dataframe(dataframe, method, window=smoothing_window):
+    """Returns a copy of the dataframe with every column smoothed by smooth_values
+
+    Arguments:
+
+    dataframe -- pandas dataframe of numbers with a datetime index, like the one from get_OD_dataframe
+
+    method -- 'none', 'savgol' or 'median'
+
+    window -- int odd number of readings in the window (default smoothing_window)
+    """
+    return pd.DataFrame(smooth_values(dataframe.to_numpy(dtype=float), method, window), index=dataframe.index,
+                        columns=dataframe.columns)
+
+
+def first_finite(values, row):
+    """Returns the index of the first row at or after row by which every column has had a finite reading, or the
+    number of rows if some column has none
+
+    Arguments:
+
+    values -- 2-D numpy array (time x tube) of readings
+
+    row -- int index of the row to look from
+    """
+    finite = np.isfinite(values[row:])
+    if len(finite) == 0 or not finite.any(axis=0).all():
+        return len(values)
+    return row + int(finite.argmax(axis=0).max())
+
+
+def last_finite(values, row):
+    """Returns the index of the last row at or before row by which every column has had a finite reading (looking
+    back), or -1 if some column has none
+
+    Arguments:
+
+    values -- 2-D numpy array (time x tube) of readings
+
+    row -- int index of the row to look back from
+    """
+    finite = np.isfinite(values[:row + 1][::-1])
+    if len(finite) == 0 or not finite.any(axis=0).all():
+        return -1
+    return row - int(finite.argmax(axis=0).max())
+
+
+def get_smoothed_data(device, dataframe, method, window=smoothing_window, source='live'):
+    """Returns the dataframe smoothed with the method, reusing the last smoothed dataframe of the device
+
+    Thingspeak keeps the most recent readings, so a new download is the last one with rows dropped from the start and
+    rows appended at the end. Only the new rows and the window at each end (whose smoothed values change with the data
+    around them) are smoothed again, the rest is copied from the cache. Missing readings are filled in from the
+    readings on either side of them, so a head or tail segment reaches out to the nearest reading of every tube, and
+    rows whose filled in neighbours could differ from the last download are not copied. The result is the same as
+    smoothing the whole dataframe.
+
+    Arguments:
+
+    device -- int device number (0-2)
+
+    dataframe -- pandas dataframe of the full download, like the one from get_OD_dataframe
+
+    method -- 'none', 'savgol' or 'median'
+
+    window -- int odd number of readings in the window (default smoothing_window)
+
+    source -- where the dataframe comes from, 'live' for Thingspeak or e.g. 'archive3' for an archived run, so opening
+    an archived run does not replace the cache of the device's live data (default 'live')
+    """
+    if method == 'none':
+        return dataframe
+
+    key = (device, source, method)
+    cached = smoothed_cache.get(key)
+    if cached is not None and cached.index.equals(dataframe.index) and cached.columns.equals(dataframe.columns):
+        return cached
+
+    # where the new download starts in the cached one
+    start = -1
+    if cached is not None and len(cached) != 0 and len(dataframe) != 0 and cached.columns.equals(dataframe.columns):
+        start = cached.index.searchsorted(dataframe.index[0])
+        overlap = len(cached) - start
+        if start >= len(cached) or overlap > len(dataframe) or \
+                not cached.index[start:].equals(dataframe.index[:overlap]):
+            start = -1
+
+    values = dataframe.to_numpy(dtype=float)
+    if start >= 0:
+        # the middle of the overlap keeps its smoothed values. Its rows are a window away from the ends, and from any
+        # missing readings that were filled in from readings the last download had before the start or did not have
+        # yet after the end of the overlap
+        keep_from = max(window, first_finite(values, 0) + window)
+        keep_to = min(overlap - window, last_finite(values, overlap - 1) - window + 1)
+    if start < 0 or overlap < 3 * window or keep_to - keep_from < window:
+        smoothed = smooth_dataframe(dataframe, method, window)
+    else:
+        smoothed_values = np.empty_like(values)
+        smoothed_values[keep_from:keep_to] = cached.to_numpy()[start + keep_from:start + keep_to]
+        # the head and the tail (with the new rows) are smoothed with at least a window of readings around them, and
+        # out to the nearest reading of every tube so missing readings are filled in like in the whole dataframe
+        head_end = max(keep_from + window, first_finite(values, keep_from + window - 1) + 1)
+        smoothed_values[:keep_from] = smooth_values(values[:head_end], method, window)[:keep_from]
+        tail_start = max(min(keep_to - window, last_finite(values, keep_to - window)), 0)
+        tail = smooth_values(values[tail_start:], method, window)
+        smoothed_values[keep_to:] = tail[keep_to - tail_start:]
+        smoothed = pd.DataFrame(smoothed_values, index=dataframe.index, columns=dataframe.columns)
+        print(f"smoothed {len(dataframe) - keep_to + keep_from} of {len(dataframe)} rows")
+
+    return smoothed_cache.put(key, smoothed)
@@ -1,6 +1,7 @@
 import os
 
 import redis
+from rq import Worker, Queue
 
 listen = ['high', 'default', 'low']
 
@@ -9,6 +10,6 @@ redis_url = os.getenv('REDISTOGO_URL', 'redis://localhost:6379')
 conn = redis.from_url(redis_url)
 
 if __name__ == '__main__':
-    with Connection(conn):
-        worker = Worker(map(Queue, listen))
-        worker.work()
+    worker = Worker([Queue(name, connection=conn) for name in listen], connection=conn)
+    # the scheduler runs the alert checks that alert_funs queues for later
+    worker.work(with_scheduler=True)